@@ -0,0 +1,240 @@
+"""Reprocesses a past period of one search
+
+    python -m geode.backfill <search> <start> <end> [options]
+
+start and end are times like 2018-01-16T00:00:00. The period is split into
+chunks that are searched and loaded concurrently, in batches (see
+geode.batch), with no more than --jobs Splunk jobs open at once.
+
+Each chunk keeps its own checkpoint, so running the same backfill again
+picks up where it left off, skipping the chunks that are already done.
+Chunks are loaded out of order, so backfill DHCP before the searches that
+depend on it, and expect correlation across chunk boundaries to be less
+exact than it is when geode runs normally.
+"""
+from geode.main import Geode
+import geode.utils as utils
+
+import argparse
+import datetime
+import logging
+import sys
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# How many times a chunk is tried before we give up on it
+RETRIES = 3
+
+# Batches are always used for backfills, and are at least this big
+MIN_BATCH_SIZE = 500
+
+
+def checkpoint_key(search, start):
+    """Returns the name that a chunk's checkpoint is kept under"""
+    return "backfill:{0}:{1}".format(search, utils.dto_to_string(start))
+
+
+def split(start, end, chunk):
+    """Splits start to end into (start, end) pairs chunk seconds long"""
+
+    chunks = []
+    while start < end:
+        chunks.append((start, min(utils.time_diff(start, chunk), end)))
+        start = chunks[-1][1]
+    return chunks
+
+
+class Backfill:
+    """Searches and loads the chunks of a period, several at once"""
+
+    def __init__(self, search, start, end, chunk=3600, jobs=4,
+                 log_file='/var/log/geode/geode.log', report_interval=30):
+        self.search = search
+        self.chunk = chunk
+        self.chunks = split(start, end, chunk)
+        self.jobs = jobs
+        self.log_file = log_file
+        self.report_interval = report_interval
+
+        # Every Splunk job that the backfill opens holds one of these
+        self.job_slots = threading.BoundedSemaphore(jobs)
+
+        self.queue = queue.Queue()
+        for c in self.chunks:
+            self.queue.put(c)
+
+        # Progress, shared by the workers
+        self.lock = threading.Lock()
+        self.done = 0
+        self.skipped = 0
+        # Events in the chunks that have been loaded
+        self.events = 0
+        self.failed = []
+        self.started = None
+
+    def run(self):
+        """Runs the backfill, reporting progress as it goes
+
+        Returns True if every chunk was loaded
+        """
+
+        self.started = time.time()
+        threads = [threading.Thread(target=self._worker)
+                   for i in range(min(self.jobs, len(self.chunks)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        reported = time.time()
+        for t in threads:
+            # Joining with a timeout keeps us responsive to KeyboardInterrupt
+            while t.is_alive():
+                t.join(1)
+                if time.time() - reported >= self.report_interval:
+                    self.report()
+                    reported = time.time()
+        self.report()
+
+        for c in self.failed:
+            message = "Chunk {0} to {1} failed".format(
+                utils.dto_to_string(c[0]), utils.dto_to_string(c[1]))
+            print(message)
+            logging.error(message)
+        return not self.failed
+
+    def report(self):
+        """Prints and logs how far the backfill has got"""
+
+        with self.lock:
+            done = self.done
+            skipped = self.skipped
+            events = self.events
+            failed = len(self.failed)
+
+        elapsed = time.time() - self.started
+        rate = events / elapsed if elapsed > 0 else 0
+        # Chunks that were already done don't tell us how long the rest take
+        loaded = done - skipped
+        remaining = len(self.chunks) - done - failed
+        if loaded > 0 and remaining > 0:
+            eta = datetime.timedelta(
+                seconds=int(elapsed / loaded * remaining))
+        else:
+            eta = "unknown" if remaining else datetime.timedelta(0)
+
+        message = ("Backfill {0}: {1}/{2} chunks ({3} already done, {4} "
+                   "failed), {5} events, {6:.0f}/s, eta {7}".format(
+                       self.search, done, len(self.chunks), skipped, failed,
+                       events, rate, eta))
+        print(message)
+        logging.info(message)
+
+    def _worker(self):
+        """Loads chunks until there are none left"""
+
+        geode = None
+        while True:
+            try:
+                chunk = self.queue.get(False)
+            except queue.Empty:
+                return
+
+            for attempt in range(RETRIES):
+                try:
+                    if geode is None:
+                        geode = self._connect()
+                    self._load(geode, chunk)
+                    break
+                except Exception as e:
+                    logging.exception("Backfill of {0} from {1} failed: "
+                                      "{2}".format(self.search,
+                                                   utils.dto_to_string(
+                                                       chunk[0]), e))
+                    # Start again with new connections
+                    geode = None
+                    if attempt + 1 < RETRIES:
+                        utils.wait(10)
+            else:
+                with self.lock:
+                    self.failed.append(chunk)
+
+    def _connect(self):
+        """Returns a Geode, with its own connections, set up for loading"""
+
+        geode = Geode(log_file=self.log_file)
+        # The other threads, and the daemon, write the same sessions, so a
+        # session cache of our own would go stale
+        geode._connect(cache=False)
+        geode.batch_size = max(geode.batch_size, MIN_BATCH_SIZE)
+        # Let quiet searches use windows as long as a chunk
+        geode.splunk.max_window = max(geode.splunk.max_window, self.chunk)
+        return geode
+
+    def _load(self, geode, chunk):
+        """Searches and loads one chunk, from its checkpoint if it has one"""
+
+        start, end = chunk
+        key = checkpoint_key(self.search, start)
+
+        earliest_time = geode.database.get_checkpoint(key)
+        if earliest_time is not None and earliest_time >= end:
+            with self.lock:
+                self.done += 1
+                self.skipped += 1
+            return
+
+        results = geode.splunk.search(self.search, end,
+                                      earliest_time or start,
+                                      job_slots=self.job_slots)
+        # Counted for this attempt only, since a failed one is tried again
+        count = [0]
+        try:
+            geode.process_batched(self._counted(results, count), key)
+        except Exception:
+            results.close()
+            raise
+
+        # Everything up to the end of the chunk is in
+        geode.database.set_checkpoint(key, end)
+        with self.lock:
+            self.done += 1
+            self.events += count[0]
+
+    def _counted(self, results, count):
+        """Passes results through, counting the events in count[0]"""
+
+        for r in results:
+            if isinstance(r, dict):
+                count[0] += 1
+            yield r
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Reprocess a past period of one search")
+    parser.add_argument("search", help="the name of the search to run")
+    parser.add_argument("start", help="where to start, like "
+                        "2018-01-16T00:00:00")
+    parser.add_argument("end", help="where to stop")
+    parser.add_argument("--chunk", type=int, default=3600,
+                        help="seconds of the period in each chunk")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="Splunk jobs to have open at once")
+    parser.add_argument("--log-file", default="/var/log/geode/geode.log")
+    args = parser.parse_args(argv)
+
+    if args.search not in utils.get_search_names(raw=True):
+        parser.error("No search called {0}".format(args.search))
+
+    backfill = Backfill(args.search, utils.string_to_dto(args.start),
+                        utils.string_to_dto(args.end), args.chunk,
+                        args.jobs, args.log_file)
+    return 0 if backfill.run() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+import geode.metrics as metrics
+import geode.utils as utils
+from geode.event import SELECT_BUFFER
+
+import time
+
+
+class Batch:
+    """Collects events from Splunk so they can be correlated in bulk
+
+    Instead of a select and a write for every event, a batch does one select
+    for every session that the events could touch, works out the matches and
+    merges in memory (see correlate), and writes everything back in a single
+    transaction. If the database is set up to correlate on the server, the
+    whole batch is handed to it in one call instead.
+    """
+
+    def __init__(self, database, size=500, flush_interval=5, search=None):
+        """Takes the Database to write to, the number of events to collect
+        before flushing, the number of seconds an event may wait in the
+        batch before it is flushed, and the search the events come from
+
+        If a search is given, its checkpoint is written along with each batch
+        """
+
+        self.database = database
+        self.size = size
+        self.flush_interval = flush_interval
+        self.search = search
+        self.events = []
+        self.started = None
+
+        # How far the search has got, and how much of that is committed
+        self.progress = None
+        self.committed = None
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event):
+        """Adds an event to the batch, and flushes if the batch is full or
+        its oldest event has been waiting longer than the flush interval
+
+        Returns True if the batch was flushed
+        """
+
+        if not self.events:
+            self.started = time.time()
+        self.events.append(event)
+
+        if (len(self.events) >= self.size or
+                time.time() - self.started >= self.flush_interval):
+            return self.flush()
+
+        return False
+
+    def advance(self, time):
+        """Records that the search has been read up to the given time, which
+        becomes the checkpoint when the batch is next flushed"""
+        self.progress = time
+
+    def flush(self):
+        """Correlates the events in the batch and writes them, along with the
+        checkpoint, to the database
+
+        Returns True if anything was written
+        """
+
+        checkpoint = None
+        if self.search is not None and self.progress != self.committed:
+            checkpoint = (self.search, self.progress)
+
+        if not self.events and checkpoint is None:
+            return False
+
+        if getattr(self.database, 'server_correlate', False):
+            for action, i in self.database.correlate_many(self.events,
+                                                          checkpoint):
+                metrics.count("events_" + action)
+        else:
+            # The sessions are looked up in the same transaction that they
+            # are written in, so that when other writers are about they can
+            # be locked in between (see Database.select_many)
+            with self.database.transaction():
+                candidates = self.database.select_many(self.events)
+                with metrics.timer("correlate"):
+                    inserts, updates = correlate(self.events, candidates)
+                self.database.write_many(inserts, updates, checkpoint)
+
+        self.events = []
+        self.started = None
+        self.committed = self.progress
+
+        return True
+
+
+def correlate(events, sessions):
+    """Works out what process_results would have done with the events, one at
+    a time, against the given sessions from the database
+
+    Events that were inserted earlier in the batch can be matched by later
+    events, just like they would be if they were written one at a time.
+
+    Returns a list of events to insert, and a dict mapping the id of each
+    session that changed to its new value
+    """
+
+    index = _Index(sessions)
+    inserts = []
+    updates = {}
+
+    for event in events:
+        lookup = index.select(event)
+
+        if lookup is not None:
+            if event.matches(lookup):
+                # Merge in place so that the session is updated everywhere
+                # that it is referenced (the index, inserts, updates)
+                merged = lookup.merge(event)
+                lookup.clear()
+                lookup.update(merged)
+                index.add(lookup)
+                if lookup.get('id') is not None:
+                    updates[lookup.get('id')] = lookup
+                metrics.count("events_merged")
+                continue
+
+            # Conflicting information, so terminate the old session at the
+            # start of the new event (see Database.terminate)
+            lookup['stop'] = event.get('start')
+            if lookup.get('id') is not None:
+                updates[lookup.get('id')] = lookup
+            metrics.count("events_terminated")
+
+        inserts.append(event)
+        index.add(event)
+        metrics.count("events_inserted")
+
+    return inserts, updates
+
+
+class _Index:
+    """In memory stand-in for select_mac_plan and select_ip_plan"""
+
+    def __init__(self, sessions=()):
+        self.macs = {}
+        self.ips = {}
+        for s in sessions:
+            self.add(s)
+
+    def add(self, session):
+        """Indexes a session by its MAC and IP"""
+
+        if session.get('mac') is not None:
+            key = utils.mac_key(session.get('mac'))
+            bucket = self.macs.setdefault(key, [])
+            if not any(s is session for s in bucket):
+                bucket.append(session)
+        if session.get('ip') is not None:
+            bucket = self.ips.setdefault(session.get('ip'), [])
+            if not any(s is session for s in bucket):
+                bucket.append(session)
+
+    def select(self, event):
+        """Returns the session that Database.select would return"""
+
+        if event.get('mac') is not None:
+            key = utils.mac_key(event.get('mac'))
+            bucket = [s for s in self.macs.get(key, [])
+                      if s.get('mac') is not None and
+                      utils.mac_key(s.get('mac')) == key]
+        elif event.get('ip') is not None:
+            key = event.get('ip')
+            bucket = [s for s in self.ips.get(key, [])
+                      if s.get('ip') == key]
+        else:
+            raise Exception("Not enough data to select upon: Mac/IP required")
+
+        adjusted_start = utils.time_diff(event.get('start'), SELECT_BUFFER)
+        adjusted_stop = utils.time_diff(event.get('stop'), SELECT_BUFFER)
+
+        for s in bucket:
+            if ((adjusted_start <= s.get('start') <= adjusted_stop) or
+                    (adjusted_start <= s.get('stop') <= adjusted_stop) or
+                    (s.get('start') <= adjusted_start <= s.get('stop'))):
+                # Like select, only the first session is checked
+                return s if s.matches(event) else None
+
+        return None
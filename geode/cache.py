@@ -0,0 +1,168 @@
+import geode.utils as utils
+from geode.event import SELECT_BUFFER
+
+import bisect
+import collections
+import copy
+import datetime
+
+
+class SessionCache:
+    """Keeps recently touched sessions from sediment in memory
+
+    Sessions are indexed by MAC and by IP, and each index entry is kept
+    sorted by start time, so that select can answer the same question as
+    select_mac_plan/select_ip_plan without going to Postgres. This only works
+    because geode is the only thing writing to sediment: every insert, update
+    and termination has to go through put so the cache stays in step.
+
+    The cache holds at most max_sessions sessions, evicting the least
+    recently used first, and drops sessions that stopped more than max_age
+    seconds before the newest session it has seen.
+    """
+
+    def __init__(self, max_sessions=100000, max_age=86400):
+        self.max_sessions = max_sessions
+        self.max_age = datetime.timedelta(seconds=max_age)
+
+        # Sessions by id, least recently used first
+        self.sessions = collections.OrderedDict()
+        # Sorted lists of (start, id) for each MAC and IP
+        self.macs = {}
+        self.ips = {}
+        self.newest = None
+
+        # Counters so that we can tune the size of the cache
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def select(self, event):
+        """Returns the cached session that Database.select would return for
+        the event, or None if the cache can't answer
+
+        None means that Postgres has to be asked, not that there is no
+        matching session. The session returned is a copy, so the caller is
+        free to change it.
+        """
+
+        if event.get('mac') is not None:
+            bucket = self.macs.get(utils.mac_key(event.get('mac')), [])
+        elif event.get('ip') is not None:
+            bucket = self.ips.get(event.get('ip'), [])
+        else:
+            bucket = []
+
+        adjusted_start = utils.time_diff(event.get('start'), SELECT_BUFFER)
+        adjusted_stop = utils.time_diff(event.get('stop'), SELECT_BUFFER)
+
+        # Nothing that starts after the window can overlap it. Of those that
+        # do, select orders by id, so the oldest session is the one it uses
+        end = bisect.bisect_right(bucket, (adjusted_stop, float('inf')))
+        first = None
+        for start, session_id in bucket[:end]:
+            s = self.sessions[session_id]
+            if ((adjusted_start <= s.get('start') <= adjusted_stop) or
+                    (adjusted_start <= s.get('stop') <= adjusted_stop) or
+                    (s.get('start') <= adjusted_start <= s.get('stop'))):
+                if first is None or session_id < first:
+                    first = session_id
+
+        # Like select, only the first session is checked
+        if first is not None and self.sessions[first].matches(event):
+            self.hits += 1
+            self._touch(first)
+            return _copy(self.sessions[first])
+
+        self.misses += 1
+        return None
+
+    def put(self, event, event_id=None):
+        """Stores (or replaces) a session, which must have an id"""
+
+        session_id = event_id if event_id is not None else event.get('id')
+        if session_id is None:
+            raise Exception("No id in given event")
+
+        # Take a copy so later changes to the caller's event don't leak into
+        # the cache
+        session = _copy(event)
+        session['id'] = session_id
+
+        self.discard(session_id)
+        self.sessions[session_id] = session
+        entry = (session.get('start'), session_id)
+        if session.get('mac') is not None:
+            key = utils.mac_key(session.get('mac'))
+            bisect.insort(self.macs.setdefault(key, []), entry)
+        if session.get('ip') is not None:
+            bisect.insort(self.ips.setdefault(session.get('ip'), []), entry)
+
+        if self.newest is None or session.get('stop') > self.newest:
+            self.newest = session.get('stop')
+
+        self._evict()
+
+    def discard(self, session_id):
+        """Removes a session from the cache, if it is there"""
+
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+
+        entry = (session.get('start'), session_id)
+        if session.get('mac') is not None:
+            _remove(self.macs, utils.mac_key(session.get('mac')), entry)
+        if session.get('ip') is not None:
+            _remove(self.ips, session.get('ip'), entry)
+
+    def stats(self):
+        """Returns the counters for the cache"""
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'sessions': len(self.sessions)}
+
+    def _touch(self, session_id):
+        """Marks a session as the most recently used"""
+        self.sessions[session_id] = self.sessions.pop(session_id)
+
+    def _evict(self):
+        """Evicts sessions until we are within the size and age limits"""
+
+        while len(self.sessions) > self.max_sessions:
+            self.discard(next(iter(self.sessions)))
+            self.evictions += 1
+
+        # Ingest moves forward in time, so the least recently used sessions
+        # are also the ones most likely to have aged out
+        horizon = self.newest - self.max_age
+        while self.sessions:
+            session_id = next(iter(self.sessions))
+            if self.sessions[session_id].get('stop') >= horizon:
+                break
+            self.discard(session_id)
+            self.evictions += 1
+
+
+def _copy(event):
+    """Copies an event; the values are immutable, so there is no need for a
+    deep copy"""
+    return copy.copy(event)
+
+
+def _remove(index, key, entry):
+    """Removes an entry from one of the sorted lists in an index"""
+
+    bucket = index.get(key)
+    if not bucket:
+        return
+    i = bisect.bisect_left(bucket, entry)
+    if i < len(bucket) and bucket[i] == entry:
+        del bucket[i]
+    if not bucket:
+        del index[key]
@@ -0,0 +1,89 @@
+from ConfigParser import SafeConfigParser as SCP
+import os
+import threading
+import time
+
+# Where geode's settings live unless told otherwise
+DEFAULT_PATH = "/etc/geode/settings.conf"
+
+
+class Config:
+    """The configuration file, parsed once and served from memory
+
+    The file is only parsed again when its modification time changes, and
+    that is checked at most once every check_interval seconds, so reading
+    settings in the ingest loop costs no file I/O. Writes go through set,
+    which keeps the parsed copy and the file in step.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+        self.parser = None
+        self.mtime = None
+        self.checked = 0
+
+    def get(self, section, tag, raw=False):
+        """Returns the value of a tag, like SafeConfigParser.get"""
+        return self._parser().get(section, tag, raw=raw)
+
+    def has(self, section, tag):
+        """Returns True if the section has the tag"""
+
+        parser = self._parser()
+        return parser.has_section(section) and parser.has_option(section, tag)
+
+    def items(self, section, raw=False):
+        """Returns the (tag, value) pairs in a section"""
+        return self._parser().items(section, raw=raw)
+
+    def set(self, section, tag, text):
+        """Sets the value of a tag and writes the file back out"""
+
+        with self.lock:
+            parser = self._parser(force_check=True)
+            parser.set(section, tag, text)
+            with open(self.path, 'wb') as c:
+                parser.write(c)
+            self.mtime = self._mtime()
+
+    def _parser(self, force_check=False):
+        """Returns the parsed file, parsing it again if it has changed"""
+
+        now = time.time()
+        if (self.parser is not None and not force_check and
+                now - self.checked < self.check_interval):
+            return self.parser
+
+        with self.lock:
+            mtime = self._mtime()
+            if self.parser is None or mtime != self.mtime:
+                parser = SCP()
+                parser.read(self.path)
+                self.parser = parser
+                self.mtime = mtime
+            self.checked = now
+            return self.parser
+
+    def _mtime(self):
+        """Returns the modification time of the file, or None if it's gone"""
+
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+
+# The configuration for each path, shared by everything in the process
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def get_config(path=DEFAULT_PATH):
+    """Returns the shared Config for a path"""
+
+    with _configs_lock:
+        if path not in _configs:
+            _configs[path] = Config(path)
+        return _configs[path]
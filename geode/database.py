@@ -1,5 +1,7 @@
 import geode.utils as utils
-from geode.event import Event
+from geode.cache import SessionCache
+from geode.event import Event, SELECT_BUFFER
+import geode.metrics as metrics
 
 import datetime
 import logging
@@ -7,17 +9,237 @@ import psycopg2
 from psycopg2.extensions import AsIs
 from psycopg2.extras import RealDictCursor
 
+# The table that geode correlates into. It isn't created here, since it is
+# normally set up along with the rest of the database, but new databases
+# (for development or benchmarking, say) can be set up with this
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sediment(
+    id bigserial PRIMARY KEY,
+    mac macaddr,
+    ip inet,
+    netid text,
+    hostname text,
+    start timestamp NOT NULL,
+    stop timestamp NOT NULL,
+    useragent text,
+    os text,
+    event_type smallint[]);
+CREATE INDEX IF NOT EXISTS sediment_mac_idx ON sediment(mac, start, stop);
+CREATE INDEX IF NOT EXISTS sediment_ip_idx ON sediment(ip, start, stop);
+"""
+
+# The range schema: the period that a session covers, as a tsrange, with
+# GiST indexes so that overlap lookups are served by && rather than by
+# three ORed comparisons that a b-tree can't help with much. The period is
+# an expression rather than a column, so existing tables don't have to be
+# rewritten (see geode.migrate). Terminated sessions can end before they
+# start, so the period runs between whichever of start and stop comes first
+PERIOD_FUNCTION = """
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+CREATE OR REPLACE FUNCTION sediment_period(start timestamp, stop timestamp)
+RETURNS tsrange AS $$
+    SELECT tsrange(least(start, stop), greatest(start, stop), '[]');
+$$ LANGUAGE sql IMMUTABLE;
+"""
+# {0} is where CONCURRENTLY goes when building them on a live table
+PERIOD_INDEXES = [
+    """CREATE INDEX {0} IF NOT EXISTS sediment_mac_period_idx
+       ON sediment USING gist (mac, sediment_period(start, stop));""",
+    """CREATE INDEX {0} IF NOT EXISTS sediment_ip_period_idx
+       ON sediment USING gist (ip, sediment_period(start, stop));"""]
+RANGE_SCHEMA = PERIOD_FUNCTION + "\n".join(i.format("")
+                                           for i in PERIOD_INDEXES)
+
+# The correlation that process_results does (see geode.main), done inside
+# Postgres for a whole batch of events at once. It follows the Python
+# semantics exactly, including their quirks:
+# - only the first (lowest id) session that select would find is looked at,
+#   and it is only used if it matches the event (Database.select)
+# - MACs are matched in the database as macaddr, but compared as the text
+#   that we were given (Event.matches)
+# - Event._does_overlap isn't symmetric, so the session has to overlap the
+#   event and the event has to overlap the session for the two to merge;
+#   when only the first holds, the session is terminated
+# Sessions are locked as they are looked up, like Database.select does for a
+# writer that isn't alone, so other writers wait rather than being undone.
+# Event types are passed in and out as bitmasks, like Event keeps them.
+# Returns what happened to each event: 'merged' or 'inserted', along with
+# the id of the session, and 'terminated' for each session that was cut off.
+# {0} is the overlap condition of the lookup, CORRELATE_OVERLAP or with the
+# range schema CORRELATE_RANGE_OVERLAP, like Database.select's
+CORRELATE_LOCK = 0x67656f64
+CORRELATE_OVERLAP = """(
+                (adjusted_start <= x.start AND x.start <= adjusted_stop) OR
+                (adjusted_start <= x.stop AND x.stop <= adjusted_stop) OR
+                (x.start <= adjusted_start AND adjusted_start <= x.stop))"""
+CORRELATE_RANGE_OVERLAP = ("""sediment_period(x.start, x.stop) &&
+                sediment_period(adjusted_start, adjusted_stop) AND """ +
+                           CORRELATE_OVERLAP)
+CORRELATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION geode_differ(a text, b text) RETURNS boolean AS $$
+    SELECT a IS NOT NULL AND a <> '' AND b IS NOT NULL AND b <> ''
+           AND a <> b;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION geode_overlaps(s timestamp, t timestamp,
+                                          a timestamp, b timestamp)
+RETURNS boolean AS $$
+    SELECT (s <= a AND a <= t AND t >= b AND b >= s)
+        OR (s >= a AND t >= b AND b >= a)
+        OR (s <= a AND a <= t AND t <= b)
+        OR (s >= a AND t <= b);
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION geode_mask(types smallint[]) RETURNS integer AS $$
+    SELECT coalesce(bit_or(1 << t), 0)::integer FROM unnest(types) AS t;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION geode_types(mask integer) RETURNS smallint[] AS $$
+    SELECT CASE WHEN mask = 0 THEN NULL ELSE
+        ARRAY(SELECT t::smallint FROM generate_series(0, 30) AS t
+              WHERE mask & (1 << t) <> 0) END;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION geode_correlate(
+    macs text[], ips text[], netids text[], hostnames text[],
+    starts timestamp[], stops timestamp[], useragents text[], oss text[],
+    masks integer[])
+RETURNS TABLE(action text, session_id bigint) AS $$
+DECLARE
+    s sediment%ROWTYPE;
+    e_start timestamp;
+    e_stop timestamp;
+    adjusted_start timestamp;
+    adjusted_stop timestamp;
+BEGIN
+    -- Lock every session that the batch could touch before touching any, in
+    -- order of id, so that batches written at the same time can't deadlock
+    PERFORM 1 FROM sediment AS x
+    WHERE (x.mac = ANY(macs::macaddr[]) OR x.ip = ANY(ips::inet[]))
+      AND least(x.start, x.stop) <=
+          (SELECT max(t) FROM unnest(stops) AS t) + interval '30 seconds'
+      AND greatest(x.start, x.stop) >=
+          (SELECT min(t) FROM unnest(starts) AS t) + interval '30 seconds'
+    ORDER BY x.id FOR UPDATE;
+
+    FOR i IN 1 .. coalesce(array_length(starts, 1), 0) LOOP
+        e_start := starts[i];
+        e_stop := stops[i];
+        adjusted_start := e_start + interval '30 seconds';
+        adjusted_stop := e_stop + interval '30 seconds';
+
+        -- Database.select
+        IF macs[i] IS NOT NULL THEN
+            SELECT * INTO s FROM sediment AS x
+            WHERE x.mac = macs[i]::macaddr AND {0}
+            ORDER BY x.id LIMIT 1 FOR UPDATE;
+        ELSIF ips[i] IS NOT NULL THEN
+            SELECT * INTO s FROM sediment AS x
+            WHERE x.ip = ips[i]::inet AND {0}
+            ORDER BY x.id LIMIT 1 FOR UPDATE;
+        ELSE
+            RAISE EXCEPTION 'Not enough data to select upon: Mac/IP required';
+        END IF;
+
+        -- The session is only used if it matches the event
+        IF FOUND AND NOT (
+                geode_differ(s.mac::text, macs[i]) OR
+                geode_differ(abbrev(s.ip), ips[i]) OR
+                geode_differ(s.netid, netids[i]) OR
+                geode_differ(s.hostname, hostnames[i])) AND
+                geode_overlaps(s.start, s.stop, e_start, e_stop) THEN
+
+            -- And the event matches it, so merge the two
+            IF geode_overlaps(e_start, e_stop, s.start, s.stop) THEN
+                UPDATE sediment SET
+                    mac = coalesce(macs[i]::macaddr, s.mac),
+                    ip = coalesce(ips[i]::inet, s.ip),
+                    netid = coalesce(netids[i], nullif(s.netid, '')),
+                    hostname = coalesce(hostnames[i], nullif(s.hostname, '')),
+                    start = least(s.start, e_start),
+                    stop = greatest(s.stop, e_stop),
+                    useragent = coalesce(useragents[i],
+                                         nullif(s.useragent, '')),
+                    os = coalesce(oss[i], nullif(s.os, '')),
+                    event_type = geode_types(geode_mask(s.event_type) |
+                                             masks[i])
+                WHERE id = s.id;
+                action := 'merged';
+                session_id := s.id;
+                RETURN NEXT;
+                CONTINUE;
+            END IF;
+
+            -- Otherwise terminate the session where the event starts
+            UPDATE sediment SET
+                netid = nullif(s.netid, ''),
+                hostname = nullif(s.hostname, ''),
+                stop = e_start,
+                useragent = nullif(s.useragent, ''),
+                os = nullif(s.os, ''),
+                event_type = geode_types(geode_mask(s.event_type))
+            WHERE id = s.id;
+            action := 'terminated';
+            session_id := s.id;
+            RETURN NEXT;
+        END IF;
+
+        INSERT INTO sediment(mac, ip, netid, hostname, start, stop,
+                             useragent, os, event_type)
+        VALUES (macs[i]::macaddr, ips[i]::inet, netids[i], hostnames[i],
+                e_start, e_stop, useragents[i], oss[i],
+                geode_types(masks[i]))
+        RETURNING id INTO session_id;
+        action := 'inserted';
+        RETURN NEXT;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def connect(config_file='/etc/geode/settings.conf'):
+    """Connect to the database in the config file and return the connection
+    and cursor"""
+
+    section = "database"
+    path = config_file
+    username = utils.read_config(section, "username", path=path)
+    password = utils.read_config(section, "password", raw=True, path=path)
+    host = utils.read_config(section, "host", path=path)
+    database = utils.read_config(section, "database", path=path)
+
+    try:
+        conn = psycopg2.connect(user=username,
+                                password=password,
+                                host=host,
+                                database=database,
+                                cursor_factory=RealDictCursor)
+
+        return conn, conn.cursor()
+    except Exception as e:
+        logging.exception('Postgres connection failure: {0}'.format(str(e)))
+        raise e
+
 
 class Database:
     """All of the functionality for interacting with the backend database"""
 
     def __init__(self,
                  config_file='/etc/geode/settings.conf',
-                 log_file='/var/log/geode/geode.log'):
-        """Create a new connection to the database"""
+                 log_file='/var/log/geode/geode.log',
+                 cache=True):
+        """Create a new connection to the database
+
+        Unset cache to keep the session cache off whatever the config says,
+        for when something else is writing the same sessions. That, like
+        more than one shard or worker in the config, also makes the lookups
+        that correlation writes back lock their sessions (see select)
+        """
 
         # Turn on logging
         logging.basicConfig(filename=log_file, level=logging.INFO)
+        self.config_file = config_file
 
         # Connect to the database
         self.database, self.cursor = self._connect()
@@ -25,6 +247,73 @@ class Database:
         # Turn on autocommit because it's nice to have
         self.database.autocommit = True
 
+        # Keep recently touched sessions in memory if we were asked to
+        self.cache = None
+        cache_size = int(utils.read_config("Geode", "cache_size", default=0,
+                                           path=config_file))
+        # The cache is only right if every write to sediment goes through
+        # it, which isn't so once shards or scheduler workers each have a
+        # Database of their own writing the same sessions
+        shards = int(utils.read_config("Geode", "shards", default=0,
+                                       path=config_file))
+        workers = int(utils.read_config("Concurrency", "workers", default=1,
+                                        path=config_file))
+        # With other writers, sessions are locked between being looked up
+        # and written, so that one writer's merge can't overwrite another's
+        self.shared = not cache or shards > 1 or workers > 1
+        # How deep we are in transaction blocks
+        self.depth = 0
+        if cache_size > 0 and (shards > 1 or workers > 1):
+            logging.warning("Not using the session cache, since there are "
+                            "{0} shards and {1} workers writing "
+                            "sediment".format(shards, workers))
+            cache = False
+        if cache and cache_size > 0:
+            max_age = int(utils.read_config("Geode", "cache_max_age",
+                                            default=86400, path=config_file))
+            self.cache = SessionCache(cache_size, max_age)
+
+        # Whether batches are correlated by Batch (python) or by
+        # geode_correlate inside Postgres (server)
+        self.server_correlate = utils.read_config(
+            "Geode", "correlate", default="python",
+            path=config_file) == "server"
+
+        # Whether sessions are looked up with the range schema's indexes
+        # (range) or with plain comparisons on start and stop (plain)
+        self.range_schema = utils.read_config(
+            "Geode", "schema", default="plain",
+            path=config_file) == "range"
+
+        # The sessions that overlap $2 to $3. The range schema narrows them
+        # down with its index first; the comparisons still decide, since
+        # they're what the rest of geode expects. Events can stop before
+        # they start too, so the range is built like the sessions' are
+        overlap = """(($2 <= start AND start <=$3) OR
+                      ($2 <= stop AND stop <= $3) OR
+                      (start <= $2 AND $2 <= stop))"""
+        if self.range_schema:
+            overlap = ("""sediment_period(start, stop) &&
+                          sediment_period($2, $3) AND """ + overlap)
+
+        # Progress through each search is kept with the data, so that it can
+        # be committed in the same transaction as the events it covers
+        self.cursor.execute(
+            """CREATE TABLE IF NOT EXISTS checkpoint(
+                   search text PRIMARY KEY,
+                   earliest_time timestamp NOT NULL);""")
+
+        # Every worker connects at once, and replacing a function that
+        # someone else is replacing at the same time fails, so take turns
+        if self.server_correlate:
+            self.cursor.execute("BEGIN;")
+            self.cursor.execute("SELECT pg_advisory_xact_lock(%s);",
+                                (CORRELATE_LOCK, ))
+            self.cursor.execute(CORRELATE_FUNCTION.format(
+                CORRELATE_RANGE_OVERLAP if self.range_schema
+                else CORRELATE_OVERLAP))
+            self.cursor.execute("COMMIT;")
+
         # Create our prepared statements
         self.cursor.execute(
             """PREPARE insert_plan(macaddr, inet, text, text, timestamp,
@@ -32,18 +321,19 @@ class Database:
              AS
              INSERT INTO sediment(mac, ip, netid, hostname, start,
                                        stop, useragent, os, event_type)
-             VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9);""")
+             VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9)
+             RETURNING id;""")
 
         self.cursor.execute("""PREPARE select_id_plan(bigint) AS
                                SELECT * FROM sediment WHERE id=$1;""")
 
+        # Only the first session is used, so make it the oldest rather than
+        # whichever the planner happens to find first
         self.cursor.execute(
             """PREPARE select_mac_plan(macaddr, timestamp, timestamp)
                AS SELECT * FROM sediment
-               WHERE mac=$1 AND (
-                   ($2 <= start AND start <=$3) OR
-                   ($2 <= stop AND stop <= $3) OR
-                   (start <= $2 AND $2 <= stop));""")
+               WHERE mac=$1 AND {0}
+               ORDER BY id;""".format(overlap))
 
         self.cursor.execute(
             """PREPARE update_plan (macaddr, inet, text, text, timestamp,
@@ -53,35 +343,35 @@ class Database:
                                            useragent=$7, os=$8, event_type=$9
                WHERE id=$10;""")
 
+        self.cursor.execute(
+            """PREPARE checkpoint_plan(text, timestamp)
+               AS INSERT INTO checkpoint(search, earliest_time)
+               VALUES($1, $2)
+               ON CONFLICT (search) DO UPDATE
+               SET earliest_time = EXCLUDED.earliest_time;""")
+
         self.cursor.execute(
             """PREPARE select_ip_plan(inet, timestamp, timestamp)
                AS SELECT * FROM sediment
-               WHERE ip=$1 AND (
-                   ($2 <= start AND start <=$3) OR
-                   ($2 <= stop AND stop <= $3) OR
-                   (start <= $2 AND $2 <= stop));""")
+               WHERE ip=$1 AND {0}
+               ORDER BY id;""".format(overlap))
+
+        # The same, for a writer that isn't alone: only the first session is
+        # used, so only it is locked until the transaction ends
+        if self.shared:
+            for key, kind in (("mac", "macaddr"), ("ip", "inet")):
+                self.cursor.execute(
+                    """PREPARE select_{0}_lock_plan({1}, timestamp, timestamp)
+                       AS SELECT * FROM sediment
+                       WHERE {0}=$1 AND {2}
+                       ORDER BY id LIMIT 1 FOR UPDATE;""".format(key, kind,
+                                                                 overlap))
 
     def _connect(self):
         """Connect to the database and return the connection and cursor"""
+        return connect(self.config_file)
 
-        section = "database"
-        username = utils.read_config(section, "username")
-        password = utils.read_config(section, "password", raw=True)
-        host = utils.read_config(section, "host")
-        database = utils.read_config(section, "database")
-
-        try:
-            conn = psycopg2.connect(user=username,
-                                    password=password,
-                                    host=host,
-                                    database=database,
-                                    cursor_factory=RealDictCursor)
-
-            return conn, conn.cursor()
-        except Exception as e:
-            logging.exception('Postgres connection failure: {0}'.format(str(e)))
-            raise e
-
+    @metrics.stage("write")
     def insert(self, event):
         """Inserts a new event into the database
 
@@ -92,41 +382,24 @@ class Database:
         if not 'start' and 'stop' in event.keys():
             raise Exception("No start or stop time for event")
 
-        # We will replace the strings in the event_type with the corresponding
-        # ints, but we want them to stay strings in the object itself, so we
-        # just replace them later on when we're done
-        tmp = None
-
-        # Convert the event_type strings into their corresponding ints
-        if event.get('event_type'):
-            tmp = [Event.types.get(x) for x in event.get('event_type')]
-        # The values to be inserted into the database
-        values = tuple([event[key] if type(event[key]) is not datetime.datetime
-                       else utils.dto_to_string(event[key])
-                       for key in event.keys()])
-
         # Query to be executed
-        #TODO: Oh man, this is so janky
         query = """EXECUTE insert_plan(%s, %s, %s, %s, %s, %s, %s, %s, %s);"""
-        data = [
-                event.get('mac'),
-                event.get('ip'),
-                event.get('netid'),
-                event.get('hostname'),
-                utils.dto_to_string(event.get('start')),
-                utils.dto_to_string(event.get('stop')),
-                event.get('useragent'),
-                event.get('os'),
-                tmp  # The event type list
-               ]
-
-        # TODO: Do conversion between event text and event number
-        self.cursor.execute(query, data)
+        self.cursor.execute(query, self._values(event))
+
+        if self.cache is not None:
+            self.cache.put(event, self.cursor.fetchone()['id'])
 
         return True
 
-    def select(self, event):
-        """Selects the data from the database that matches the event"""
+    @metrics.stage("select")
+    def select(self, event, lock=False):
+        """Selects the data from the database that matches the event
+
+        With lock set and other writers about (see shared), the session is
+        locked until the end of the transaction, which the caller should
+        have begun (see transaction) so that it can write the session back
+        before anyone else does
+        """
 
         # If we have an ID, then let's select based on that
         if event.get('id') is not None:
@@ -151,23 +424,35 @@ class Database:
         if not fields:
             raise Exception("Not enough data to select upon: Mac/IP required")
 
-        # Give us a 30 second buffer for start and stop
+        lock = lock and self.shared
+
+        # Most of the time the session was touched seconds ago, so see if the
+        # cache can answer before going to Postgres
+        if self.cache is not None and not lock:
+            cached = self.cache.select(event)
+            if cached is not None:
+                return cached
+
+        # Give us a buffer for start and stop
         if type(event.get('start')) is str:
-            adjusted_start = utils.time_diff_string(event.get('start'), 30)
+            adjusted_start = utils.time_diff_string(event.get('start'),
+                                                    SELECT_BUFFER)
         else:
-            adjusted_start = utils.time_diff(event.get('start'), 30)
+            adjusted_start = utils.time_diff(event.get('start'), SELECT_BUFFER)
         if type(event.get('stop')) is str:
-            adjusted_stop = utils.time_diff_string(event.get('stop'), 30)
+            adjusted_stop = utils.time_diff_string(event.get('stop'),
+                                                   SELECT_BUFFER)
         else:
-            adjusted_stop = utils.time_diff(event.get('stop'), 30)
+            adjusted_stop = utils.time_diff(event.get('stop'), SELECT_BUFFER)
 
         # If we have an MAC address and an IP address, check either
+        plan = "lock_plan" if lock else "plan"
         if "mac" in fields:
-            sql = """EXECUTE select_mac_plan(%s, %s, %s);"""
+            sql = """EXECUTE select_mac_{0}(%s, %s, %s);""".format(plan)
             data = (values[0], adjusted_start, adjusted_stop)
         # Otherwise we have an IP
         else:
-            sql = """EXECUTE select_ip_plan(%s, %s, %s);"""
+            sql = """EXECUTE select_ip_{0}(%s, %s, %s);""".format(plan)
             data = (values[0], adjusted_start, adjusted_stop)
 
         self.cursor.execute(sql, data)
@@ -179,8 +464,269 @@ class Database:
 
         # TODO: For now, we are only checking the first event, is this okay?
         e = Event(results[0])
-        return Event(results[0]) if e.matches(event) else None
+        if self.cache is not None:
+            self.cache.put(e)
+        return e if e.matches(event) else None
+
+    @metrics.stage("select")
+    def select_many(self, events):
+        """Selects every session that could match any of the events
+
+        This is the batched version of select: instead of one query per event
+        it does a single query for all of the MACs and IPs in the batch, over
+        the full time span of the batch (with the same buffer that select
+        uses). The caller is expected to narrow the results down to the
+        session for each event, see geode.batch.correlate
+
+        With other writers about (see shared), the sessions are locked until
+        the end of the transaction, in order of id so that two batches can't
+        deadlock, and the cache isn't used
 
+        Returns a list of events ordered by id
+        """
+
+        macs = set()
+        ips = set()
+        adjusted_start = None
+        adjusted_stop = None
+        cached = {}
+
+        for event in events:
+            # Events that the cache can answer don't need to be queried
+            if self.cache is not None and not self.shared:
+                session = self.cache.select(event)
+                if session is not None:
+                    cached[session.get('id')] = session
+                    continue
+
+            # Mirror select: if we have a MAC we look up by MAC, otherwise IP
+            if event.get('mac') is not None:
+                macs.add(event.get('mac'))
+            elif event.get('ip') is not None:
+                ips.add(event.get('ip'))
+            else:
+                raise Exception("Not enough data to select upon: "
+                                "Mac/IP required")
+
+            start = utils.time_diff(event.get('start'), SELECT_BUFFER)
+            stop = utils.time_diff(event.get('stop'), SELECT_BUFFER)
+            if adjusted_start is None or start < adjusted_start:
+                adjusted_start = start
+            if adjusted_stop is None or stop > adjusted_stop:
+                adjusted_stop = stop
+
+        if adjusted_start is None:
+            return sorted(cached.values(), key=lambda e: e.get('id'))
+
+        # Anything that overlaps a single event's window also overlaps the
+        # window of the whole batch, so this is a superset of what select
+        # would have found for each of the events
+        if self.range_schema:
+            sql = """SELECT * FROM sediment
+                     WHERE (mac = ANY(%s::macaddr[]) OR ip = ANY(%s::inet[]))
+                       AND sediment_period(start, stop) &&
+                           sediment_period(%s::timestamp, %s::timestamp)
+                     ORDER BY id{0};"""
+            data = (list(macs), list(ips),
+                    utils.dto_to_string(adjusted_start),
+                    utils.dto_to_string(adjusted_stop))
+        else:
+            sql = """SELECT * FROM sediment
+                     WHERE (mac = ANY(%s::macaddr[]) OR ip = ANY(%s::inet[]))
+                       AND start <= %s AND stop >= %s
+                     ORDER BY id{0};"""
+            data = (list(macs), list(ips),
+                    utils.dto_to_string(adjusted_stop),
+                    utils.dto_to_string(adjusted_start))
+        self.cursor.execute(sql.format(" FOR UPDATE" if self.shared else ""),
+                            data)
+
+        sessions = dict(cached)
+        for r in self.cursor.fetchall():
+            e = Event(r)
+            sessions[e.get('id')] = e
+            if self.cache is not None:
+                self.cache.put(e)
+
+        return sorted(sessions.values(), key=lambda e: e.get('id'))
+
+    @metrics.stage("write")
+    def write_many(self, inserts, updates, checkpoint=None):
+        """Writes a batch of new and changed events in a single transaction
+
+        inserts is a list of new events, and updates is a dict mapping the id
+        of a row to the event that should replace it. Each of the two is sent
+        as one multi-row statement. checkpoint is an optional (search, time)
+        pair that is committed along with the events.
+
+        Returns True on success
+        """
+
+        insert_row = """(%s::macaddr, %s::inet, %s::text, %s::text,
+                         %s::timestamp, %s::timestamp, %s::text, %s::text,
+                         %s::smallint[])"""
+        update_row = """(%s::bigint, %s::macaddr, %s::inet, %s::text,
+                         %s::text, %s::timestamp, %s::timestamp, %s::text,
+                         %s::text, %s::smallint[])"""
+
+        try:
+            self._begin()
+            if inserts:
+                rows = ",".join([self.cursor.mogrify(insert_row,
+                                                     self._values(e))
+                                 for e in inserts])
+                self.cursor.execute(
+                    """INSERT INTO sediment(mac, ip, netid, hostname, start,
+                                            stop, useragent, os, event_type)
+                       VALUES %s RETURNING id;""" % rows)
+                # Postgres returns the ids in the order of the VALUES list
+                ids = [r['id'] for r in self.cursor.fetchall()]
+
+            if updates:
+                rows = ",".join([self.cursor.mogrify(update_row,
+                                                     [i] + self._values(e))
+                                 for i, e in updates.items()])
+                self.cursor.execute(
+                    """UPDATE sediment AS s
+                       SET mac=v.mac, ip=v.ip, netid=v.netid,
+                           hostname=v.hostname, start=v.start, stop=v.stop,
+                           useragent=v.useragent, os=v.os,
+                           event_type=v.event_type
+                       FROM (VALUES %s) AS v(id, mac, ip, netid, hostname,
+                                             start, stop, useragent, os,
+                                             event_type)
+                       WHERE s.id = v.id;""" % rows)
+
+            if checkpoint is not None:
+                self.set_checkpoint(*checkpoint)
+
+            self._end(True)
+        except Exception:
+            self._end(False)
+            # We don't know what made it in, so don't trust the cache
+            if self.cache is not None:
+                for i in updates:
+                    self.cache.discard(i)
+            raise
+
+        if self.cache is not None:
+            for i, e in updates.items():
+                self.cache.put(e, i)
+            if inserts:
+                for i, e in zip(ids, inserts):
+                    self.cache.put(e, i)
+
+        return True
+
+    @metrics.stage("write")
+    def correlate_many(self, events, checkpoint=None):
+        """Correlates and writes a batch of events inside Postgres (see
+        CORRELATE_FUNCTION), in a single transaction
+
+        This does what select_many, geode.batch.correlate and write_many do
+        together, in one round trip. checkpoint is an optional (search, time)
+        pair that is committed along with the events.
+
+        Returns a list of (action, id) pairs, see CORRELATE_FUNCTION
+        """
+
+        columns = ([e.mac for e in events],
+                   [e.ip for e in events],
+                   [e.netid for e in events],
+                   [e.hostname for e in events],
+                   [e.start for e in events],
+                   [e.stop for e in events],
+                   [e.useragent for e in events],
+                   [e.os for e in events],
+                   [e.mask for e in events])
+
+        try:
+            self._begin()
+            self.cursor.execute(
+                """SELECT action, session_id FROM geode_correlate(
+                       %s::text[], %s::text[], %s::text[], %s::text[],
+                       %s::timestamp[], %s::timestamp[], %s::text[],
+                       %s::text[], %s::integer[]);""", columns)
+            actions = [(r['action'], r['session_id'])
+                       for r in self.cursor.fetchall()]
+
+            if checkpoint is not None:
+                self.set_checkpoint(*checkpoint)
+
+            self._end(True)
+        except Exception:
+            self._end(False)
+            raise
+
+        # The sessions were changed behind the cache's back, so it has to
+        # forget them
+        if self.cache is not None:
+            for action, i in actions:
+                self.cache.discard(i)
+
+        return actions
+
+    def transaction(self):
+        """Returns a context manager that runs what is inside it in one
+        transaction, or in the one that is already open"""
+        return _Transaction(self)
+
+    def _begin(self):
+        """Begins a transaction, unless one is already open"""
+
+        if self.depth == 0:
+            self.cursor.execute("BEGIN;")
+        self.depth += 1
+
+    def _end(self, commit):
+        """Ends what _begin began: the transaction is committed (or rolled
+        back) once the outermost block ends. A failure inside rolls back the
+        lot, since the outer block sees the exception too"""
+
+        self.depth -= 1
+        if self.depth == 0:
+            self.cursor.execute("COMMIT;" if commit else "ROLLBACK;")
+
+    def get_checkpoint(self, search):
+        """Returns the time that the search has been processed up to, or None
+        if we have never processed it"""
+
+        self.cursor.execute("""SELECT earliest_time FROM checkpoint
+                               WHERE search=%s;""", (search, ))
+        row = self.cursor.fetchone()
+
+        return row['earliest_time'] if row is not None else None
+
+    @metrics.stage("write")
+    def set_checkpoint(self, search, time):
+        """Records that the search has been processed up to the given time
+
+        Returns True on success
+        """
+
+        if type(time) is datetime.datetime:
+            time = utils.dto_to_string(time)
+        self.cursor.execute("""EXECUTE checkpoint_plan(%s, %s);""",
+                            (search, time))
+
+        return True
+
+    def _values(self, event):
+        """Returns the column values for an event, in the order that the
+        insert and update plans expect them"""
+
+        return [event.mac,
+                event.ip,
+                event.netid,
+                event.hostname,
+                utils.dto_to_string(event.start),
+                utils.dto_to_string(event.stop),
+                event.useragent,
+                event.os,
+                # The event type ids, straight from the bitmask
+                event.type_ids() or None]
+
+    @metrics.stage("write")
     def update(self, event, event_id):
         """Updates the SQL event with the given ID to contain the event values
 
@@ -198,19 +744,10 @@ class Database:
         # Query to be executed
         query = """EXECUTE update_plan(%s, %s, %s, %s, %s,
                                        %s, %s, %s, %s, %s);"""
-        tmp = [Event.types.get(x) for x in event.get('event_type')]
-
-        data = [event.get('mac'),
-                event.get('ip'),
-                event.get('netid'),
-                event.get('hostname'),
-                utils.dto_to_string(event.get('start')),
-                utils.dto_to_string(event.get('stop')),
-                event.get('useragent'),
-                event.get('os'),
-                tmp,
-                event_id]
-        self.cursor.execute(query, data)
+        self.cursor.execute(query, self._values(event) + [event_id])
+
+        if self.cache is not None:
+            self.cache.put(event, event_id)
 
         return True
 
@@ -232,3 +769,18 @@ class Database:
         self.update(event, event_id)
 
         return True
+
+
+class _Transaction(object):
+    """A block of Database statements that commit or roll back together"""
+
+    def __init__(self, database):
+        self.database = database
+
+    def __enter__(self):
+        self.database._begin()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.database._end(kind is None)
+        return False
@@ -0,0 +1,129 @@
+from geode.reader import FIELDS
+import geode.utils as utils
+
+import collections
+
+
+class DedupFilter:
+    """Remembers the events that a search has given us recently, so that
+    exact repeats can be dropped before they cost a select and an update
+
+    Splunk gives us the same events more than once when a window is searched
+    again from its last start, and dedup in a search only works within one
+    job. Results are compared on the fields in reader.FIELDS. Results come
+    in order of start, so an event is only remembered until the search is
+    window seconds past its start, and no more than max_events are
+    remembered at once, oldest first to go.
+
+    An event that has passed is only pending until commit says that the
+    database has everything before its start. If writing fails, rollback
+    forgets the pending events, so that they get through when the window is
+    fetched again rather than being taken for repeats of themselves.
+    """
+
+    def __init__(self, window=60, max_events=100000):
+        self.window = window
+        self.max_events = max_events
+
+        # The events in the database and the events on their way there,
+        # oldest first, with their starts
+        self.seen = collections.OrderedDict()
+        self.pending = collections.OrderedDict()
+        self.newest = None
+        self.horizon = None
+
+        # Counters so that we can see what it saves
+        self.passed = 0
+        self.suppressed = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.seen) + len(self.pending)
+
+    def check(self, result):
+        """Returns False if the result (a dict from Splunk) is a repeat of
+        one seen within the window, otherwise remembers it as pending and
+        returns True"""
+
+        start = result.get('start')
+        if start is None:
+            self.passed += 1
+            return True
+        if not isinstance(start, str):
+            start = utils.dto_to_string(start)
+
+        key = _key(result)
+        if key in self.seen or key in self.pending:
+            self.suppressed += 1
+            return False
+
+        self.pending[key] = start
+        self.passed += 1
+        # The times are all in the same format, so they compare as strings
+        if self.newest is None or start > self.newest:
+            self.newest = start
+            self.horizon = utils.time_diff_string(start, -self.window)
+        self._expire()
+        return True
+
+    def commit(self, time):
+        """Records that the database has every event that started before
+        time (a datetime). Events at time itself may still be on their way
+        (in a batch, say), so they stay pending"""
+
+        time = utils.dto_to_string(time)
+        while self.pending:
+            key = next(iter(self.pending))
+            if self.pending[key] >= time:
+                break
+            self.seen[key] = self.pending.pop(key)
+        self._expire()
+
+    def rollback(self):
+        """Forgets the pending events, after writing them failed"""
+
+        self.pending.clear()
+
+    def stats(self):
+        """Returns the counters for the filter"""
+
+        return {'passed': self.passed,
+                'suppressed': self.suppressed,
+                'expired': self.expired,
+                'events': len(self)}
+
+    def _expire(self):
+        """Forgets events until we are within the size and time limits.
+        Forgetting a pending event only means that a repeat of it is
+        written again"""
+
+        while len(self) > self.max_events:
+            if self.seen:
+                self.seen.popitem(last=False)
+            else:
+                self.pending.popitem(last=False)
+            self.expired += 1
+
+        # Results come in order of start, so the oldest are at the front
+        for events in (self.seen, self.pending):
+            while events:
+                key = next(iter(events))
+                if events[key] >= self.horizon:
+                    break
+                del events[key]
+                self.expired += 1
+
+
+def _key(result):
+    """Returns something hashable that is the same for exact repeats
+
+    Only the fields that we store count: Splunk adds its own (_serial, _cd,
+    _indextime and the like) that differ from one job to the next for the
+    same event
+    """
+
+    key = []
+    for field in FIELDS:
+        value = result.get(field)
+        key.append(tuple(value) if isinstance(value, list) else value)
+    return tuple(key)
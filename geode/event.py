@@ -1,13 +1,41 @@
+import geode.utils as utils
+
 import datetime
 import copy
 
 # The default duration for an event (in seconds)
 DEFAULT_DURATION = 30
 
+# The buffer (in seconds) added to the start and stop of an event when
+# looking for a session in the database that overlaps it
+SELECT_BUFFER = 30
+
+# Values of these types can't be changed, so events can share them with
+# the dicts (and other events) they came from instead of copying them
+_IMMUTABLE = (str, unicode, int, long, float, bool, datetime.datetime,
+              datetime.date, datetime.timedelta, tuple, frozenset)
+
+
+def _own(value):
+    """Returns value if it can be shared safely, or a copy of it if it could
+    be changed underneath us (a list or a dict, say)"""
+
+    if value is None or isinstance(value, _IMMUTABLE):
+        return value
+    return copy.deepcopy(value)
 
-class Event(dict):
+
+class Event(object):
     """This class is used to deal with events from Splunk and Postgres
-    It provides an easy way to do comparison, combining, etc."""
+    It provides an easy way to do comparison, combining, etc.
+
+    Millions of these get created, so an event keeps its fields in slots
+    rather than a dict, and its event types as a bitmask (bit n set for the
+    type with id n in types). It still looks like a dict to callers: the
+    event types come back as a set of strings from get('event_type'), keys
+    that aren't fields are kept in extra, and a value of None is the same
+    as the key not being there at all.
+    """
 
     # This dictionary is used for doing lookups between strings and ints
     # to convert Splunk event types into ints stored in the database
@@ -41,97 +69,117 @@ class Event(dict):
                      11: 'NetApp:Audit'
                     }
 
+    # The fixed fields of an event, in the order of the sediment columns
+    fields = ('id', 'mac', 'ip', 'netid', 'hostname', 'start', 'stop',
+              'useragent', 'os')
+
+    # The fields that have to agree for two events to match. Everything that
+    # isn't a field has to agree as well
+    match_fields = ('mac', 'ip', 'netid', 'hostname')
+
+    __slots__ = fields + ('mask', 'extra')
+
+    # For quick lookups of the above
+    _slots = frozenset(fields)
+    _type_ids = sorted(types_reverse.keys())
+
     def __init__(self, d):
-        """Constructor; takes in a dict and copies the values to this object"""
+        """Constructor; takes in a dict (or event) and copies the values to
+        this object"""
 
         # Make sure that we have a start time for every event
         if d.get('start') is None:
             raise Exception("No start time")
 
+        self.id = None
+        self.mac = None
+        self.ip = None
+        self.netid = None
+        self.hostname = None
+        self.start = None
+        self.stop = None
+        self.useragent = None
+        self.os = None
+        self.mask = 0
+        self.extra = None
+
         # Copy the values for d into this event
-        for k in d.keys():
+        for k, v in d.items():
             # Convert the start and stop times to be datetime objects if they
             # are strings
-            if (k == 'start' or k == 'stop') and (type(d[k]) == str):
-                self[k] = datetime.datetime.strptime(d[k], '%Y-%m-%dT%H:%M:%S')
+            if (k == 'start' or k == 'stop') and (type(v) == str):
+                setattr(self, k, utils.string_to_dto(v))
 
-            # Convert all event types to be set of strings
+            # Convert all event types to be a bitmask
             elif k == 'event_type':
-                # TODO: Lots of type checking in python?? There's probably
-                # a better way to do this
-
-                # If there are multiple event types, do the lookup and convert
-                # to strings
-                if type(d[k]) == list:
-                    self[k] = set([Event.types_reverse.get(x)
-                                  if type(x) == int else x for x in d[k]])
-                # If there is only one event type as an in, do the lookup
-                # and convert to a string
-                elif type(d[k]) == int:
-                    self[k] = set([Event.types_reverse.get(d[k])])
-                # Otherwise, there is only one type and it's a string, so just
-                # add it
-                else:
-                    self[k] = set([d[k]])
+                self.mask = Event.mask_of(v)
 
             # Because None is easier to work with than both '' and None
             # NOTE: I suppose that this could cause problems, and if it does
             # cause problems for someone, I'm sorry. Suggest the change and
             # I'll alter the code
-            elif d[k] == '':
+            elif v == '':
                 pass
 
+            # Strings and times are shared with d; anything that could be
+            # changed (dictionaries, say) is copied so that changes to d
+            # don't show up in this event or the other way around
+            elif k in Event._slots:
+                setattr(self, k, _own(v))
             else:
-                # Use deep copy to prevent annoying bugs that might arise if
-                # the values are dictionaries themselves
-                self[k] = copy.deepcopy(d[k])
+                self[k] = _own(v)
 
         # Make sure that we have a stop time for every event
-        if self.get('stop') is None:
-            self['stop'] = self.get('start') + datetime.timedelta(seconds=30)
+        if self.stop is None:
+            self.stop = self.start + datetime.timedelta(seconds=30)
+
+    @staticmethod
+    def mask_of(event_type):
+        """Converts event types (a name, an id, or a list or set of either)
+        into a bitmask. Names that aren't in types are dropped"""
+
+        if event_type is None:
+            return 0
+        if type(event_type) not in (list, set, tuple, frozenset):
+            event_type = [event_type]
+
+        mask = 0
+        for t in event_type:
+            if type(t) != int:
+                t = Event.types.get(t)
+            if t is not None:
+                mask |= 1 << t
+        return mask
+
+    def type_ids(self):
+        """Returns the ids of the event types, as stored in the database"""
+        return [i for i in Event._type_ids if self.mask & (1 << i)]
 
     def matches(self, e):
         """Returns True if this event and e have no conflicting information"""
 
-        # Get all of the keys for this event
-        keys = self.keys()
-
-        # Remove the keys that we don't care about
-        if 'id' in keys:
-            keys.remove('id')
-        if 'event_type' in keys:
-            keys.remove('event_type')
-        if 'useragent' in keys:
-            keys.remove('useragent')
-        if 'os' in keys:
-            keys.remove('os')
-        # Remove stop, since we only really need to check start
-        if 'stop' in keys:
-            keys.remove('stop')
-
-        # For all of the keys that we do care about, check to make sure that
-        # there is no conflicting evidence between the two events
-        for key in keys:
-            # Check to make sure that the start and stop times overlap
-            if key == 'start':
-                if not self._does_overlap(e):
-                    return False
-
-            # The below commented out statement is equivalent to what we are
-            # actually running (because of DeMorgan's Law), but I find what is
-            # commented out easier to read, so that's why it's there
-            #
-            # if e.get(key) is None or self.get(key) == e.get(key):
-            elif (e.get(key) is not None and
-                  e.get(key) is not '' and
-                  self.get(key) is not None and
-                  self.get(key) is not '' and
-                  self.get(key) != e.get(key)):
+        # For all of the fields that we do care about, check to make sure
+        # that there is no conflicting evidence between the two events. The
+        # id, event types, user agent, OS and stop time don't matter
+        for key in Event.match_fields:
+            mine = getattr(self, key)
+            if mine is None or mine == '':
+                continue
+            theirs = e.get(key)
+            if theirs is not None and theirs != '' and mine != theirs:
                 # There is conflicting evidence, so return
                 return False
 
-        # If we got here, there is no conflicting evidence
-        return True
+        if self.extra:
+            for key, mine in self.extra.items():
+                theirs = e.get(key)
+                if (mine is not None and mine != '' and
+                        theirs is not None and theirs != '' and
+                        mine != theirs):
+                    return False
+
+        # Check to make sure that the start and stop times overlap
+        return self._does_overlap(e)
 
     def merge(self, e):
         """Merges two events together
@@ -142,43 +190,154 @@ class Event(dict):
         """
 
         # if there is no stop time for either event, default it to 30 seconds
-        if not self.get('stop'):
-            self['stop'] = (self.get('start') +
-                            datetime.timedelta(seconds=DEFAULT_DURATION))
-        if not e.get('stop'):
-            e['stop'] = (e.get('start') +
-                         datetime.timedelta(seconds=DEFAULT_DURATION))
-
-        # the merged event; default to have the values of this event
-        tmp = copy.deepcopy(self)
+        stop = self.stop
+        if not stop:
+            stop = self.start + datetime.timedelta(seconds=DEFAULT_DURATION)
+        e_start = e.get('start')
+        e_stop = e.get('stop')
+        if not e_stop:
+            e_stop = e_start + datetime.timedelta(seconds=DEFAULT_DURATION)
+
+        # the merged event; default to have the values of this event. Those
+        # that can't change are shared rather than copied, see _own
+        tmp = copy.copy(self)
 
         # take the earliest start time
-        tmp['start'] = min(self.get('start'), e.get('start'))
+        tmp.start = min(self.start, e_start)
 
         # it's safe to assume that there are no DHCP RELEASE events, so we want
         # to take the latest stop time possible, since if we terminate early,
         # it won't matter which time we picked anyways
-        tmp['stop'] = max(self.get('stop'), e.get('stop'))
-
-        keys = e.keys()
-
-        if 'start' in keys:
-            keys.remove('start')
-        if 'stop' in keys:
-            keys.remove('stop')
-        if 'event_type' in keys:
-            keys.remove('event_type')
+        tmp.stop = max(stop, e_stop)
 
-        # Add all of the new event types using sets
-        tmp['event_type'] |= e.get('event_type')
+        # Add all of the new event types
+        if isinstance(e, Event):
+            tmp.mask |= e.mask
+        else:
+            tmp.mask |= Event.mask_of(e.get('event_type'))
 
         # copy e into the new event
-        for k in keys:
-            tmp[k] = e[k]
+        for k in e.keys():
+            if k != 'start' and k != 'stop' and k != 'event_type':
+                tmp[k] = _own(e[k])
 
         # return the merged event
         return tmp
 
+    # The dict-like view of an event, for existing callers
+
+    def get(self, key, default=None):
+        """Returns the value for a key, or default if it isn't set"""
+
+        if key in Event._slots:
+            value = getattr(self, key)
+        elif key == 'event_type':
+            value = self._type_names()
+        elif self.extra:
+            value = self.extra.get(key)
+        else:
+            value = None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in Event._slots:
+            setattr(self, key, value)
+        elif key == 'event_type':
+            self.mask = Event.mask_of(value)
+        elif value is None:
+            if self.extra:
+                self.extra.pop(key, None)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if self.get(key) is None:
+            raise KeyError(key)
+        self[key] = None if key != 'event_type' else 0
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        """Returns a list of the keys that are set"""
+
+        keys = [k for k in Event.fields if getattr(self, k) is not None]
+        if self.mask:
+            keys.append('event_type')
+        if self.extra:
+            keys.extend(self.extra.keys())
+        return keys
+
+    def items(self):
+        return [(k, self.get(k)) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def update(self, d):
+        """Sets every key in d on this event"""
+        for k in d.keys():
+            self[k] = d[k]
+
+    def clear(self):
+        """Unsets every key"""
+
+        for k in Event.fields:
+            setattr(self, k, None)
+        self.mask = 0
+        self.extra = None
+
+    def __copy__(self):
+        c = Event.__new__(Event)
+        c.__setstate__(self.__getstate__())
+        return c
+
+    def __getstate__(self):
+        return tuple(getattr(self, k) for k in Event.__slots__)
+
+    def __setstate__(self, state):
+        for k, v in zip(Event.__slots__, state):
+            setattr(self, k, v)
+        # Copies (and merges) own any mutable values in extra, so that
+        # changing one event's lists never changes another's
+        if self.extra is not None:
+            self.extra = dict((k, _own(v)) for k, v in self.extra.items())
+
+    def __eq__(self, e):
+        if isinstance(e, Event):
+            return (self.__getstate__()[:-1] == e.__getstate__()[:-1] and
+                    (self.extra or {}) == (e.extra or {}))
+        if isinstance(e, dict):
+            return dict(self.items()) == e
+        return NotImplemented
+
+    def __ne__(self, e):
+        result = self.__eq__(e)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def _type_names(self):
+        """Returns the event types as a set of strings, or None"""
+
+        if not self.mask:
+            return None
+        return set(Event.types_reverse[i] for i in self.type_ids())
+
     def _does_overlap(self, e):
         """Returns True if time times of this event and e overlap
         The four cases for overlap are as follows:
@@ -191,17 +350,18 @@ class Event(dict):
 
         """
 
-        if ((self.get('start') <= e.get('start') <= self.get('stop') and
-                self.get('stop') >= e.get('stop') >= self.get('start'))
+        start = self.start
+        stop = self.stop
+        e_start = e.get('start')
+        e_stop = e.get('stop')
+
+        if ((start <= e_start <= stop and stop >= e_stop >= start)
             or
-            (self.get('start') >= e.get('start') and
-                self.get('stop') >= e.get('stop') >= e.get('start'))
+            (start >= e_start and stop >= e_stop >= e_start)
             or
-            (self.get('start') <= e.get('start') <= self.get('stop') and
-                self.get('stop') <= e.get('stop'))
+            (start <= e_start <= stop and stop <= e_stop)
             or
-            (self.get('start') >= e.get('start') and
-                self.get('stop') <= e.get('stop'))):
+            (start >= e_start and stop <= e_stop)):
 
             return True
         return False
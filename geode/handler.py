@@ -0,0 +1,213 @@
+"""An HTTP handler for splunklib that keeps connections open between requests
+
+splunklib's own handler opens a new connection, with a new TLS handshake, for
+every REST call and closes it afterwards. Every window of a search makes
+several calls (creating the job, polling it, reading its results and
+cancelling it), so those handshakes add up. KeepAliveHandler keeps a pool of
+idle connections to reuse instead, and can ask for gzipped responses.
+"""
+
+import httplib
+import io
+import logging
+import socket
+import ssl
+import threading
+import urlparse
+import zlib
+
+import splunklib.binding
+
+# How much of a gzipped response is read at a time, and the most that a
+# response can hold to be read as soon as it arrives
+READ_SIZE = 64 * 1024
+
+
+class KeepAliveHandler:
+    """Sends requests for splunklib over a pool of keep-alive connections
+
+    Pass it as handler to client.connect. A connection goes back to the pool
+    once the body of its response has been read to the end; one whose body
+    is closed early (or that the server is closing) is closed instead.
+    """
+
+    def __init__(self, pool_size=4, timeout=None, gzip=False, verify=False):
+        """Keeps up to pool_size idle connections to each host. timeout is in
+        seconds, gzip asks for compressed responses, and verify checks the
+        server's certificate"""
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.gzip = gzip
+        self.verify = verify
+
+        # Idle connections for each (scheme, host, port)
+        self.idle = {}
+        self.lock = threading.Lock()
+        # How many connections have been opened, for checking that they are
+        # being reused
+        self.opened = 0
+
+    def __call__(self, url, message, **kwargs):
+        """Sends a request in splunklib's form and returns the response in
+        splunklib's form"""
+
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path
+        if parts.query:
+            path += "?" + parts.query
+
+        body = message.get("body", "")
+        headers = {"Content-Length": str(len(body)),
+                   "Host": parts.netloc,
+                   "User-Agent": "geode",
+                   "Accept": "*/*",
+                   "Connection": "keep-alive"}
+        if self.gzip:
+            headers["Accept-Encoding"] = "gzip"
+        for k, v in message.get("headers", []):
+            headers[k] = v
+        method = message.get("method", "GET")
+
+        connection, reused = self._checkout(key)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            # The server closed the idle connection while it was in the pool,
+            # so try again on a new one
+            connection = self._checkout(key, new=True)[0]
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+
+        body = _PooledResponse(self, key, connection, response)
+        # splunklib doesn't read the bodies of many small responses (to
+        # cancelling a job, for one), which would keep their connections out
+        # of the pool, so those are read straight away. Results are streamed
+        if response.length is not None and response.length <= READ_SIZE:
+            body = io.BytesIO(body.read())
+
+        return {"status": response.status,
+                "reason": response.reason,
+                "headers": response.getheaders(),
+                "body": splunklib.binding.ResponseReader(body)}
+
+    def close(self):
+        """Closes every idle connection"""
+
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for c in connections:
+                c.close()
+
+    def _checkout(self, key, new=False):
+        """Returns an idle connection to key, or a new one if there isn't one
+        (or if new is set), and whether it was reused"""
+
+        if not new:
+            with self.lock:
+                connections = self.idle.get(key)
+                if connections:
+                    return connections.pop(), True
+
+        scheme, host, port = key
+        with self.lock:
+            self.opened += 1
+        if scheme == "https":
+            context = None
+            if not self.verify and hasattr(ssl, "_create_unverified_context"):
+                context = ssl._create_unverified_context()
+            if context is not None:
+                return httplib.HTTPSConnection(host, port,
+                                               timeout=self.timeout,
+                                               context=context), False
+            return httplib.HTTPSConnection(host, port,
+                                           timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        """Puts a connection that has finished its response back in the
+        pool, or closes it if the pool is full"""
+
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.pool_size:
+                connections.append(connection)
+                return
+        connection.close()
+
+
+class _PooledResponse:
+    """The body of a response, which hands its connection back to the pool
+    when it has been read and decompresses it if it was gzipped"""
+
+    def __init__(self, handler, key, connection, response):
+        self.handler = handler
+        self.key = key
+        self.connection = connection
+        self.response = response
+
+        self.decompressor = None
+        if response.getheader("content-encoding", "").lower() == "gzip":
+            # 16 + MAX_WBITS expects a gzip header and trailer
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # Decompressed data that hasn't been read yet
+        self.pending = b""
+
+    def read(self, size=None):
+        if self.decompressor is None:
+            data = self.response.read(size)
+        else:
+            data = self._decompressed(size)
+        if self.response.isclosed():
+            self._done(reusable=not self.response.will_close)
+        return data
+
+    def close(self):
+        # A response that is closed before its end leaves the rest of it on
+        # the connection, so the connection can't be used again
+        self._done(reusable=False)
+        self.response.close()
+
+    def _decompressed(self, size):
+        """Reads and decompresses up to size bytes (or all of them)"""
+
+        while ((size is None or len(self.pending) < size) and
+               not self.response.isclosed()):
+            self.pending += self.decompressor.decompress(
+                self.response.read(READ_SIZE))
+            if self.response.isclosed():
+                self.pending += self.decompressor.flush()
+
+        if size is None:
+            data, self.pending = self.pending, b""
+        else:
+            data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def _done(self, reusable):
+        """Gives the connection back to the pool (or closes it), once"""
+
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        if reusable:
+            self.handler._release(self.key, connection)
+        else:
+            try:
+                connection.close()
+            except Exception as e:
+                logging.debug("Closing connection failed: {0}".format(e))
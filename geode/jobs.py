@@ -0,0 +1,265 @@
+"""Keeps track of the Splunk jobs that geode creates
+
+Listing jobs is slow on a busy search head, so rather than listing them to
+count or clean up ours, every job is registered when it is created and
+unregistered once it has been read and cancelled. There is one JobManager
+for the whole process (see job_manager), shared by every Splunk connection,
+so max_jobs holds however many searches and threads there are.
+"""
+
+import errno
+import logging
+import os
+import threading
+import time
+
+# How often (in seconds) to look for room for a job, while every slot is
+# taken
+POLL_INTERVAL = 0.5
+
+
+class JobManager:
+    """Keeps track of the Splunk jobs that we create
+
+    No more than max_jobs are open at once. A job that we fail to cancel is
+    kept as an orphan, and keeps its slot, until a later attempt cancels it.
+
+    The registry is also kept in a file in job_dir, named for this process,
+    so that jobs left behind by a process that died can be cancelled when
+    geode next starts (see reap).
+    """
+
+    def __init__(self, max_jobs=25, job_dir=None):
+        self.max_jobs = max_jobs
+        self.job_dir = job_dir
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.lock = threading.Lock()
+
+        # The sids of our open jobs, and of jobs that we couldn't cancel
+        self.open = set()
+        self.orphans = set()
+
+        self.registry = None
+        if job_dir:
+            try:
+                if not os.path.isdir(job_dir):
+                    os.makedirs(job_dir)
+                path = os.path.join(job_dir, str(os.getpid()))
+                # A registry with our pid is left by an earlier process that
+                # had it (in a container, every run can be pid 1), so it is
+                # moved aside for reap rather than added to
+                if os.path.exists(path):
+                    os.rename(path, "{0}-{1}".format(path, int(time.time())))
+                self.registry = open(path, "a")
+            except (IOError, OSError) as e:
+                logging.warning("No job registry in {0}, so jobs left by a "
+                                "crash won't be cancelled: {1}".format(
+                                    job_dir, e))
+
+    def create(self, connection, search_string, block=True, **kwargs):
+        """Creates a job through a splunklib connection, once there is room
+        for it
+
+        With block unset, returns None rather than waiting if we already
+        have max_jobs open
+        """
+
+        if self.orphans:
+            self._cancel_orphans(connection)
+        while not self.slots.acquire(False):
+            if not block:
+                return None
+            # Orphans hold slots, so try them again while we wait
+            time.sleep(POLL_INTERVAL)
+            if self.orphans:
+                self._cancel_orphans(connection)
+
+        try:
+            job = connection.jobs.create(search_string, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.open.add(job.sid)
+            self._record("+", job.sid)
+        return job
+
+    def cancel(self, job):
+        """Cancels a job that we have finished with, making room for
+        another once Splunk has cancelled it"""
+
+        cancelled = False
+        try:
+            cancelled = self._cancel(job)
+        finally:
+            with self.lock:
+                self.open.discard(job.sid)
+                if cancelled:
+                    self._record("-", job.sid)
+                else:
+                    self.orphans.add(job.sid)
+            if cancelled:
+                self.slots.release()
+
+    def replace(self, connection, job, search_string, **kwargs):
+        """Cancels a job and creates another in its slot, without waiting
+        for room
+
+        For a window that has to be searched again, whose prefetched
+        successors may be holding every other slot. If the old job can't be
+        cancelled it keeps its slot as an orphan, and the new one waits for
+        room like any other
+        """
+
+        cancelled = False
+        try:
+            cancelled = self._cancel(job)
+        finally:
+            with self.lock:
+                self.open.discard(job.sid)
+                if cancelled:
+                    self._record("-", job.sid)
+                else:
+                    self.orphans.add(job.sid)
+        if not cancelled:
+            return self.create(connection, search_string, **kwargs)
+
+        try:
+            new_job = connection.jobs.create(search_string, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.open.add(new_job.sid)
+            self._record("+", new_job.sid)
+        return new_job
+
+    def reap(self, connection):
+        """Cancels the jobs left in the registries of processes that are no
+        longer running, and removes their registries. Returns how many jobs
+        were cancelled"""
+
+        if not self.job_dir or not os.path.isdir(self.job_dir):
+            return 0
+
+        reaped = 0
+        for name in os.listdir(self.job_dir):
+            try:
+                pid = int(name.split("-")[0])
+            except ValueError:
+                continue
+            if name == str(os.getpid()):
+                continue
+            if pid != os.getpid() and _running(pid):
+                continue
+
+            # Another process starting at the same time may be reaping the
+            # same registry, in which case it can disappear under us
+            path = os.path.join(self.job_dir, name)
+            sids = set()
+            try:
+                with open(path) as f:
+                    for line in f:
+                        if line.startswith("+"):
+                            sids.add(line[1:].strip())
+                        elif line.startswith("-"):
+                            sids.discard(line[1:].strip())
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            for sid in sids:
+                if self._cancel(self._job(connection, sid)):
+                    reaped += 1
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        if reaped:
+            logging.info("Cancelled {0} jobs left by earlier runs".format(
+                reaped))
+        return reaped
+
+    def _cancel(self, job):
+        """Cancels a job, returning False if that failed. A job that Splunk
+        no longer has counts as cancelled"""
+
+        try:
+            job.cancel()
+        except Exception as e:
+            # splunklib's HTTPError has the status
+            if getattr(e, "status", None) == 404:
+                return True
+            logging.warning("Cancelling job {0} failed: {1}".format(job.sid,
+                                                                    e))
+            return False
+        return True
+
+    def _job(self, connection, sid):
+        """Returns the job with a sid, without fetching it"""
+
+        import splunklib.client
+        return splunklib.client.Job(connection, sid)
+
+    def _cancel_orphans(self, connection):
+        """Tries again to cancel the jobs that we couldn't before, freeing
+        their slots"""
+
+        with self.lock:
+            orphans = list(self.orphans)
+        for sid in orphans:
+            if self._cancel(self._job(connection, sid)):
+                with self.lock:
+                    if sid not in self.orphans:
+                        continue
+                    self.orphans.discard(sid)
+                    self._record("-", sid)
+                self.slots.release()
+
+    def _record(self, change, sid):
+        """Writes a change to the registry, emptying it whenever we have no
+        jobs, so that it stays small. Called with the lock held"""
+
+        if self.registry is None:
+            return
+        try:
+            if not self.open and not self.orphans:
+                self.registry.truncate(0)
+            else:
+                self.registry.write("{0}{1}\n".format(change, sid))
+            self.registry.flush()
+        except (IOError, OSError) as e:
+            logging.warning("Writing the job registry failed: {0}".format(e))
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+
+def job_manager(max_jobs=25, job_dir=None):
+    """Returns the process's JobManager, creating it the first time
+
+    Every Splunk connection shares it, so it outlives reconnects, along with
+    any orphans it is still trying to cancel
+    """
+
+    global _job_manager
+
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(max_jobs, job_dir)
+        return _job_manager
+
+
+def _running(pid):
+    """Returns whether a process is running"""
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
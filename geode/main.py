@@ -1,77 +1,399 @@
-import splunk
+from geode.batch import Batch
 from geode.database import Database
+from geode.dedup import DedupFilter
 from geode.event import Event
+import geode.metrics as metrics
+from geode.scheduler import Scheduler
+from geode.shard import ShardPool
+from geode.splunk import Checkpoint, Splunk
+import geode.spool as spool
 import geode.utils as utils
-from configparser import SafeConfigParser
 import splunklib.results
 
 import logging
+import threading
+import time
 
 
 class Geode:
 
-    def __init__(self, log_file='/var/log/geode/geode.log'):
-        """On instantiation, turn on logging"""
+    def __init__(self, log_file='/var/log/geode/geode.log', watermark=None):
+        """On instantiation, turn on logging
+
+        When running under the Scheduler, the watermark is used to hold
+        identity searches back until DHCP has caught up
+        """
         logging.basicConfig(filename=log_file, level=logging.INFO)
+        self.log_file = log_file
+        self.watermark = watermark
+        self.shard_pool = None
+        # Where results go on their way to the database, if anywhere (see
+        # geode.spool)
+        self.spool = None
+        # Repeats of recent events are dropped if dedup_window is set, with a
+        # filter for each search (see geode.dedup)
+        self.dedup_window = 0
+        self.dedup_filters = {}
+
+    def _connect(self, splunk=True, database=True, cache=True):
+        """Connect to Splunk and to the Database
 
-    def _connect(self):
-        """Connect to Splunk and to the Database"""
+        Either can be left out, for a Geode that only fetches results or
+        only writes them. Unset cache if anything else may be writing the
+        same sessions (see Database)
+        """
 
         # Connect to the things we need to connect to
-        c = SafeConfigParser()
-        c.read("/etc/geode/settings.conf")
-        self.splunk = splunk.Splunk(**{"username": c.get("Splunk", "username"),
-                                       "password": c.get("Splunk", "password"),
-                                       "host":     c.get("Splunk", "host"),
-                                       "port":     c.get("Splunk", "port")})
-        self.database = Database()
+        if splunk:
+            self.splunk = Splunk()
+        self.database = Database(cache=cache) if database else None
+
+        # Instrumentation is off unless the Metrics section turns it on
+        metrics.configure()
+
+        # The search that every other search depends on
+        self.dhcp_search = utils.read_config("Geode", "dhcp_search",
+                                             default="dhcp")
+
+        # Batch mode is off unless a batch size is set
+        self.batch_size = int(utils.read_config("Geode", "batch_size",
+                                                default=0))
+        self.flush_interval = float(utils.read_config("Geode",
+                                                      "flush_interval",
+                                                      default=5))
+
+        # Sharding is off unless there is more than one shard
+        self.shards = int(utils.read_config("Geode", "shards", default=0))
+        self._close_shards()
+
+        # Dropping repeated events is off unless a window (in seconds) is set
+        self.dedup_window = int(utils.read_config("Geode", "dedup_window",
+                                                  default=0))
+        self.dedup_size = int(utils.read_config("Geode", "dedup_size",
+                                                default=100000))
 
     def process_results(self, results, s):
         """Process results from Splunk, inserting them into the database"""
 
-        tag = 'earliest_%s_time' % s
+        if self.dedup_window > 0:
+            results = self._deduplicated(results, s)
+
+        if self.shards > 1:
+            return self.process_sharded(results, s)
+        if self.batch_size > 1:
+            return self.process_batched(results, s)
+
         # For each of the results:
         i = 0
         earliest_time = None
         for r in results:
             if type(r) == splunklib.results.Message:
                 continue
-            r = Event(r)
-            # First check to see if there is another event that spans this time
-            # in the database
-            lookup = self.database.select(r)
-
-            # If there is, and the event matches, then merge these events and
-            # update the database
-            if lookup is not None:
-                if r.matches(lookup):
-                    m = lookup.merge(r)
-                    self.database.update(m, lookup.get('id'))
-                # Otherwise, the information is conflicting, so terminate the old
-                # event and make a new one. The termination happens at the start
-                # time of the new event, since this is the first time that we know
-                # for certain the old event does not match
-                else:
-                    self.database.terminate(lookup, r.get('start'))
-                    self.database.insert(r)
-            else:
-                self.database.insert(r)
+            # Splunk has given us everything up to this point
+            if isinstance(r, Checkpoint):
+                earliest_time = r.time
+                self._checkpoint(s, earliest_time)
+                i = 0
+                continue
+            with metrics.timer("event"):
+                r = Event(r)
+            self._correlate(r)
             earliest_time = r.get('start')
             i += 1
             if i % 100 == 0:
-                utils.update_config('Time', tag, earliest_time)
-        if earliest_time is not None:
-            utils.update_config('Time', tag, earliest_time)
+                self._checkpoint(s, earliest_time)
+        if i % 100 != 0:
+            self._checkpoint(s, earliest_time)
+
+    def _deduplicated(self, results, s):
+        """Passes results from search s through, except for exact repeats of
+        events that it has given us recently"""
+
+        dedup = self.dedup_filters.get(s)
+        if dedup is None:
+            dedup = DedupFilter(self.dedup_window, self.dedup_size)
+            self.dedup_filters[s] = dedup
+
+        for r in results:
+            if isinstance(r, dict) and not dedup.check(r):
+                metrics.count("events_deduplicated")
+                continue
+            yield r
+
+    def _correlate(self, r):
+        """Merges an event into the session it belongs to in the database,
+        or starts a new session for it"""
+
+        # When other writers share the sessions, the session is locked from
+        # being looked up until it is written back, so that a merge made in
+        # between isn't overwritten (see Database.select)
+        if self.database.shared:
+            with self.database.transaction():
+                self._merge(r, lock=True)
+        else:
+            self._merge(r)
+
+    def _merge(self, r, lock=False):
+        """Does the work of _correlate, locking the session if asked"""
+
+        # First check to see if there is another event that spans this time
+        # in the database
+        lookup = self.database.select(r, lock=lock)
+
+        # If there is, and the event matches, then merge these events and
+        # update the database
+        if lookup is not None:
+            if r.matches(lookup):
+                m = lookup.merge(r)
+                self.database.update(m, lookup.get('id'))
+                metrics.count("events_merged")
+            # Otherwise, the information is conflicting, so terminate the old
+            # event and make a new one. The termination happens at the start
+            # time of the new event, since this is the first time that we know
+            # for certain the old event does not match
+            else:
+                self.database.terminate(lookup, r.get('start'))
+                self.database.insert(r)
+                metrics.count("events_terminated")
+                metrics.count("events_inserted")
+        else:
+            self.database.insert(r)
+            metrics.count("events_inserted")
+
+    def process_batched(self, results, s):
+        """Process results from Splunk in batches (see geode.batch)
+
+        The checkpoint is written in the same transaction as each batch
+        """
+
+        batch = Batch(self.database, self.batch_size, self.flush_interval, s)
+        for r in results:
+            if type(r) == splunklib.results.Message:
+                continue
+            # Splunk has given us everything up to this point
+            if isinstance(r, Checkpoint):
+                batch.advance(r.time)
+                continue
+            with metrics.timer("event"):
+                r = Event(r)
+            batch.advance(r.get('start'))
+            if batch.add(r):
+                self._committed(s, batch.committed)
+        if batch.flush():
+            self._committed(s, batch.committed)
+
+    def process_sharded(self, results, s):
+        """Process results from Splunk across several processes (see
+        geode.shard)
+
+        The checkpoint is only written once every shard has committed the
+        events before it
+        """
+
+        if self.shard_pool is None:
+            self.shard_pool = ShardPool(self.shards, self.batch_size,
+                                        self.flush_interval,
+                                        self.database.config_file,
+                                        self.log_file)
+        pool = self.shard_pool
+
+        earliest_time = None
+        pending = False
+        for r in results:
+            if type(r) == splunklib.results.Message:
+                continue
+            # Splunk has given us everything up to this point
+            if isinstance(r, Checkpoint):
+                done = pool.checkpoint(s, r.time)
+                pending = False
+            else:
+                pool.add(s, r)
+                earliest_time = r.get('start')
+                pending = True
+                done = pool.committed()
+            if done is not None:
+                self._checkpoint(s, done)
+
+        # Like process_results, anything after the last checkpoint counts up
+        # to the last event
+        if pending:
+            pool.checkpoint(s, utils.string_to_dto(earliest_time))
+        done = pool.committed(wait=True)
+        if done is not None:
+            self._checkpoint(s, done)
+
+    def spool_results(self, results, s):
+        """Appends results from Splunk to the spool, for drain to write to
+        the database"""
+
+        for r in results:
+            if type(r) == splunklib.results.Message:
+                continue
+            # Splunk has given us everything up to this point
+            if isinstance(r, Checkpoint):
+                self.spool.checkpoint(s, r.time)
+                continue
+            self.spool.append(s, r)
+
+    def drain(self, spool, interval=5):
+        """Writes whatever has been spooled to the database, forever
+
+        This runs in a thread of its own, with its own connection. If the
+        database fails, it waits and picks up from the last group of results
+        that it wrote, while fetching carries on
+        """
+
+        connected = False
+        while True:
+            try:
+                if not connected:
+                    self._connect(splunk=False)
+                    connected = True
+                self.drain_once(spool)
+            except Exception as e:
+                logging.exception("Draining the spool failed: {0}".format(e))
+                self._close_shards()
+                connected = False
+                utils.wait()
+                continue
+            time.sleep(interval)
+
+    def drain_once(self, spool):
+        """Writes everything in the spool that has a checkpoint to the
+        database, moving the spool's cursor on after each group of results
+        that has been written"""
+
+        for s, results, checkpoint, position in spool.groups():
+            if checkpoint is not None:
+                results.append(Checkpoint(checkpoint))
+            try:
+                self.process_results(results, s)
+            except Exception:
+                self._rollback(s)
+                raise
+            spool.commit(position)
+
+    def _close_shards(self):
+        """Stops the shard processes, if there are any"""
+
+        if self.shard_pool is not None:
+            self.shard_pool.close()
+            self.shard_pool = None
+
+    def _checkpoint(self, s, earliest_time):
+        """Records that search s has been processed up to earliest_time"""
+
+        self.database.set_checkpoint(s, earliest_time)
+        self._committed(s, earliest_time)
+
+    def _committed(self, s, earliest_time):
+        """Called once search s is in the database up to earliest_time"""
+
+        metrics.checkpoint(s, earliest_time)
+        metrics.export()
+
+        # Results are sorted by start, so every DHCP event before this one
+        # is in the database, though some at the same time may not be yet
+        if self.watermark is not None and s == self.dhcp_search:
+            self.watermark.advance(utils.time_diff(earliest_time, -1))
+
+        # Events before this are written, so repeats of them can be dropped
+        if s in self.dedup_filters:
+            self.dedup_filters[s].commit(earliest_time)
+
+    def _rollback(self, s):
+        """Called when processing search s failed, so that the events that
+        weren't committed are written when they are fetched again"""
+
+        if s in self.dedup_filters:
+            self.dedup_filters[s].rollback()
+
+    def run_search(self, s, latest_time, job_slots=None):
+        """Runs search s up to latest_time and processes the results
+
+        job_slots optionally limits the Splunk jobs the search may have open
+        """
+
+        # Pick up where we left off: the spool knows how far we've fetched,
+        # which may be past what's in the database. Older versions kept this
+        # in settings.conf, so use that until we have a checkpoint of our own
+        earliest_time = None
+        if self.spool is not None:
+            earliest_time = self.spool.fetched(s)
+        if earliest_time is None:
+            if self.database is None:
+                self.database = Database()
+            earliest_time = self.database.get_checkpoint(s)
+        if earliest_time is None:
+            earliest_time = utils.read_config('Time', 'earliest_%s_time' % s,
+                                              default=None)
+
+        # Results is actually a generator of all results
+        results = self.splunk.search(s, latest_time, earliest_time,
+                                     job_slots=job_slots)
+        if self.watermark is not None and s != self.dhcp_search:
+            results = self.watermark.gate(results)
+
+        try:
+            if self.spool is not None:
+                self.spool_results(results, s)
+            else:
+                self.process_results(results, s)
+        except Exception:
+            # Stop the search so its job and stream are cleaned up
+            results.close()
+            # Whatever the shards were in the middle of is abandoned, and
+            # the search starts again from its last checkpoint
+            self._close_shards()
+            self._rollback(s)
+            raise
+
+        # The search covered everything up to latest_time
+        if self.watermark is not None and s == self.dhcp_search:
+            self.watermark.advance(latest_time)
+
+        # Spooled results are only counted once drain has written them
+        if self.spool is None:
+            metrics.checkpoint(s, latest_time)
+        metrics.export()
+
+        if self.database is not None and self.database.cache is not None:
+            logging.info("Session cache for {0}: {1}".format(
+                s, self.database.cache.stats()))
+        if s in self.dedup_filters:
+            logging.info("Dedup filter for {0}: {1}".format(
+                s, self.dedup_filters[s].stats()))
 
     def main(self):
         """Main function that run the searches and processes results"""
 
+        # With more than one worker, let the scheduler run the searches
+        # concurrently
+        workers = int(utils.read_config("Concurrency", "workers", default=1))
+        if workers > 1:
+            dhcp_search = utils.read_config("Geode", "dhcp_search",
+                                            default="dhcp")
+            Scheduler(Geode, workers, dhcp_search).run()
+            return
+
+        # With a spool, results are fetched here and written to the
+        # database by a thread of its own, so that fetching doesn't have to
+        # wait for the database (or stop when it's down)
+        self.spool = spool.configure()
+        if self.spool is not None:
+            drainer = threading.Thread(
+                target=Geode(log_file=self.log_file).drain,
+                args=(self.spool, float(utils.read_config(
+                    "Spool", "drain_interval", default=5))))
+            drainer.daemon = True
+            drainer.start()
+
         # For each of the searches, run the search and process the results
         # from that search
         while True:
 
             try:
-                self._connect()
+                self._connect(database=self.spool is None)
             except Exception as e:
                 logging.exception("Unable to connect: {0}".format(e))
                 utils.wait()
@@ -80,21 +402,17 @@ class Geode:
             searches = utils.get_search_names(raw=True)
             latest_time = utils.time_diff(utils.now(), -300)
 
-            c = SafeConfigParser()
-            c.read("/etc/geode/settings.conf")
             for s in searches:
                 #if s == 'access':
                 #    continue
-                # Results is actually a generator of all results
-                results = self.splunk.search(c.get("Searches", s, raw=True), c.get("Time", str("earliest_%s_time" % s)), latest_time)
                 try:
-                    self.process_results(results, s)
+                    self.run_search(s, latest_time)
                 except Exception as e:
                     print(e)
-                    print(results)
                     logging.exception(str(e))
                     # This should be a break, since we NEED DHCP before info
                     break
 
+
 if __name__ == "__main__":
     Geode().main()
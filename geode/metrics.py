@@ -0,0 +1,269 @@
+import geode.utils as utils
+
+import functools
+import logging
+import os
+import threading
+import time
+
+# Every metric name starts with this
+PREFIX = "geode_"
+
+
+class Metrics:
+    """Where the time goes in ingest, and how far behind each search is
+
+    Stage timings are exclusive: time spent in a stage that starts inside
+    another (a download inside parsing, say) only counts towards the inner
+    one, so the stages add up to the time spent in all of them. Counters
+    count things that happened, like rows fetched, and lag is how far each
+    search's last checkpoint is behind now().
+
+    Everything is kept in memory and written out by export, as a Prometheus
+    text format file (for node_exporter's textfile collector) and to the log.
+    """
+
+    def __init__(self, path=None, interval=60):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.exported = time.time()
+        # stage -> [calls, seconds]
+        self.stages = {}
+        self.counters = {}
+        # search -> the time it has been processed up to
+        self.progress = {}
+
+    def timer(self, stage):
+        """Returns a context manager that times a stage"""
+        return _Timer(self, stage)
+
+    def count(self, name, n=1):
+        """Adds n to a counter"""
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def checkpoint(self, search, time):
+        """Records that search has been processed up to time (a datetime)"""
+
+        with self.lock:
+            self.progress[search] = time
+
+    def record(self, stage, seconds):
+        """Adds a call of the given length to a stage"""
+
+        with self.lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = [0, 0.0]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def export(self, force=False):
+        """Writes everything out if it has been interval seconds since we
+        last did, or if force is set"""
+
+        now = time.time()
+        if not force and now - self.exported < self.interval:
+            return
+        self.exported = now
+
+        with self.lock:
+            stages = dict((k, list(v)) for k, v in self.stages.items())
+            counters = dict(self.counters)
+            progress = dict(self.progress)
+
+        current = utils.now()
+        lag = dict((s, _seconds(current - t)) for s, t in progress.items())
+
+        logging.info("Metrics: stages {0}, counters {1}, lag {2}".format(
+            dict((k, round(v[1], 3)) for k, v in stages.items()),
+            counters, lag))
+
+        if self.path is None:
+            return
+
+        lines = [
+            "# HELP {0}stage_seconds_total Time spent in each ingest stage"
+            .format(PREFIX),
+            "# TYPE {0}stage_seconds_total counter".format(PREFIX)]
+        for stage in sorted(stages):
+            lines.append('{0}stage_seconds_total{{stage="{1}"}} {2:f}'.format(
+                PREFIX, stage, stages[stage][1]))
+        lines.extend([
+            "# HELP {0}stage_calls_total Times each ingest stage ran"
+            .format(PREFIX),
+            "# TYPE {0}stage_calls_total counter".format(PREFIX)])
+        for stage in sorted(stages):
+            lines.append('{0}stage_calls_total{{stage="{1}"}} {2}'.format(
+                PREFIX, stage, stages[stage][0]))
+        for name in sorted(counters):
+            lines.append("# TYPE {0}{1}_total counter".format(PREFIX, name))
+            lines.append("{0}{1}_total {2}".format(PREFIX, name,
+                                                  counters[name]))
+        lines.extend([
+            "# HELP {0}lag_seconds How far each search is behind now"
+            .format(PREFIX),
+            "# TYPE {0}lag_seconds gauge".format(PREFIX)])
+        for search in sorted(lag):
+            lines.append('{0}lag_seconds{{search="{1}"}} {2}'.format(
+                PREFIX, search, lag[search]))
+
+        # Write to the side and rename, so the collector never sees half
+        tmp = "{0}.{1}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logging.warning("Unable to write metrics to {0}: {1}".format(
+                self.path, e))
+
+
+class _Timer(object):
+    """Times one run of a stage, pausing while a nested stage runs"""
+
+    __slots__ = ('metrics', 'stage', 'elapsed', 'resumed')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.elapsed = 0.0
+        self.resumed = None
+
+    def __enter__(self):
+        now = time.time()
+        stack = getattr(self.metrics.local, 'stack', None)
+        if stack is None:
+            stack = self.metrics.local.stack = []
+        if stack:
+            parent = stack[-1]
+            parent.elapsed += now - parent.resumed
+        self.resumed = now
+        stack.append(self)
+        return self
+
+    def __exit__(self, *args):
+        now = time.time()
+        self.elapsed += now - self.resumed
+        stack = self.metrics.local.stack
+        stack.pop()
+        if stack:
+            stack[-1].resumed = now
+        self.metrics.record(self.stage, self.elapsed)
+        return False
+
+
+class _NullTimer(object):
+    """Stands in for _Timer when metrics are off"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+# The Metrics shared by everything in the process, or None if they're off
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def configure(path="/etc/geode/settings.conf"):
+    """Turns metrics on if the Metrics section of the config asks for them
+
+    [Metrics]
+    enabled = true
+    file = /var/lib/node_exporter/textfile/geode.prom
+    interval = 60
+
+    Without a file, metrics only go to the log
+    """
+
+    global _metrics
+
+    enabled = utils.read_config("Metrics", "enabled", default="false",
+                                path=path)
+    if enabled.lower() not in ("1", "yes", "true", "on"):
+        return None
+
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(
+                utils.read_config("Metrics", "file", default=None, path=path),
+                float(utils.read_config("Metrics", "interval", default=60,
+                                        path=path)))
+        return _metrics
+
+
+def timer(stage):
+    """Returns a context manager that times a stage, if metrics are on"""
+
+    if _metrics is None:
+        return _NULL_TIMER
+    return _metrics.timer(stage)
+
+
+def stage(name):
+    """Decorator that times every call to a function as a stage"""
+
+    def decorate(f):
+        @functools.wraps(f)
+        def timed_call(*args, **kwargs):
+            if _metrics is None:
+                return f(*args, **kwargs)
+            with _metrics.timer(name):
+                return f(*args, **kwargs)
+        return timed_call
+    return decorate
+
+
+def timed(iterable, stage):
+    """Iterates over iterable, timing each step as a stage (and not the time
+    spent by whoever is consuming it)"""
+
+    if _metrics is None:
+        return iterable
+    return _timed(_metrics, iter(iterable), stage)
+
+
+def _timed(metrics, iterator, stage):
+    while True:
+        with metrics.timer(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def count(name, n=1):
+    """Adds n to a counter, if metrics are on"""
+
+    if _metrics is not None:
+        _metrics.count(name, n)
+
+
+def checkpoint(search, time):
+    """Records how far a search has got, if metrics are on"""
+
+    if _metrics is not None:
+        _metrics.checkpoint(search, time)
+
+
+def export(force=False):
+    """Writes the metrics out if they are due, if metrics are on"""
+
+    if _metrics is not None:
+        _metrics.export(force)
+
+
+def _seconds(delta):
+    """Returns a timedelta in whole seconds"""
+    return delta.days * 24 * 60 * 60 + delta.seconds
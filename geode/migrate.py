@@ -0,0 +1,50 @@
+"""Brings an existing database up to date with the schema that geode's
+settings ask for
+
+    python -m geode.migrate range [config_file]
+
+range adds what the range schema needs (see geode.database.PERIOD_FUNCTION)
+to the sediment table. The indexes are built concurrently, so geode can keep
+running while they are built; once this has finished, set schema = range in
+the Geode section of the config. If a build fails, Postgres leaves an
+invalid index behind, which has to be dropped before this is run again
+"""
+from geode.database import connect, PERIOD_FUNCTION, PERIOD_INDEXES
+
+import sys
+import time
+
+
+def migrate_range(cursor):
+    """Adds the period function and its GiST indexes to sediment"""
+
+    cursor.execute(PERIOD_FUNCTION)
+    for index in PERIOD_INDEXES:
+        sql = index.format("CONCURRENTLY")
+        print(sql)
+        begin = time.time()
+        cursor.execute(sql)
+        print("Done in {0:.1f}s".format(time.time() - begin))
+
+
+MIGRATIONS = {'range': migrate_range}
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in MIGRATIONS:
+        print(__doc__)
+        return 1
+
+    config_file = argv[2] if len(argv) > 2 else '/etc/geode/settings.conf'
+    conn, cursor = connect(config_file)
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    conn.autocommit = True
+    try:
+        MIGRATIONS[argv[1]](cursor)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,187 @@
+import geode.utils as utils
+
+import logging
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class Watermark:
+    """Tracks how far the DHCP search has been ingested
+
+    Identity searches (everything but DHCP) can only be correlated once the
+    DHCP sessions they attach to are in the database, so they wait on this
+    before processing an event that is past it.
+    """
+
+    def __init__(self, time=None):
+        self.condition = threading.Condition()
+        self.time = time
+        self.failed = False
+
+    def advance(self, time):
+        """Records that DHCP has been ingested up to the given time"""
+
+        with self.condition:
+            if self.time is None or time > self.time:
+                self.time = time
+            self.failed = False
+            self.condition.notify_all()
+
+    def fail(self):
+        """Records that DHCP ingestion failed, releasing anyone waiting"""
+
+        with self.condition:
+            self.failed = True
+            self.condition.notify_all()
+
+    def wait(self, time):
+        """Blocks until DHCP has been ingested up to the given time
+
+        Raises an exception if DHCP ingestion fails in the meantime
+        """
+
+        with self.condition:
+            while self.time is None or self.time < time:
+                if self.failed:
+                    raise Exception("DHCP ingestion failed, can't process "
+                                    "events past {0}".format(self.time))
+                # Wake up now and again so that we can be interrupted
+                self.condition.wait(60)
+
+    def gate(self, results):
+        """Passes results from Splunk through, holding back each event until
+        DHCP has caught up to it"""
+
+        try:
+            for r in results:
+                if isinstance(r, dict) and r.get('start'):
+                    self.wait(utils.string_to_dto(r.get('start')))
+                yield r
+        finally:
+            # Make sure the search underneath cleans up its job too
+            if hasattr(results, 'close'):
+                results.close()
+
+
+def job_limit(search, path="/etc/geode/settings.conf"):
+    """Returns how many Splunk jobs a search may have open at once
+
+    This is [Concurrency] <search>. Only prefetching (see [Splunk] prefetch)
+    gives a search more than one job at a time, for the window it is reading
+    and each window ahead of it, so by default a search may have prefetch + 1
+    jobs. A limit below that leaves the prefetched windows waiting for the
+    current one, so we warn about it.
+    """
+
+    prefetch = int(utils.read_config('Splunk', 'prefetch', default=0,
+                                     path=path))
+    limit = max(int(utils.read_config('Concurrency', search,
+                                      default=prefetch + 1, path=path)), 1)
+    if limit < prefetch + 1:
+        logging.warning("[Concurrency] {0} = {1} leaves room for only {2} of "
+                        "the {3} windows that prefetch looks ahead".format(
+                            search, limit, limit - 1, prefetch))
+    return limit
+
+
+class Scheduler:
+    """Runs the searches concurrently instead of one after another
+
+    Every worker is a thread with its own Geode, and so its own Splunk and
+    Postgres connections. DHCP gets a worker to itself so that it can never
+    be starved by searches that are waiting on it; the other searches share
+    the remaining workers, each taking the next search from a queue, running
+    it up to now and putting it back. A slow search therefore only holds up
+    its own worker.
+
+    [Concurrency] <search> limits how many Splunk jobs each search has open
+    at once. That only makes a difference with [Splunk] prefetch set, since
+    otherwise a search runs one job at a time anyway (see job_limit).
+    """
+
+    def __init__(self, factory, workers, dhcp_search='dhcp'):
+        """Takes a callable that creates a Geode given a Watermark, the total
+        number of workers, and the name of the DHCP search"""
+
+        self.factory = factory
+        self.workers = workers
+        self.dhcp_search = dhcp_search
+        self.searches = queue.Queue()
+        self.limits = {}
+        self.watermark = None
+
+    def run(self):
+        """Starts the workers and runs forever"""
+
+        searches = utils.get_search_names(raw=True)
+
+        # Nothing is let through until DHCP records its first checkpoint
+        self.watermark = Watermark()
+
+        # The number of Splunk jobs each search may have open at once
+        for s in searches:
+            self.limits[s] = threading.BoundedSemaphore(job_limit(s))
+
+        threads = []
+        if self.dhcp_search in searches:
+            threads.append(threading.Thread(target=self._dhcp_worker))
+
+        identity = [s for s in searches if s != self.dhcp_search]
+        for s in identity:
+            self.searches.put(s)
+        for i in range(min(max(self.workers - 1, 1), len(identity))):
+            threads.append(threading.Thread(target=self._worker))
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        # The workers never return, but joining with a timeout keeps us
+        # responsive to KeyboardInterrupt
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(60)
+
+    def _dhcp_worker(self):
+        """Runs the DHCP search over and over"""
+
+        geode = None
+        while True:
+            geode = self._run(geode, self.dhcp_search)
+
+    def _worker(self):
+        """Runs whichever identity search is next in the queue"""
+
+        geode = None
+        while True:
+            s = self.searches.get()
+            try:
+                geode = self._run(geode, s)
+            finally:
+                self.searches.put(s)
+
+    def _run(self, geode, s):
+        """Runs one pass of a search, connecting first if we need to
+
+        Returns the Geode to use for the next pass, which is None if
+        something went wrong and we need to reconnect
+        """
+
+        try:
+            if geode is None:
+                geode = self.factory(watermark=self.watermark)
+                geode._connect()
+            latest_time = utils.time_diff(utils.now(), -300)
+            geode.run_search(s, latest_time, self.limits.get(s))
+        except Exception as e:
+            logging.exception("Search {0} failed: {1}".format(s, e))
+            # Anything waiting on DHCP has to give up until it recovers
+            if s == self.dhcp_search:
+                self.watermark.fail()
+            utils.wait()
+            return None
+
+        return geode
@@ -0,0 +1,218 @@
+from geode.batch import Batch
+import geode.utils as utils
+
+import collections
+import logging
+import multiprocessing
+import traceback
+import zlib
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# How many chunks of events may be waiting for each shard before the
+# dispatcher has to wait for it to catch up
+QUEUE_SIZE = 64
+
+# How many events are sent to a shard at once
+CHUNK_SIZE = 100
+
+
+class ShardPool:
+    """Correlates events in several processes at once
+
+    Each event is sent to a shard picked by its MAC (or its IP if it has no
+    MAC), and each shard is a process with its own database connection that
+    works through its events in order. That keeps each device's events in
+    order, but not a session's: its MAC events can go to one shard and its
+    IP-only events to another. So shards lock the sessions they look up
+    until they have written them back (see Database.select), and merges
+    made by one shard aren't undone by another. What isn't kept is the order
+    between shards, so an IP-only event read at about the same time as the
+    DHCP event that starts its session may get there first and start a
+    session of its own.
+
+    Shards commit on their own schedule, so progress is tracked with
+    checkpoints: each one is sent to every shard after the events before it,
+    and it only counts as committed once every shard has acknowledged it.
+    """
+
+    def __init__(self, shards, batch_size=0, flush_interval=5,
+                 config_file='/etc/geode/settings.conf',
+                 log_file='/var/log/geode/geode.log'):
+        """Starts shards processes, which correlate one event at a time or,
+        if batch_size is more than 1, in batches (see geode.batch). Each
+        connects to the database in config_file"""
+
+        self.shards = shards
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = []
+        self.processes = []
+        for i in range(shards):
+            inbox = multiprocessing.Queue(QUEUE_SIZE)
+            p = multiprocessing.Process(target=_work,
+                                        args=(i, inbox, self.outbox,
+                                              batch_size, flush_interval,
+                                              config_file, log_file))
+            p.daemon = True
+            p.start()
+            self.inboxes.append(inbox)
+            self.processes.append(p)
+
+        # Events that haven't been sent to each shard yet
+        self.chunks = [[] for i in range(shards)]
+
+        # The last checkpoint sent, and the last acknowledged by each shard
+        self.sequence = 0
+        self.acknowledged = [0] * shards
+        # (sequence, search, time) for each checkpoint not yet committed
+        self.checkpoints = collections.deque()
+
+    def shard_of(self, r):
+        """Returns the shard for an event (or a result from Splunk)"""
+
+        if r.get('mac'):
+            key = utils.mac_key(r.get('mac'))
+        else:
+            key = r.get('ip') or ''
+        return (zlib.crc32(key) & 0xffffffff) % self.shards
+
+    def add(self, search, r):
+        """Sends a result from search to its shard"""
+
+        i = self.shard_of(r)
+        chunk = self.chunks[i]
+        chunk.append(dict(r))
+        if len(chunk) >= CHUNK_SIZE:
+            self._send(i, ('events', search, chunk))
+            self.chunks[i] = []
+
+    def checkpoint(self, search, time):
+        """Marks that search has been read up to time (a datetime), once
+        everything added so far is committed
+
+        Returns the latest time that every shard has committed, or None if
+        that hasn't moved on (see committed)
+        """
+
+        self.sequence += 1
+        for i in range(self.shards):
+            if self.chunks[i]:
+                self._send(i, ('events', search, self.chunks[i]))
+                self.chunks[i] = []
+            self._send(i, ('checkpoint', search, self.sequence))
+        self.checkpoints.append((self.sequence, search, time))
+
+        return self.committed()
+
+    def committed(self, wait=False):
+        """Collects acknowledgements from the shards
+
+        Returns the time of the latest checkpoint that every shard has
+        committed since this was last called, or None. If wait is set, this
+        waits until every checkpoint has been committed
+        """
+
+        while not wait or min(self.acknowledged) < self.sequence:
+            try:
+                message = self.outbox.get(wait, 1)
+            except queue.Empty:
+                if not wait:
+                    break
+                self._check()
+                continue
+            self._receive(message)
+
+        done = min(self.acknowledged)
+        time = None
+        while self.checkpoints and self.checkpoints[0][0] <= done:
+            time = self.checkpoints.popleft()[2]
+        return time
+
+    def close(self):
+        """Stops the shards, abandoning anything they haven't done"""
+
+        for inbox in self.inboxes:
+            try:
+                inbox.put(None, False)
+            except queue.Full:
+                pass
+        for p in self.processes:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
+
+    def _send(self, i, message):
+        """Sends a message to a shard, waiting if it is behind"""
+
+        while True:
+            try:
+                self.inboxes[i].put(message, True, 1)
+                return
+            except queue.Full:
+                # Make sure that it's behind rather than gone
+                self._check()
+
+    def _receive(self, message):
+        """Handles a message from a shard"""
+
+        kind, i, payload = message
+        if kind == 'error':
+            raise Exception("Shard {0} failed: {1}".format(i, payload))
+        self.acknowledged[i] = payload
+
+    def _check(self):
+        """Raises an exception if any of the shards has failed"""
+
+        try:
+            while True:
+                self._receive(self.outbox.get(False))
+        except queue.Empty:
+            pass
+        for i, p in enumerate(self.processes):
+            if not p.is_alive():
+                raise Exception("Shard {0} exited ({1})".format(i,
+                                                                p.exitcode))
+
+
+def _work(i, inbox, outbox, batch_size, flush_interval, config_file,
+          log_file):
+    """Runs a shard: correlates the events that it is sent, and acknowledges
+    each checkpoint once everything before it is committed"""
+
+    # Imported here so that the modules can import each other
+    from geode.database import Database
+    from geode.event import Event
+    from geode.main import Geode
+
+    try:
+        geode = Geode(log_file=log_file)
+        # Other shards write the same sessions (DHCP by MAC, identity by
+        # IP), so a cache of our own would go stale
+        geode.database = Database(config_file=config_file,
+                                  log_file=log_file, cache=False)
+        batch = None
+        if batch_size > 1:
+            batch = Batch(geode.database, batch_size, flush_interval)
+
+        while True:
+            message = inbox.get()
+            if message is None:
+                return
+            kind, search, payload = message
+
+            if kind == 'events':
+                for r in payload:
+                    r = Event(r)
+                    if batch is not None:
+                        batch.add(r)
+                    else:
+                        geode._correlate(r)
+            elif kind == 'checkpoint':
+                if batch is not None:
+                    batch.flush()
+                outbox.put(('committed', i, payload))
+    except Exception as e:
+        logging.exception("Shard {0} failed: {1}".format(i, e))
+        outbox.put(('error', i, traceback.format_exc()))
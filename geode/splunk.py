@@ -1,12 +1,22 @@
 import splunklib.client as client
 import splunklib.results as results
 import splunklib.binding
+import collections
 import io
 import logging
+import time
 
+from geode.handler import KeepAliveHandler
+from geode.jobs import job_manager
+import geode.metrics as metrics
+import geode.reader as reader
 import geode.utils as utils
 
 
+# How often (in seconds) to check whether a prefetched job has finished
+POLL_INTERVAL = 0.5
+
+
 class ResponseReaderWrapper(io.RawIOBase):
     """Splunk ResultReader wrapper to speed up IO from Splunk
        Credit to senior design team for this solution:
@@ -20,6 +30,12 @@ class ResponseReaderWrapper(io.RawIOBase):
     def __init__(self, responseReader):
         self.responseReader = responseReader
 
+        # splunklib's ResponseReader wraps an HTTPResponse. If that response
+        # can fill a buffer itself (Python 3's can) we read straight into the
+        # caller's buffer and skip the intermediate string entirely
+        response = getattr(responseReader, '_response', responseReader)
+        self._readinto = getattr(response, 'readinto', None)
+
     def readable(self):
         return True
 
@@ -30,12 +46,43 @@ class ResponseReaderWrapper(io.RawIOBase):
         return self.responseReader.read(n)
 
     def readinto(self, b):
-        size = len(b)
-        data = self.responseReader.read(size)
-        for idx, ch in enumerate(data):
-            b[idx] = ch
+        with metrics.timer("download"):
+            return self._read_into(b)
+
+    def _read_into(self, b):
+        # Anything that was peeked at is sitting in the reader's own buffer,
+        # so only go around the reader once that has been used up
+        if (self._readinto is not None and
+                not getattr(self.responseReader, '_buffer', None)):
+            return self._readinto(b)
+
+        data = self.responseReader.read(len(b))
+        size = len(data)
+        # One copy through the buffer protocol rather than a byte at a time
+        memoryview(b)[:size] = data
+
+        return size
+
+
+class _ExportUnavailable(Exception):
+    """Raised when Splunk won't let us use the export endpoint, with the
+    time that the search had got up to"""
+
+    def __init__(self, earliest_time, reason):
+        Exception.__init__(self, reason)
+        self.earliest_time = earliest_time
 
-        return len(data)
+
+class Checkpoint:
+    """Yielded by Splunk.search once every result up to time (a datetime) has
+    been yielded, so that the consumer can record its progress once it has
+    stored those results"""
+
+    def __init__(self, time):
+        self.time = time
+
+    def __repr__(self):
+        return "Checkpoint({0})".format(utils.dto_to_string(self.time))
 
 
 class Splunk:
@@ -45,12 +92,55 @@ class Splunk:
 
     def __init__(self, config_file='/etc/geode/settings.conf',
                  max_events=10000,
+                 max_jobs=25,
                  log_file='/var/log/geode/geode.log'):
 
         self.config_file = config_file
         self.max_events = max_events
-        self.total_jobs = 0
+        self.max_jobs = max_jobs
         logging.basicConfig(filename=log_file, level=logging.INFO)
+
+        # Results are read from each job page_size at a time, which can be no
+        # more than Splunk returns at once (maxresultrows in limits.conf). A
+        # job keeps up to max_count results; only a window with more than
+        # that has to be searched again
+        self.page_size = int(utils.read_config("Splunk", "page_size",
+                                               default=max_events))
+        self.max_count = int(utils.read_config("Splunk", "max_count",
+                                               default=500000))
+
+        # How many windows ahead to run jobs for; 0 runs one job at a time.
+        # Under the Scheduler, prefetched jobs count towards the search's
+        # [Concurrency] limit, which defaults to prefetch + 1
+        self.prefetch = int(utils.read_config("Splunk", "prefetch",
+                                              default=0))
+
+        # The limits (in seconds) for the windows that searches are cut into.
+        # The defaults keep every window at 1 minute
+        self.min_window = int(utils.read_config("Splunk", "min_window",
+                                                default=60))
+        self.max_window = int(utils.read_config("Splunk", "max_window",
+                                                default=60))
+        # A window of no time would never get anywhere
+        if self.min_window < 1:
+            raise Exception("min_window must be at least 1 second, not "
+                            "{0}".format(self.min_window))
+        # The window sizer for each search
+        self.sizers = {}
+
+        # Set once Splunk has refused an export, after which every search
+        # uses jobs
+        self.export_unavailable = False
+
+        # The format to ask Splunk for results in: xml, json or csv. xml
+        # goes through splunklib's ResultsReader, the others are much
+        # cheaper to parse (see geode.reader)
+        self.output_mode = utils.read_config("Splunk", "output_mode",
+                                             default="xml")
+        if self.output_mode not in ("xml", "json", "csv"):
+            raise Exception("Unknown output_mode {0}".format(
+                self.output_mode))
+
         self._connect()
 
     def _connect(self):
@@ -67,28 +157,49 @@ class Splunk:
         port = utils.read_config(section, "port")
         host = utils.read_config(section, "host")
 
+        # With a pool_size, requests go over that many keep-alive
+        # connections rather than a new connection each, optionally gzipped
+        kwargs = {}
+        pool_size = int(utils.read_config(section, "pool_size", default=0))
+        if pool_size > 0:
+            gzip = utils.read_config(section, "gzip", default="false")
+            kwargs["handler"] = KeepAliveHandler(
+                pool_size, gzip=gzip.lower() in ("1", "yes", "true", "on"))
+
         # Try to connect else error handle
         try:
             self.connection = client.connect(username=username,
                                              password=password,
                                              port=port,
-                                             host=host)
-            jobs = self.connection.jobs.list()
-            for j in jobs:
-                try:
-                    if j.access['owner'] == self.user:
-                        self.total_jobs += 1
-                except splunklib.binding.HTTPError:
-                    continue
+                                             host=host,
+                                             **kwargs)
+            # Our jobs are tracked locally rather than by listing them, by
+            # one manager that every connection in the process shares, and
+            # any left behind by a crash are cancelled now
+            self.job_manager = job_manager(
+                self.max_jobs,
+                utils.read_config(section, "job_dir",
+                                  default="/var/lib/geode/jobs"))
+            self.job_manager.reap(self.connection)
 
         except Exception as e:
             logging.exception('Splunk connection failure: {0}'.format(str(e)))
             raise e
 
-    def search(self, search, latest_time):
+    def search(self, search, latest_time, earliest_time=None,
+               job_slots=None):
         """Searches Splunk and sets a result stream to read the events returned
 
-        The latest_time should be a datetime object
+        The latest_time should be a datetime object. earliest_time is where
+        to start from, as a datetime or string; by default it is read from
+        the Time section of the config. job_slots is an optional semaphore
+        that is held for as long as each job is open, to limit how many jobs
+        a search has open at once. Without prefetch a search only ever has
+        one job open, so job_slots only limits anything once prefetch is set
+
+        Along with the results, Checkpoint objects are yielded after each
+        page. Nothing is saved here: it's up to the consumer to record its
+        progress once the results before a checkpoint are stored.
 
         The default functionality is searching from last_event_time_seen until
         now(). However, we took a few things into consideration:
@@ -97,11 +208,13 @@ class Splunk:
             time as earliest_time + 5mins rather than now() so it can backfill
             easier.
         2) Our Splunk instance can only return 10,000 results at a time, yours
-            may vary. Set this when initializing the class with max_events=#
-            If we receive 10,000 events, we need to loop back through from
-            last_event_time_seen until the latest original search time as
+            may vary. Set page_size in the Splunk section of the config. Each
+            job's results are read a page at a time with offsets, as
             documented in the official Splunk Python SDK documentation.
             See: http://dev.splunk.com/view/python-sdk/SP-CAAAER5#paginating
+            Only if a job fills up with max_count results do we loop back
+            through from last_event_time_seen until the latest original
+            search time.
 
         """
 
@@ -110,14 +223,46 @@ class Splunk:
         tag = 'earliest_%s_time' % search
 
         # Get the most recent time that we've searched, or default to -5m
-        try:
-            earliest_time = utils.read_config('Time', tag)
-        except:
+        if earliest_time is None:
+            earliest_time = utils.read_config('Time', tag, default=None)
+        if earliest_time is None:
             earliest_time = utils.time_diff_string(latest_time, -300)
+        elif type(earliest_time) is not str:
+            earliest_time = utils.dto_to_string(earliest_time)
 
         # Get the search string
         search_string = utils.read_config('Searches', search, raw=True)
 
+        if search not in self.sizers:
+            self.sizers[search] = WindowSizer(search, self.max_events,
+                                              self.min_window,
+                                              self.max_window)
+        sizer = self.sizers[search]
+
+        # Searches can be streamed from the export endpoint instead of going
+        # through jobs, if the Export section says so
+        export = utils.read_config('Export', search, default='false')
+        if (export.lower() in ('1', 'yes', 'true', 'on') and
+                not self.export_unavailable):
+            try:
+                for result in self._search_export(search_string,
+                                                  earliest_time, latest_time,
+                                                  sizer, job_slots):
+                    yield result
+                return
+            except _ExportUnavailable as e:
+                logging.warning("Export unavailable, using jobs for {0} from "
+                                "{1}: {2}".format(search, e.earliest_time, e))
+                self.export_unavailable = True
+                earliest_time = e.earliest_time
+
+        if self.prefetch > 0:
+            for result in self._search_pipelined(search_string, earliest_time,
+                                                 latest_time, sizer,
+                                                 job_slots):
+                yield result
+            return
+
         # caught_up represents if the latest time we have searched is the
         # latest time that we wanted to search
         caught_up = False
@@ -127,68 +272,411 @@ class Splunk:
 
         # Run the search, loop through, and search again if needed
         while not caught_up:
-            # Ensure that we are not running too many searches
-            if self.total_jobs > 25:
-                jobs = self.connection.jobs.list()
-                for j in jobs:
-                    try:
-                        if j.access['owner'] == self.user:
-                            j.cancel()
-                            self.total_jobs -= 1
-                    except splunklib.binding.HTTPError:
-                        continue
-
-
             # We reset this each time through the loop because we are now
             # running a search again for a new 5 minute interval.
             events_done = False
 
-            # If we need to search more than 1 minute at a time, then only
-            # search for 1 minute (because otherwise we'll probably return too
-            # many results). Otherwise, search the full time period
-            if (utils.return_difference(earliest_time, latest_time) > 60):
-                search_time = utils.time_diff_string(earliest_time, 60)
+            # If we need to search more than one window at a time, then only
+            # search for one window (because otherwise we'll probably return
+            # too many results). Otherwise, search the full time period
+            window = sizer.size
+            if (utils.return_difference(earliest_time, latest_time) > window):
+                search_time = utils.time_diff_string(earliest_time, window)
             else:
                 search_time = latest_time
                 caught_up = True
+            window_start = earliest_time
 
             # The search parameters
             kwargs_search = {"exec_mode": "blocking",
                              "earliest_time": earliest_time,
-                             "latest_time": search_time}
+                             "latest_time": search_time,
+                             "max_count": self.max_count}
             # Now we need to run the search until we are caught up to when we
             # wanted to search until
             while not events_done:
                 # Create a job and run the search
                 original_earliest_time = earliest_time
-                jobs = self.connection.jobs
-                job = jobs.create(search_string, **kwargs_search)
-                # Get the results and the result count
-                result_count = int(job["resultCount"])
-                rs = job.results(count=0)
-                # Iterate through all of the results using the modified reader
-                evts = results.ResultsReader(io.BufferedReader(ResponseReaderWrapper(rs)))
-                results_array = [evt for evt in evts]
-                for result in results_array:
-                    # Update the earliest time to be the most recent time
-                    earliest_time = result.get('start')
-                    yield result
-
-                # I'm finished with this guy!
-                job.cancel()
-
-                # If we returned less than the max number of results, we're
-                # done with this iteration of the search
+                if job_slots is not None:
+                    job_slots.acquire()
+                job = None
+                pages = None
+                try:
+                    with metrics.timer("job"):
+                        job = self.job_manager.create(self.connection,
+                                                      search_string,
+                                                      **kwargs_search)
+                    # Get the results and the result count
+                    result_count = int(job["resultCount"])
+                    # Size the next window on how this one went
+                    if kwargs_search['earliest_time'] == window_start:
+                        sizer.record(result_count,
+                                     utils.return_difference(window_start,
+                                                             search_time),
+                                     float(job["runDuration"]))
+                    pages = self._read_pages(job, result_count)
+                    for result in pages:
+                        # Update the earliest time to be the most recent time
+                        if isinstance(result, dict):
+                            earliest_time = result.get('start')
+                        yield result
+                finally:
+                    # I'm finished with this guy! This also runs if the
+                    # consumer stops partway through the page, in which case
+                    # we never get to the checkpoint below; the consumer is
+                    # responsible for recording how far it got
+                    if pages is not None:
+                        pages.close()
+                    if job is not None:
+                        self.job_manager.cancel(job)
+                    if job_slots is not None:
+                        job_slots.release()
+
+                # If the job wasn't full, we've read the whole window and
+                # we're done with this iteration of the search
                 # We can run into a feature where all events happen at the same time
                 # So earliest_time never gets incremented. Fixed here
                 if earliest_time == original_earliest_time:
                     earliest_time = utils.time_diff_string(earliest_time, 60)
-                if (result_count < self.max_events):
+                if (result_count < self.max_count):
                     events_done = True
                 # Otherwise, we want to start the search again
                 else:
                     kwargs_search['earliest_time'] = earliest_time
 
-                # NOTE: This might cause issues in the future, if searching
-                # errors out, we might end up missing a ton of results
-                utils.update_config('Time', tag, earliest_time)
+                # Let the consumer know how far we've got
+                yield Checkpoint(utils.string_to_dto(earliest_time))
+
+    def _search_pipelined(self, search_string, earliest_time, latest_time,
+                          sizer, job_slots=None):
+        """The pipelined version of search
+
+        Rather than creating a blocking job for a window only once the window
+        before it has been read, the jobs for the next self.prefetch windows
+        are created asynchronously, so Splunk is searching them while we
+        process the current one. Prefetching never takes us over max_jobs or
+        over the search's job_slots; the current window always gets its job.
+        """
+
+        # The start of the next window that needs a job, or None once the
+        # last window has one
+        next_start = earliest_time
+        # (window, job) pairs, the current window first
+        pending = collections.deque()
+
+        try:
+            while next_start is not None or pending:
+                # Top up the pipeline
+                while next_start is not None and len(pending) <= self.prefetch:
+                    if not pending:
+                        if job_slots is not None:
+                            job_slots.acquire()
+                    elif (job_slots is not None and
+                            not job_slots.acquire(False)):
+                        break
+
+                    # Windows are sized on what we know so far, which may be
+                    # a window or two behind when prefetching
+                    if (utils.return_difference(next_start, latest_time) >
+                            sizer.size):
+                        window = (next_start,
+                                  utils.time_diff_string(next_start,
+                                                         sizer.size))
+                    else:
+                        window = (next_start, latest_time)
+                    try:
+                        # Only the current window waits for room for its job
+                        with metrics.timer("job"):
+                            job = self.job_manager.create(
+                                self.connection, search_string,
+                                block=not pending,
+                                earliest_time=window[0],
+                                latest_time=window[1],
+                                max_count=self.max_count)
+                    except Exception:
+                        if job_slots is not None:
+                            job_slots.release()
+                        raise
+                    if job is None:
+                        if job_slots is not None:
+                            job_slots.release()
+                        break
+                    pending.append((window, job))
+                    next_start = (window[1] if window[1] != latest_time
+                                  else None)
+
+                window, job = pending.popleft()
+                page = self._read_window(search_string, window, job, sizer,
+                                         job_slots)
+                try:
+                    for result in page:
+                        yield result
+                finally:
+                    page.close()
+
+                # The whole window has been consumed
+                yield Checkpoint(utils.string_to_dto(window[1]))
+        finally:
+            # If the consumer stopped early, don't leave jobs behind
+            for window, job in pending:
+                self.job_manager.cancel(job)
+                if job_slots is not None:
+                    job_slots.release()
+
+    def _search_export(self, search_string, earliest_time, latest_time,
+                       sizer, job_slots=None):
+        """The export version of search
+
+        Each window is streamed straight from the export endpoint as Splunk
+        finds the results, so there's no job to create, poll, page through
+        and cancel, and no max_events limit to re-run windows for. Windows
+        are still used so that we can checkpoint as we go.
+
+        Raises _ExportUnavailable if Splunk refuses the export, before
+        anything has been yielded for the window it refused
+        """
+
+        while True:
+            if (utils.return_difference(earliest_time, latest_time) >
+                    sizer.size):
+                search_time = utils.time_diff_string(earliest_time,
+                                                     sizer.size)
+            else:
+                search_time = latest_time
+
+            if job_slots is not None:
+                job_slots.acquire()
+            stream = None
+            count = 0
+            began = time.time()
+            # The results are sorted, so Splunk has done its searching by
+            # the time the first one arrives; after that the time is ours
+            duration = None
+            try:
+                try:
+                    with metrics.timer("job"):
+                        stream = self.connection.jobs.export(
+                            search_string,
+                            earliest_time=earliest_time,
+                            latest_time=search_time,
+                            search_mode="normal",
+                            **self._output_params())
+                except AttributeError as e:
+                    # A version of splunklib without export
+                    raise _ExportUnavailable(earliest_time, e)
+                except splunklib.binding.HTTPError as e:
+                    if e.status in (403, 404):
+                        raise _ExportUnavailable(earliest_time, e)
+                    raise
+
+                evts = self._reader(stream)
+                for result in metrics.timed(evts, "parse"):
+                    # Only the final results, not the previews along the way
+                    if evts.is_preview:
+                        continue
+                    if isinstance(result, dict):
+                        if duration is None:
+                            duration = time.time() - began
+                        count += 1
+                        metrics.count("rows_fetched")
+                    yield result
+            finally:
+                if stream is not None:
+                    stream.close()
+                if job_slots is not None:
+                    job_slots.release()
+
+            # Size the following windows on how this one went
+            if duration is None:
+                duration = time.time() - began
+            sizer.record(count,
+                         utils.return_difference(earliest_time, search_time),
+                         duration)
+
+            yield Checkpoint(utils.string_to_dto(search_time))
+            if search_time == latest_time:
+                return
+            earliest_time = search_time
+
+    def _output_params(self):
+        """Returns the parameters that ask Splunk for results in our
+        output_mode"""
+
+        if self.output_mode == "xml":
+            return {}
+        return {"output_mode": self.output_mode}
+
+    def _results(self, job, offset=0):
+        """Starts reading a page of the results of a finished job, from
+        offset
+
+        With json or csv only the fields that our searches table are asked
+        for, so nothing else is sent or parsed
+        """
+
+        params = self._output_params()
+        if params:
+            params["f"] = list(reader.FIELDS)
+        return job.results(count=self.page_size, offset=offset, **params)
+
+    def _read_pages(self, job, result_count):
+        """Yields all result_count results of a finished job, a page at a
+        time
+
+        Each page is read as it is parsed, so only a buffer's worth of it is
+        ever held in memory
+        """
+
+        offset = 0
+        while offset < result_count:
+            with metrics.timer("download"):
+                rs = self._results(job, offset)
+            read = 0
+            try:
+                for result in metrics.timed(self._reader(rs), "parse"):
+                    if isinstance(result, dict):
+                        read += 1
+                        metrics.count("rows_fetched")
+                    yield result
+            finally:
+                rs.close()
+
+            # Splunk may send fewer than we asked for, so carry on from
+            # wherever this page ended
+            if read == 0:
+                return
+            offset += read
+
+    def _reader(self, stream):
+        """Returns a reader that yields the results in a stream from
+        Splunk, as they are parsed"""
+
+        stream = io.BufferedReader(ResponseReaderWrapper(stream))
+        if self.output_mode == "json":
+            return reader.JSONReader(stream)
+        if self.output_mode == "csv":
+            return reader.CSVReader(stream)
+        return results.ResultsReader(stream)
+
+    def _read_window(self, search_string, window, job, sizer=None,
+                     job_slots=None):
+        """Waits for the job for a window to finish and yields its results
+
+        The job is read a page at a time. If it filled up with max_count
+        results, the rest of the window is searched again from the last
+        result, like search does. The job for that takes over the window's
+        slots rather than waiting for new ones, which the jobs prefetched
+        after this window may be holding. The last job is cancelled and its
+        slot released once it has been read.
+        """
+
+        earliest_time, latest_time = window
+        pages = None
+        try:
+            while True:
+                original_earliest_time = earliest_time
+                with metrics.timer("job"):
+                    while not job.is_done():
+                        time.sleep(POLL_INTERVAL)
+                result_count = int(job["resultCount"])
+                # Size the following windows on how this one went
+                if sizer is not None and earliest_time == window[0]:
+                    sizer.record(result_count,
+                                 utils.return_difference(window[0],
+                                                         window[1]),
+                                 float(job["runDuration"]))
+                pages = self._read_pages(job, result_count)
+                for result in pages:
+                    if isinstance(result, dict):
+                        earliest_time = result.get('start')
+                    yield result
+                pages.close()
+                pages = None
+
+                if result_count < self.max_count:
+                    return
+
+                # All of the events may have happened at the same time, in
+                # which case we have to skip ahead
+                if earliest_time == original_earliest_time:
+                    earliest_time = utils.time_diff_string(earliest_time, 60)
+                    if utils.return_difference(earliest_time,
+                                               latest_time) <= 0:
+                        return
+
+                # The old job is dealt with by replace, even if it fails
+                old_job, job = job, None
+                with metrics.timer("job"):
+                    job = self.job_manager.replace(
+                        self.connection, old_job, search_string,
+                        exec_mode="blocking",
+                        earliest_time=earliest_time,
+                        latest_time=latest_time,
+                        max_count=self.max_count)
+        finally:
+            if pages is not None:
+                pages.close()
+            if job is not None:
+                self.job_manager.cancel(job)
+            if job_slots is not None:
+                job_slots.release()
+
+
+class WindowSizer:
+    """Picks the length of the time windows that a search is cut into
+
+    Each window should come back with about target_fill of max_events
+    results. Quiet searches get longer windows, so that we don't run lots of
+    tiny jobs that are mostly overhead. Busy searches get shorter windows,
+    so that they don't go over max_events and need several pages. Jobs that
+    take longer than max_duration seconds also shrink the window. The size
+    always stays between min_window and max_window seconds.
+    """
+
+    def __init__(self, search, max_events, min_window=60, max_window=60,
+                 target_fill=0.5, max_duration=60):
+        self.search = search
+        self.max_events = max_events
+        self.min_window = min_window
+        self.max_window = max(max_window, min_window)
+        self.target_fill = target_fill
+        self.max_duration = max_duration
+        self.size = self._clamp(60)
+
+    def record(self, result_count, window, duration):
+        """Records how a job for a window of the given number of seconds did,
+        and works out the size of the next window"""
+
+        if window <= 0:
+            return
+
+        if result_count >= self.max_events:
+            # The window overflowed, so back off hard
+            size = window / 2.0
+        else:
+            # Aim for the target number of results at the rate we just saw,
+            # but don't let one quiet window blow the size up too far
+            rate = float(result_count) / window
+            if rate > 0:
+                size = self.target_fill * self.max_events / rate
+            else:
+                size = self.max_window
+            size = min(size, window * 2)
+
+        if duration > self.max_duration:
+            size = min(size, window * float(self.max_duration) / duration)
+
+        size = self._clamp(size)
+        logging.debug("Search {0}: {1} results in a {2}s window, job took "
+                      "{3:.1f}s, next window {4}s".format(
+                          self.search, result_count, window, duration, size))
+        if size != self.size:
+            logging.info("Search {0}: window size {1}s -> {2}s ({3} results "
+                         "in {4}s, job took {5:.1f}s)".format(
+                             self.search, self.size, size, result_count,
+                             window, duration))
+        self.size = size
+
+    def _clamp(self, size):
+        """Keeps a size within the configured limits"""
+        return int(max(self.min_window, min(self.max_window, size)))
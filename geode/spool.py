@@ -0,0 +1,287 @@
+"""An on-disk spool between fetching results from Splunk and writing them to
+Postgres
+
+Results are appended to the spool as they are fetched, and drained from it
+into the database separately, so fetching carries on while the database is
+slow or down. Anything that hasn't been drained when geode stops is drained
+when it next starts.
+
+The spool is a directory of segment files, each holding one JSON record per
+line, with a cursor file for how far it has been drained and a fetched file
+for how far each search has been spooled. Draining is at least once: if geode
+stops between writing to the database and moving the cursor on, the last
+results drained are written again, which correlation takes in its stride.
+
+If the database is down for long, the spool grows until max_size, after which
+fetching waits at each checkpoint for draining to catch up.
+"""
+from geode.reader import to_str
+import geode.metrics as metrics
+import geode.utils as utils
+
+import json
+import logging
+import os
+import threading
+
+# Segments are named with their number, padded so that they sort in order
+SEGMENT_FORMAT = "{0:010d}.seg"
+
+# The most results that are drained at once, when a window is bigger
+GROUP_SIZE = 10000
+
+
+class Spool:
+    """An append-only, segmented record of fetched results
+
+    Results and checkpoints for every search go into one sequence, in the
+    order they were fetched. A new segment is started once the current one
+    is segment_size bytes, and segments are deleted once they've been
+    drained. fsync is when appends are synced to disk: "always", at each
+    "checkpoint", or "never" (leaving it to the OS).
+
+    Once max_size bytes are waiting to be drained, checkpoint blocks until
+    draining brings it back under. Results are never held back part way
+    through a window, since a window is only drained once it has its
+    checkpoint, so one big window can take the spool past max_size. 0 lets
+    the spool grow without limit.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 fsync="checkpoint", max_size=0):
+        if fsync not in ("always", "checkpoint", "never"):
+            raise Exception("Unknown fsync policy {0}".format(fsync))
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Notified whenever something has been drained
+        self.drained = threading.Condition(self.lock)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # How far each search has been spooled, by name
+        self.fetched_times = {}
+        state = self._load("fetched")
+        if state is not None:
+            for s, time in state.items():
+                self.fetched_times[to_str(s)] = utils.string_to_dto(
+                    to_str(time))
+
+        # Carry on from the end of the last segment. A crash part way
+        # through a write can leave half a record at the end, which is cut
+        # off first
+        self.segment = max(self.segments() or [0])
+        path = self._path(self.segment)
+        if os.path.exists(path):
+            self._trim(path)
+        self.file = open(path, "ab")
+        self.size = os.path.getsize(path)
+
+        # How many bytes are waiting to be drained
+        self.pending = self._pending(self._load("cursor") or [0, 0])
+
+    def append(self, search, result):
+        """Adds a result from search to the end of the spool"""
+
+        self._write({"s": search, "r": result}, False)
+        metrics.count("rows_spooled")
+
+    def checkpoint(self, search, time):
+        """Records that search has been fetched up to time (a datetime)"""
+
+        self._write({"s": search, "c": utils.dto_to_string(time)}, True)
+        with self.lock:
+            self.fetched_times[search] = time
+            self._save("fetched", dict(
+                (s, utils.dto_to_string(t))
+                for s, t in self.fetched_times.items()))
+
+            # Everything up to here can be drained now, so this is where we
+            # wait for it to be
+            if self.max_size and self.pending >= self.max_size:
+                logging.warning("The spool has {0} bytes waiting to be "
+                                "drained, so fetching is waiting for "
+                                "it".format(self.pending))
+                while self.pending >= self.max_size:
+                    self.drained.wait(60)
+
+    def fetched(self, search):
+        """Returns how far search has been spooled, or None"""
+
+        with self.lock:
+            return self.fetched_times.get(search)
+
+    def groups(self):
+        """Yields what has been spooled but not drained, as (search,
+        results, time, position) for a search's results up to a checkpoint
+
+        time is the checkpoint, or None if the group was cut short because
+        it hit GROUP_SIZE. Whatever comes after the last checkpoint is left
+        until it has one. Once a group has been written to the database,
+        pass its position to commit
+        """
+
+        cursor = self._load("cursor") or [0, 0]
+        segments = [n for n in self.segments() if n >= cursor[0]]
+
+        search = None
+        group = []
+        for n in segments:
+            offset = cursor[1] if n == cursor[0] else 0
+            with open(self._path(n), "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    # The rest of this record hasn't been written yet
+                    if not line.endswith("\n"):
+                        return
+                    record = json.loads(line)
+                    s = to_str(record["s"])
+
+                    # A group only ever holds one search
+                    if group and s != search:
+                        yield search, group, None, (n, offset)
+                        group = []
+                    search = s
+                    offset += len(line)
+
+                    if "c" in record:
+                        time = utils.string_to_dto(to_str(record["c"]))
+                        yield search, group, time, (n, offset)
+                        group = []
+                        continue
+
+                    group.append(to_str(record["r"]))
+                    if len(group) >= GROUP_SIZE:
+                        yield search, group, None, (n, offset)
+                        group = []
+
+    def commit(self, position):
+        """Records that everything up to position has been drained, and
+        deletes the segments before it"""
+
+        self._save("cursor", list(position))
+        for n in self.segments():
+            if n < position[0]:
+                os.remove(self._path(n))
+
+        with self.lock:
+            # What is still buffered counts too
+            if not self.file.closed:
+                self.file.flush()
+            self.pending = self._pending(position)
+            self.drained.notify_all()
+
+    def segments(self):
+        """Returns the numbers of the segments, in order"""
+
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".seg"):
+                try:
+                    numbers.append(int(name[:-4]))
+                except ValueError:
+                    continue
+        return sorted(numbers)
+
+    def close(self):
+        with self.lock:
+            self._sync(True)
+            self.file.close()
+
+    def _write(self, record, checkpoint):
+        """Appends a record, starting a new segment if this one is full"""
+
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.size += len(line)
+            self.pending += len(line)
+            # Readers only see what has been flushed
+            if checkpoint or self.fsync == "always":
+                self._sync(checkpoint)
+
+            if self.size >= self.segment_size:
+                # Everything in this segment is flushed before the next one
+                # exists, so a reader that finds the next one has all of
+                # this one
+                self._sync(True)
+                self.file.close()
+                self.segment += 1
+                self.file = open(self._path(self.segment), "ab")
+                self.size = 0
+
+    def _sync(self, checkpoint):
+        """Flushes the segment, and syncs it as the fsync policy says"""
+
+        self.file.flush()
+        if (self.fsync == "always" or
+                (checkpoint and self.fsync == "checkpoint")):
+            os.fsync(self.file.fileno())
+
+    def _trim(self, path):
+        """Cuts off a half written record at the end of a segment"""
+
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = data.rfind("\n") + 1
+            if end < len(data):
+                logging.warning("Dropping {0} bytes of a partly written "
+                                "record from {1}".format(len(data) - end,
+                                                         path))
+                f.truncate(end)
+
+    def _pending(self, cursor):
+        """Returns how many bytes of the segments come after cursor"""
+
+        pending = 0
+        for n in self.segments():
+            if n > cursor[0]:
+                pending += os.path.getsize(self._path(n))
+            elif n == cursor[0]:
+                pending += max(os.path.getsize(self._path(n)) - cursor[1], 0)
+        return pending
+
+    def _path(self, n):
+        return os.path.join(self.directory, SEGMENT_FORMAT.format(n))
+
+    def _load(self, name):
+        """Returns the contents of a state file, or None"""
+
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def _save(self, name, value):
+        """Replaces a state file, so that it is always either the old
+        contents or the new"""
+
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(value, f)
+            f.flush()
+            if self.fsync != "never":
+                os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+
+
+def configure(path="/etc/geode/settings.conf"):
+    """Returns a Spool as the Spool section of the config sets it up, or
+    None if it doesn't set a directory"""
+
+    directory = utils.read_config("Spool", "directory", default=None,
+                                  path=path)
+    if not directory:
+        return None
+    return Spool(directory,
+                 int(utils.read_config("Spool", "segment_size",
+                                       default=64 * 1024 * 1024, path=path)),
+                 utils.read_config("Spool", "fsync", default="checkpoint",
+                                   path=path),
+                 int(utils.read_config("Spool", "max_size", default=0,
+                                       path=path)))
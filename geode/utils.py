@@ -1,7 +1,22 @@
+from geode.config import get_config
+
 import datetime
-from ConfigParser import SafeConfigParser as SCP
 import time
 
+# Used to tell read_config that no default value was given
+_NO_DEFAULT = object()
+
+# The format that times are written in everywhere: Splunk results, the
+# config file and our queries
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Events arrive in bursts that share the same second, so we remember the
+# times we have converted recently. The memos are emptied once they get
+# this big
+MEMO_SIZE = 10000
+_parsed = {}
+_formatted = {}
+
 
 def now():
     """Get the current time (in UTC to avoid daylight savings issues)"""
@@ -19,12 +34,10 @@ def time_diff_string(d_string, duration):
     Returns a string of the new datetime
     """
 
-    new_dt_dto = (datetime.datetime.strptime(d_string, "%Y-%m-%dT%H:%M:%S")
+    new_dt_dto = (string_to_dto(d_string)
                   + datetime.timedelta(seconds=int(duration)))
-    new_dt_string = datetime.datetime.strftime(new_dt_dto,
-                                               "%Y-%m-%dT%H:%M:%S")
 
-    return new_dt_string
+    return dto_to_string(new_dt_dto)
 
 
 def return_difference(earliest_time, latest_time):
@@ -44,23 +57,73 @@ def string_to_dto(dt_string):
     And have some control of the format in case we need to change it
     Then we can just change it here rather than all over our code
 
+    Rather than going through strptime, the fields are sliced out of their
+    fixed positions in TIME_FORMAT, and recent results are remembered
     """
 
-    dt_dto = datetime.datetime.strptime(dt_string, "%Y-%m-%dT%H:%M:%S")
+    dt_dto = _parsed.get(dt_string)
+    if dt_dto is not None:
+        return dt_dto
+
+    # YYYY-MM-DDTHH:MM:SS; anything else gets strptime's error for it
+    if (len(dt_string) == 19 and dt_string[4] == '-' and
+            dt_string[7] == '-' and dt_string[10] == 'T' and
+            dt_string[13] == ':' and dt_string[16] == ':'):
+        try:
+            dt_dto = datetime.datetime(int(dt_string[0:4]),
+                                       int(dt_string[5:7]),
+                                       int(dt_string[8:10]),
+                                       int(dt_string[11:13]),
+                                       int(dt_string[14:16]),
+                                       int(dt_string[17:19]))
+        except ValueError:
+            dt_dto = None
+    if dt_dto is None:
+        dt_dto = datetime.datetime.strptime(dt_string, TIME_FORMAT)
+
+    if len(_parsed) >= MEMO_SIZE:
+        _parsed.clear()
+    _parsed[dt_string] = dt_dto
+
     return dt_dto
 
 
 def dto_to_string(dto):
     """Converts a datetime object to a string"""
-    return dto.strftime("%Y-%m-%dT%H:%M:%S")
 
+    dt_string = _formatted.get(dto)
+    if dt_string is not None:
+        return dt_string
+
+    dt_string = "%04d-%02d-%02dT%02d:%02d:%02d" % (dto.year, dto.month,
+                                                   dto.day, dto.hour,
+                                                   dto.minute, dto.second)
+
+    if len(_formatted) >= MEMO_SIZE:
+        _formatted.clear()
+    _formatted[dto] = dt_string
+
+    return dt_string
+
+
+def mac_key(mac):
+    """Normalizes a MAC address the way Postgres' macaddr compares them,
+    for the formats that we get from Splunk"""
+    return mac.lower().replace('-', ':')
+
+
+def read_config(section, tag, raw=False, path="/etc/geode/settings.conf",
+                default=_NO_DEFAULT):
+    """Reads the specified section from the configuration file
+
+    If a default is given, it is returned when the section or tag is missing
+    """
+    config = get_config(path)
 
-def read_config(section, tag, raw=False, path="/etc/geode/settings.conf"):
-    """Reads the specified section from the configuration file"""
-    parser = SCP()
-    parser.read(path)
+    if default is not _NO_DEFAULT and not config.has(section, tag):
+        return default
 
-    return parser.get(section, tag, raw=raw)
+    return config.get(section, tag, raw=raw)
 
 
 def update_config(section, tag, text, path="/etc/geode/settings.conf"):
@@ -69,19 +132,14 @@ def update_config(section, tag, text, path="/etc/geode/settings.conf"):
         text = ""
     if type(text) is datetime.datetime:
         text = dto_to_string(text)
-    parser = SCP()
-    parser.read(path)
-    parser.set(section, tag, text)
-    with open(path, 'wb') as c:
-        parser.write(c)
+    get_config(path).set(section, tag, text)
 
 
 def get_search_names(path="/etc/geode/settings.conf", raw=False):
     """Gets all of the search in the config file"""
-    parser = SCP()
-    parser.read(path)
+    config = get_config(path)
 
-    return [search[0] for search in parser.items("Searches", raw=raw)]
+    return [search[0] for search in config.items("Searches", raw=raw)]
 
 
 def wait(amount=60):
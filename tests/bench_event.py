@@ -0,0 +1,133 @@
+"""This file is for comparing the memory use and speed of Event against the
+dict based event that it replaced"""
+
+import copy
+import datetime
+import sys
+import time
+
+from geode.event import Event
+
+
+class LegacyEvent(dict):
+    """The dict based Event, with event types kept as a set of strings"""
+
+    def __init__(self, d):
+        if d.get('start') is None:
+            raise Exception("No start time")
+        for k in d.keys():
+            if (k == 'start' or k == 'stop') and (type(d[k]) == str):
+                self[k] = datetime.datetime.strptime(d[k], '%Y-%m-%dT%H:%M:%S')
+            elif k == 'event_type':
+                if type(d[k]) == list:
+                    self[k] = set([Event.types_reverse.get(x)
+                                  if type(x) == int else x for x in d[k]])
+                elif type(d[k]) == int:
+                    self[k] = set([Event.types_reverse.get(d[k])])
+                else:
+                    self[k] = set([d[k]])
+            elif d[k] == '':
+                pass
+            else:
+                self[k] = copy.deepcopy(d[k])
+        if self.get('stop') is None:
+            self['stop'] = self.get('start') + datetime.timedelta(seconds=30)
+
+    def matches(self, e):
+        keys = self.keys()
+        for k in ('id', 'event_type', 'useragent', 'os', 'stop'):
+            if k in keys:
+                keys.remove(k)
+        for key in keys:
+            if key == 'start':
+                if not self._does_overlap(e):
+                    return False
+            elif (e.get(key) is not None and
+                  e.get(key) is not '' and
+                  self.get(key) is not None and
+                  self.get(key) is not '' and
+                  self.get(key) != e.get(key)):
+                return False
+        return True
+
+    def merge(self, e):
+        tmp = copy.deepcopy(self)
+        tmp['start'] = min(self.get('start'), e.get('start'))
+        tmp['stop'] = max(self.get('stop'), e.get('stop'))
+        keys = e.keys()
+        for k in ('start', 'stop', 'event_type'):
+            if k in keys:
+                keys.remove(k)
+        tmp['event_type'] |= e.get('event_type')
+        for k in keys:
+            tmp[k] = e[k]
+        return tmp
+
+    def _does_overlap(self, e):
+        return ((self.get('start') <= e.get('start') <= self.get('stop') and
+                 self.get('stop') >= e.get('stop') >= self.get('start')) or
+                (self.get('start') >= e.get('start') and
+                 self.get('stop') >= e.get('stop') >= e.get('start')) or
+                (self.get('start') <= e.get('start') <= self.get('stop') and
+                 self.get('stop') <= e.get('stop')) or
+                (self.get('start') >= e.get('start') and
+                 self.get('stop') <= e.get('stop')))
+
+
+def footprint(e):
+    """Returns the bytes used by an event and its containers, leaving out
+    the values themselves, which are the same for both classes"""
+
+    size = sys.getsizeof(e)
+    if isinstance(e, Event):
+        if e.extra is not None:
+            size += sys.getsizeof(e.extra)
+    elif e.get('event_type') is not None:
+        size += sys.getsizeof(e.get('event_type'))
+    return size
+
+
+def timed(label, f, n):
+    """Runs f n times and prints how long each run took on average"""
+
+    begin = time.time()
+    for i in range(n):
+        f()
+    end = time.time()
+    print("%-28s %.2f us" % (label, (end - begin) / n * 1000000))
+
+
+def main():
+    # A DHCP event from Splunk and the session it lands on from Postgres
+    splunk = {'start': '2018-01-16T13:36:16',
+              'stop': '2018-01-16T13:56:16',
+              'mac': 'aa:bb:cc:dd:ee:ff',
+              'ip': '10.0.0.1',
+              'hostname': 'laptop',
+              'event_type': 'DHCPACK'}
+    postgres = {'id': 1,
+                'start': datetime.datetime(2018, 1, 16, 13, 30, 0),
+                'stop': datetime.datetime(2018, 1, 16, 13, 50, 0),
+                'mac': 'aa:bb:cc:dd:ee:ff',
+                'ip': '10.0.0.1',
+                'netid': 'abc12345',
+                'hostname': 'laptop',
+                'useragent': None,
+                'os': None,
+                'event_type': [1, 6]}
+    n = 100000
+
+    for cls in (LegacyEvent, Event):
+        print(cls.__name__)
+        e = cls(splunk)
+        s = cls(postgres)
+        print("%-28s %d bytes" % ("size from Splunk", footprint(e)))
+        print("%-28s %d bytes" % ("size from Postgres", footprint(s)))
+        timed("construct from Splunk", lambda: cls(splunk), n)
+        timed("construct from Postgres", lambda: cls(postgres), n)
+        timed("matches", lambda: s.matches(e), n)
+        timed("merge", lambda: s.merge(e), n)
+
+
+if __name__ == "__main__":
+    main()
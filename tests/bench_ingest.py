@@ -0,0 +1,144 @@
+"""This file is for measuring ingest end to end: synthetic Splunk results are
+run through Geode.process_results into a throwaway local Postgres, and we
+report events per second, per event latency and statements per event
+
+It needs the PostgreSQL server binaries (initdb and pg_ctl) on the PATH, or
+in the directory given with --pg-bin. Nothing outside of a temporary
+directory is touched, and the cluster is removed again at the end.
+"""
+
+import argparse
+import os
+import time
+
+from geode.database import Database
+from geode.main import Geode
+from geode.splunk import Checkpoint
+import geode.utils as utils
+from tests.fixtures import Postgres, SEARCHES, generate
+
+# Splunk hands back results a page at a time, with a checkpoint after each
+PAGE_SIZE = 1000
+
+
+class CountingCursor:
+    """Passes everything through to a cursor, counting the statements"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statements = 0
+
+    def execute(self, *args, **kwargs):
+        self.statements += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def stream(results, timings):
+    """Yields results the way Splunk.search does, with a Checkpoint after
+    each page, and records when each event was asked for"""
+
+    for i, r in enumerate(results):
+        timings.append(time.time())
+        # A fresh dict each time, like ResultsReader gives us
+        yield dict(r)
+        if (i + 1) % PAGE_SIZE == 0:
+            yield Checkpoint(utils.string_to_dto(r['start']))
+    timings.append(time.time())
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of sorted values"""
+
+    if not values:
+        return 0
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def run(postgres, results, batch_size, cache_size, log_file,
+        correlate="python"):
+    """Runs every search through process_results, printing a line for each"""
+
+    postgres.reset()
+    config_file = postgres.write_config(cache_size, correlate)
+
+    geode = Geode(log_file=log_file)
+    geode.database = Database(config_file=config_file, log_file=log_file)
+    geode.database.cursor = CountingCursor(geode.database.cursor)
+    geode.dhcp_search = 'dhcp'
+    geode.batch_size = batch_size
+    geode.flush_interval = 5
+
+    mode = "batch %d" % batch_size if batch_size > 1 else "per event"
+    if cache_size:
+        mode += ", cache %d" % cache_size
+    if correlate == "server":
+        mode += ", server"
+
+    total_events = 0
+    total_seconds = 0
+    for s, _ in SEARCHES:
+        timings = []
+        statements = geode.database.cursor.statements
+        begin = time.time()
+        geode.process_results(stream(results[s], timings), s)
+        seconds = time.time() - begin
+        statements = geode.database.cursor.statements - statements
+
+        n = len(results[s])
+        latencies = sorted(b - a for a, b in zip(timings, timings[1:]))
+        print("%-22s %-9s %7d events %9.0f/s  p50 %6.3f  p90 %6.3f  "
+              "p99 %7.3f  max %8.3f ms  %5.2f statements/event" % (
+                  mode, s, n, n / seconds,
+                  percentile(latencies, 50) * 1000,
+                  percentile(latencies, 90) * 1000,
+                  percentile(latencies, 99) * 1000,
+                  (latencies[-1] if latencies else 0) * 1000,
+                  float(statements) / max(n, 1)))
+        total_events += n
+        total_seconds += seconds
+
+    geode.database.cursor.execute("SELECT count(*) AS n FROM sediment;")
+    rows = geode.database.cursor.fetchone()['n']
+    print("%-22s %-9s %7d events %9.0f/s  %d sessions" % (
+        mode, "total", total_events, total_events / total_seconds, rows))
+    geode.database.database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", type=int, default=50000,
+                        help="results across all of the searches")
+    parser.add_argument("--macs", type=int, default=2000,
+                        help="distinct devices")
+    parser.add_argument("--ips", type=int, default=1500,
+                        help="size of the DHCP address pool")
+    parser.add_argument("--churn", type=float, default=0.1,
+                        help="chance that a DHCP event moves a device")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="batch size for the batched run")
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="session cache size for the cached runs")
+    parser.add_argument("--pg-bin", default=None,
+                        help="directory with initdb and pg_ctl")
+    args = parser.parse_args()
+
+    results = generate(args.events, args.macs, args.ips, args.churn)
+
+    postgres = Postgres(args.pg_bin)
+    postgres.start()
+    try:
+        log_file = os.path.join(postgres.directory, "geode.log")
+        for batch_size, cache_size in [(1, 0), (1, args.cache_size),
+                                       (args.batch_size, 0),
+                                       (args.batch_size, args.cache_size)]:
+            run(postgres, results, batch_size, cache_size, log_file)
+        run(postgres, results, args.batch_size, 0, log_file, "server")
+    finally:
+        postgres.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""This file is for comparing how long Database.select takes with the plain
+schema (b-tree indexes and ORed comparisons) and the range schema (GiST
+indexes and &&), as sediment grows
+
+Like bench_ingest.py, it runs against a throwaway local Postgres
+"""
+
+import argparse
+import datetime
+import os
+import random
+import time
+
+from geode.database import Database, RANGE_SCHEMA
+from geode.event import Event
+from tests.bench_ingest import percentile
+from tests.fixtures import Postgres
+
+# How many sessions each device has, on average
+SESSIONS_PER_DEVICE = 50
+
+# The first session starts here, and each one starts this long after the last
+BEGIN = datetime.datetime(2018, 1, 1)
+STEP = 10
+
+
+def fill(cursor, size):
+    """Fills sediment with size sessions, spread over size / 50 devices,
+    each of which has its own MAC and IP"""
+
+    devices = max(size // SESSIONS_PER_DEVICE, 1)
+    cursor.execute(
+        """INSERT INTO sediment(mac, ip, netid, start, stop, event_type)
+           SELECT lpad(to_hex(g %% %s), 12, '0')::macaddr,
+                  '10.0.0.0'::inet + (g %% %s),
+                  'user' || (g %% %s),
+                  %s::timestamp + g * %s * interval '1 second',
+                  %s::timestamp + g * %s * interval '1 second'
+                                + interval '20 minutes',
+                  ARRAY[1]::smallint[]
+           FROM generate_series(1, %s) AS g;""",
+        (devices, devices, devices, BEGIN, STEP, BEGIN, STEP, size))
+    cursor.execute("ANALYZE sediment;")
+    return devices
+
+
+def lookups(size, devices, count, seed=0):
+    """Makes count events to look up, half by MAC and half by IP"""
+
+    rand = random.Random(seed)
+    events = []
+    for i in range(count):
+        device = rand.randrange(devices)
+        start = BEGIN + datetime.timedelta(
+            seconds=rand.randrange(size) * STEP)
+        if i % 2 == 0:
+            mac = ("%012x" % device)
+            events.append(Event({'mac': ':'.join(mac[j:j + 2]
+                                                 for j in range(0, 12, 2)),
+                                 'start': start}))
+        else:
+            events.append(Event({'ip': '10.0.%d.%d' % (device >> 8 & 255,
+                                                       device & 255),
+                                 'start': start}))
+    return events
+
+
+def timed_selects(database, events):
+    """Returns how long each select took, sorted"""
+
+    latencies = []
+    for e in events:
+        begin = time.time()
+        database.select(e)
+        latencies.append(time.time() - begin)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated sediment sizes")
+    parser.add_argument("--lookups", type=int, default=2000,
+                        help="selects to time for each size and schema")
+    parser.add_argument("--pg-bin", default=None,
+                        help="directory with initdb and pg_ctl")
+    args = parser.parse_args()
+
+    postgres = Postgres(args.pg_bin)
+    postgres.start()
+    try:
+        log_file = os.path.join(postgres.directory, "geode.log")
+        for size in [int(s) for s in args.sizes.split(",")]:
+            postgres.reset()
+            database = Database(config_file=postgres.write_config(0),
+                                log_file=log_file)
+            cursor = database.cursor
+            cursor.execute("DROP INDEX IF EXISTS sediment_mac_period_idx, "
+                           "sediment_ip_period_idx;")
+            devices = fill(cursor, size)
+            events = lookups(size, devices, args.lookups)
+
+            # Warm up, then time the plain schema
+            timed_selects(database, events[:100])
+            plain = timed_selects(database, events)
+
+            # Swap the b-tree indexes for the range schema's GiST indexes
+            cursor.execute(RANGE_SCHEMA)
+            cursor.execute("DROP INDEX sediment_mac_idx, sediment_ip_idx;")
+            cursor.execute("ANALYZE sediment;")
+            database.database.close()
+            database = Database(config_file=postgres.write_config(
+                0, schema="range"), log_file=log_file)
+            timed_selects(database, events[:100])
+            ranged = timed_selects(database, events)
+            database.database.close()
+
+            for name, latencies in [("plain", plain), ("range", ranged)]:
+                print("%9d sessions  %-5s  mean %7.3f  p50 %7.3f  "
+                      "p99 %7.3f ms" % (
+                          size, name,
+                          sum(latencies) / len(latencies) * 1000,
+                          percentile(latencies, 50) * 1000,
+                          percentile(latencies, 99) * 1000))
+    finally:
+        postgres.stop()
+
+
+if __name__ == "__main__":
+    main()
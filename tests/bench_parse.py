@@ -0,0 +1,73 @@
+"""This file is for comparing how fast results are parsed from each of
+Splunk's output modes: XML with splunklib's ResultsReader, and JSON and CSV
+with the readers in geode.reader, on canned responses holding the same
+results"""
+
+import io
+import json
+import time
+
+import splunklib.results as results
+
+from geode import reader
+from geode.splunk import ResponseReaderWrapper
+from tests.bench_readinto import CannedResponse, RESULT
+
+# How many results are in each canned response
+RESULTS = 20000
+
+# The values that RESULT holds, as the other modes send them
+ROW = {'start': '2018-01-16T13:36:16', 'stop': '2018-01-16T13:56:16',
+       'mac': 'aa:bb:cc:dd:ee:ff', 'ip': '10.0.0.1', 'hostname': 'laptop',
+       'event_type': 'DHCPACK'}
+
+
+def xml_response():
+    """Returns a canned response from the results endpoint in XML"""
+
+    return (b"<?xml version='1.0' encoding='UTF-8'?>\n<results preview='0'>\n"
+            b"<meta><fieldOrder><field>start</field></fieldOrder></meta>\n" +
+            b"".join([RESULT % i for i in range(RESULTS)]) + b"</results>\n")
+
+
+def json_response():
+    """Returns a canned response from the results endpoint in JSON"""
+
+    return json.dumps({'preview': False, 'init_offset': 0, 'messages': [],
+                       'fields': [{'name': f} for f in reader.FIELDS],
+                       'results': [ROW] * RESULTS})
+
+
+def csv_response():
+    """Returns a canned response from the results endpoint in CSV"""
+
+    lines = [",".join(reader.FIELDS)]
+    row = ",".join(ROW.get(f, '') for f in reader.FIELDS)
+    lines.extend([row] * RESULTS)
+    return "\n".join(lines) + "\n"
+
+
+def throughput(read, data):
+    """Parses the data with read and returns results/s"""
+
+    begin = time.time()
+    parsed = 0
+    for r in read(io.BufferedReader(
+            ResponseReaderWrapper(CannedResponse(data)))):
+        if isinstance(r, dict):
+            parsed += 1
+    end = time.time()
+    assert parsed == RESULTS
+    return parsed / (end - begin)
+
+
+def main():
+    for name, read, data in [("xml", results.ResultsReader, xml_response()),
+                             ("json", reader.JSONReader, json_response()),
+                             ("csv", reader.CSVReader, csv_response())]:
+        print("%-4s  %5.1f MB  %9.0f results/s" % (
+            name, len(data) / (1024.0 * 1024.0), throughput(read, data)))
+
+
+if __name__ == "__main__":
+    main()
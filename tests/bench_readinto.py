@@ -0,0 +1,66 @@
+"""This file is for comparing the throughput of ResponseReaderWrapper against
+the byte at a time readinto that it replaced, on a canned Splunk response"""
+
+import io
+import time
+
+from geode.splunk import ResponseReaderWrapper
+
+# Roughly what a page of DHCP results looks like in Splunk's XML output
+RESULT = b"""<result offset='%d'>
+<field k='start'><value><text>2018-01-16T13:36:16</text></value></field>
+<field k='stop'><value><text>2018-01-16T13:56:16</text></value></field>
+<field k='mac'><value><text>aa:bb:cc:dd:ee:ff</text></value></field>
+<field k='ip'><value><text>10.0.0.1</text></value></field>
+<field k='hostname'><value><text>laptop</text></value></field>
+<field k='event_type'><value><text>DHCPACK</text></value></field>
+</result>
+"""
+
+
+class CannedResponse:
+    """Stands in for splunklib's ResponseReader, which only offers read"""
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, size=None):
+        return self._stream.read(size)
+
+    def close(self):
+        self._stream.close()
+
+
+class LegacyWrapper(ResponseReaderWrapper):
+    """The original readinto, which copied every byte in Python"""
+
+    def readinto(self, b):
+        size = len(b)
+        data = self.responseReader.read(size)
+        for idx, ch in enumerate(data):
+            b[idx] = ch
+
+        return len(data)
+
+
+def throughput(wrapper, data):
+    """Streams the data through the wrapper and returns MB/s"""
+
+    begin = time.time()
+    reader = io.BufferedReader(wrapper(CannedResponse(data)))
+    while reader.read(8192):
+        pass
+    end = time.time()
+    return len(data) / (1024.0 * 1024.0) / (end - begin)
+
+
+def main():
+    data = b"".join([RESULT % i for i in range(20000)])
+    print("%.1f MB canned response" % (len(data) / (1024.0 * 1024.0)))
+    print("legacy readinto:  %.1f MB/s" % throughput(LegacyWrapper, data))
+    print("current readinto: %.1f MB/s" % throughput(ResponseReaderWrapper,
+                                                     data))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""This file is for comparing the time codec in geode.utils against strptime
+and strftime, on a stream of times like the ones we get from Splunk"""
+
+import datetime
+import time
+
+import geode.utils as utils
+
+
+def timed(label, f, values):
+    """Runs f over the values and prints how long each call took"""
+
+    begin = time.time()
+    for v in values:
+        f(v)
+    end = time.time()
+    print("%-24s %.3f us" % (label, (end - begin) / len(values) * 1000000))
+
+
+def main():
+    # A minute of results, a couple of hundred per second
+    start = datetime.datetime(2018, 1, 16, 13, 36, 0)
+    dtos = [start + datetime.timedelta(seconds=i // 200)
+            for i in range(200 * 60)] * 10
+    strings = [d.strftime(utils.TIME_FORMAT) for d in dtos]
+
+    timed("strptime", lambda s: datetime.datetime.strptime(
+        s, utils.TIME_FORMAT), strings)
+    timed("string_to_dto", utils.string_to_dto, strings)
+    timed("strftime", lambda d: d.strftime(utils.TIME_FORMAT), dtos)
+    timed("dto_to_string", utils.dto_to_string, dtos)
+
+    # Without any repeats, so the memos never help
+    unique = [start + datetime.timedelta(seconds=i) for i in range(100000)]
+    unique_strings = [d.strftime(utils.TIME_FORMAT) for d in unique]
+    timed("strptime (unique)", lambda s: datetime.datetime.strptime(
+        s, utils.TIME_FORMAT), unique_strings)
+    timed("string_to_dto (unique)", utils.string_to_dto, unique_strings)
+    timed("strftime (unique)", lambda d: d.strftime(utils.TIME_FORMAT),
+          unique)
+    timed("dto_to_string (unique)", utils.dto_to_string, unique)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Fixtures shared by the tests and benchmarks that run against Postgres: a
+throwaway local cluster, and synthetic Splunk results to feed it
+
+The cluster needs the PostgreSQL server binaries (initdb and pg_ctl) on the
+PATH, or in the directory given as pg_bin. Nothing outside of a temporary
+directory is touched, and the cluster is removed again when it stops.
+"""
+
+import datetime
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+import psycopg2
+
+from geode.database import SCHEMA, RANGE_SCHEMA
+import geode.utils as utils
+
+# The searches, in the order that geode runs them, and how often each of
+# them shows up in the results
+SEARCHES = [('dhcp', 0.25), ('wireless', 0.25), ('cas', 0.2),
+            ('access', 0.3)]
+
+
+class Postgres:
+    """A Postgres cluster in a temporary directory, for as long as it runs"""
+
+    def __init__(self, pg_bin=None):
+        self.pg_bin = pg_bin
+        self.directory = tempfile.mkdtemp(prefix="geode-bench-")
+        self.data = os.path.join(self.directory, "data")
+        self.configs = 0
+
+    def _command(self, name):
+        return os.path.join(self.pg_bin, name) if self.pg_bin else name
+
+    def start(self):
+        """Creates the cluster and starts it, listening on a socket only"""
+
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call([self._command("initdb"), "-D", self.data,
+                                   "-U", "geode", "-A", "trust"],
+                                  stdout=null, stderr=null)
+            subprocess.check_call([self._command("pg_ctl"), "-D", self.data,
+                                   "-l", os.path.join(self.directory,
+                                                      "postgres.log"),
+                                   "-o", "-k %s -c listen_addresses='' -F" %
+                                   self.directory, "-w", "start"],
+                                  stdout=null, stderr=null)
+
+    def stop(self):
+        """Stops the cluster and removes everything it wrote"""
+
+        with open(os.devnull, 'w') as null:
+            subprocess.call([self._command("pg_ctl"), "-D", self.data,
+                             "-m", "immediate", "-w", "stop"],
+                            stdout=null, stderr=null)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_config(self, cache_size, correlate="python", schema="plain",
+                     shards=0):
+        """Writes a settings file for Database that points at this cluster
+
+        Each one gets a new name, since the config is cached per path
+        """
+
+        self.configs += 1
+        path = os.path.join(self.directory, "settings%d.conf" % self.configs)
+        with open(path, 'w') as c:
+            c.write("[database]\n"
+                    "username = geode\n"
+                    "password = \n"
+                    "host = %s\n"
+                    "database = postgres\n"
+                    "\n"
+                    "[Geode]\n"
+                    "cache_size = %d\n"
+                    "correlate = %s\n"
+                    "schema = %s\n"
+                    "shards = %d\n" % (self.directory, cache_size,
+                                        correlate, schema, shards))
+        return path
+
+    def reset(self, schema="plain"):
+        """Creates the schema, emptying it if it is already there. The range
+        schema's indexes are added on top for schema="range"
+        """
+
+        conn = psycopg2.connect(user="geode", host=self.directory,
+                                database="postgres")
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute(SCHEMA)
+        if schema == "range":
+            cursor.execute(RANGE_SCHEMA)
+        cursor.execute("""CREATE TABLE IF NOT EXISTS checkpoint(
+                              search text PRIMARY KEY,
+                              earliest_time timestamp NOT NULL);""")
+        cursor.execute("TRUNCATE sediment, checkpoint RESTART IDENTITY;")
+        conn.close()
+
+
+def generate(events, macs, ips, churn, seed=0):
+    """Makes a day of synthetic results for each search
+
+    There are macs devices, each with a netid, sharing a pool of ips
+    addresses. DHCP hands out ACKs (and now and again an EXPIRE), moving a
+    device to a new address with probability churn. The identity searches
+    see whichever address the device has at the time
+
+    Returns a dict of the results for each search, sorted by start time
+    """
+
+    rand = random.Random(seed)
+    begin = datetime.datetime(2018, 1, 16)
+    step = 24 * 60 * 60.0 / events
+
+    devices = [{'mac': ':'.join('%02x' % rand.randint(0, 255)
+                                for _ in range(6)),
+                'netid': 'user%05d' % i,
+                'hostname': 'host%05d' % i,
+                'ip': None}
+               for i in range(macs)]
+    pool = ['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+            for i in range(ips)]
+
+    names = [s for s, _ in SEARCHES]
+    weights = [w for _, w in SEARCHES]
+    results = dict((s, []) for s in names)
+
+    for i in range(events):
+        start = begin + datetime.timedelta(seconds=int(i * step))
+        start_string = utils.dto_to_string(start)
+        device = rand.choice(devices)
+
+        # Every device gets an address before it shows up anywhere else
+        s = 'dhcp' if device['ip'] is None else _pick(rand, names, weights)
+
+        if s == 'dhcp':
+            if device['ip'] is None or rand.random() < churn:
+                device['ip'] = rand.choice(pool)
+            event_type = 'DHCPEXPIRE' if rand.random() < 0.05 else 'DHCPACK'
+            results[s].append({
+                'start': start_string,
+                'stop': utils.time_diff_string(start_string, 1200),
+                'mac': device['mac'],
+                'ip': device['ip'],
+                'hostname': device['hostname'],
+                'event_type': event_type})
+        elif s == 'wireless':
+            results[s].append({
+                'start': start_string,
+                'mac': device['mac'],
+                'netid': device['netid'],
+                'event_type': 'wireless_authentication'})
+        elif s == 'cas':
+            results[s].append({
+                'start': start_string,
+                'ip': device['ip'],
+                'netid': device['netid'],
+                'event_type': 'cas:prod'})
+        else:
+            results[s].append({
+                'start': start_string,
+                'ip': device['ip'],
+                'netid': device['netid'],
+                'useragent': 'Mozilla/5.0 (bench %d)' % (i % 50),
+                'event_type': 'access_combined'})
+
+    return results
+
+
+def _pick(rand, names, weights):
+    """Picks one of names with the given weights"""
+
+    x = rand.random() * sum(weights)
+    for name, weight in zip(names, weights):
+        x -= weight
+        if x < 0:
+            return name
+    return names[-1]
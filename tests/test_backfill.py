@@ -0,0 +1,191 @@
+import unittest
+import datetime
+import logging
+import sys
+import time
+
+try:
+    import psycopg2
+    import splunklib.results
+except ImportError:
+    psycopg2 = splunklib = None
+
+# Our class imports
+import geode.utils as utils
+if psycopg2 is not None and splunklib is not None:
+    import geode.backfill
+    from geode.backfill import Backfill, checkpoint_key, split
+
+
+class FakeDatabase:
+    """Stands in for Database, keeping checkpoints in memory"""
+
+    def __init__(self, checkpoints=None):
+        self.checkpoints = dict(checkpoints or {})
+
+    def get_checkpoint(self, search):
+        return self.checkpoints.get(search)
+
+    def set_checkpoint(self, search, time):
+        self.checkpoints[search] = time
+        return True
+
+
+class FakeSplunk:
+    """Stands in for Splunk, giving three results for each chunk. The
+    chunks starting at the times in fail fail that many times, part of the
+    way through"""
+
+    def __init__(self, fail=None):
+        self.fail = dict(fail or {})
+        self.searched = []
+
+    def search(self, s, latest_time, earliest_time, job_slots=None):
+        self.searched.append((earliest_time, latest_time))
+        for i in range(3):
+            if i == 2 and self.fail.get(earliest_time):
+                self.fail[earliest_time] -= 1
+                raise Exception("Splunk went away")
+            yield {'start': utils.dto_to_string(earliest_time),
+                   'mac': 'aa:bb:cc:dd:ee:%02d' % i,
+                   'event_type': ['DHCPACK']}
+
+
+class FakeGeode:
+    """Stands in for Geode, reading through the results of each search"""
+
+    def __init__(self, database, splunk):
+        self.database = database
+        self.splunk = splunk
+
+    def process_batched(self, results, s):
+        for r in results:
+            pass
+
+
+class Output:
+    """Stands in for stdout, keeping what is printed"""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, s):
+        self.lines.extend(l for l in s.split("\n") if l)
+
+
+class BackfillTestCase(unittest.TestCase):
+    """Test class for backfilling a period in chunks"""
+
+    def setUp(self):
+        if psycopg2 is None or splunklib is None:
+            raise unittest.SkipTest("Needs psycopg2 and splunklib")
+        self.start = datetime.datetime(2018, 1, 16)
+        self.end = datetime.datetime(2018, 1, 16, 3)
+        self.stdout = sys.stdout
+        sys.stdout = self.output = Output()
+        self.wait = utils.wait
+        utils.wait = lambda amount=60: None
+        # Failures are expected, so don't log them
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        utils.wait = self.wait
+        logging.disable(logging.NOTSET)
+
+    def _backfill(self, database, splunk, end=None, jobs=2):
+        """Returns a Backfill that loads into database from splunk rather
+        than Postgres and Splunk"""
+
+        backfill = Backfill('dhcp', self.start, end or self.end, jobs=jobs)
+        backfill._connect = lambda: FakeGeode(database, splunk)
+        return backfill
+
+    def _hour(self, i):
+        return self.start + datetime.timedelta(hours=i)
+
+    def test_split(self):
+        """ The period is split into chunks, the last of them cut short """
+
+        self.assertEqual(split(self.start, self._hour(2.5), 3600),
+                         [(self._hour(0), self._hour(1)),
+                          (self._hour(1), self._hour(2)),
+                          (self._hour(2), self._hour(2.5))])
+        self.assertEqual(split(self.start, self.start, 3600), [])
+
+    def test_skip_done(self):
+        """ Chunks that are already done are skipped, and one that was
+        partly done picks up from its checkpoint """
+
+        database = FakeDatabase({
+            checkpoint_key('dhcp', self._hour(0)): self._hour(1),
+            checkpoint_key('dhcp', self._hour(1)): self._hour(1.5)})
+        splunk = FakeSplunk()
+        backfill = self._backfill(database, splunk)
+        self.assertTrue(backfill.run())
+
+        self.assertEqual(sorted(splunk.searched),
+                         [(self._hour(1.5), self._hour(2)),
+                          (self._hour(2), self._hour(3))])
+        self.assertEqual((backfill.done, backfill.skipped, backfill.events),
+                         (3, 1, 6))
+        for i in range(3):
+            self.assertEqual(
+                database.checkpoints[checkpoint_key('dhcp', self._hour(i))],
+                self._hour(i + 1))
+
+    def test_retry(self):
+        """ A chunk that fails is tried again, and its events are only
+        counted once it is loaded """
+
+        splunk = FakeSplunk({self._hour(1): geode.backfill.RETRIES - 1})
+        backfill = self._backfill(FakeDatabase(), splunk)
+        self.assertTrue(backfill.run())
+
+        self.assertEqual(len(splunk.searched), 2 + geode.backfill.RETRIES)
+        self.assertEqual((backfill.done, backfill.events, backfill.failed),
+                         (3, 9, []))
+
+    def test_failed(self):
+        """ A chunk that fails every time is given up on and reported, and
+        the rest are still loaded """
+
+        splunk = FakeSplunk({self._hour(1): geode.backfill.RETRIES})
+        database = FakeDatabase()
+        backfill = self._backfill(database, splunk)
+        self.assertFalse(backfill.run())
+
+        self.assertEqual(backfill.failed, [(self._hour(1), self._hour(2))])
+        self.assertEqual((backfill.done, backfill.events), (2, 6))
+        self.assertFalse(checkpoint_key('dhcp', self._hour(1)) in
+                         database.checkpoints)
+        self.assertTrue("Chunk 2018-01-16T01:00:00 to 2018-01-16T02:00:00 "
+                        "failed" in self.output.lines)
+
+    def test_report(self):
+        """ The ETA comes from the chunks loaded so far, not those that
+        were skipped """
+
+        backfill = self._backfill(FakeDatabase(), FakeSplunk(),
+                                  self._hour(4))
+        backfill.started = time.time() - 100
+        backfill.done = 2
+        backfill.skipped = 1
+        backfill.events = 1000
+        backfill.report()
+        self.assertTrue(self.output.lines[-1].startswith(
+            "Backfill dhcp: 2/4 chunks (1 already done, 0 failed), 1000 "
+            "events, 10/s, eta 0:03:20"))
+
+        # Nothing has been loaded yet, so there's nothing to go on
+        backfill.done = 1
+        backfill.report()
+        self.assertTrue(self.output.lines[-1].endswith("eta unknown"))
+
+        backfill.done = 4
+        backfill.report()
+        self.assertTrue(self.output.lines[-1].endswith("eta 0:00:00"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import datetime
+
+# Our class imports
+from geode.batch import Batch, correlate
+from geode.event import Event
+
+
+class BatchTestCase(unittest.TestCase):
+    """Test class for the in memory correlation used by batch mode"""
+
+    def setUp(self):
+        """Create a session that is already in the database"""
+
+        self.session = Event(
+                       {
+                         'id': 7,
+                         'ip': '10.0.0.1',
+                         'mac': 'aa:bb:cc:dd:ee:ff',
+                         'hostname': 'laptop',
+                         'start': datetime.datetime(2017, 1, 1, 12, 0, 0),
+                         'stop': datetime.datetime(2017, 1, 1, 12, 20, 0),
+                         'event_type': [1]
+                       })
+
+    def test_merge_into_existing(self):
+        """ An event that matches a session in the database updates it """
+
+        e = Event({'ip': '10.0.0.1',
+                   'netid': 'abc12345',
+                   'start': '2017-01-01T12:05:00',
+                   'event_type': 'cas:prod'})
+        inserts, updates = correlate([e], [self.session])
+
+        self.assertEqual(inserts, [])
+        self.assertEqual(list(updates.keys()), [7])
+        self.assertEqual(updates[7].get('netid'), 'abc12345')
+        self.assertEqual(updates[7].get('event_type'),
+                         set(['DHCPACK', 'cas:prod']))
+
+    def test_conflict(self):
+        """ An event that conflicts with a session is inserted on its own """
+
+        e = Event({'ip': '10.0.0.1',
+                   'mac': 'aa:bb:cc:dd:ee:ff',
+                   'hostname': 'desktop',
+                   'start': '2017-01-01T12:10:00',
+                   'event_type': 'DHCPACK'})
+        inserts, updates = correlate([e], [self.session])
+
+        self.assertEqual(inserts, [e])
+        self.assertEqual(updates, {})
+        self.assertEqual(self.session.get('stop'),
+                         datetime.datetime(2017, 1, 1, 12, 20, 0))
+
+    def test_within_batch(self):
+        """ Later events in a batch see the events inserted before them """
+
+        e1 = Event({'ip': '10.0.0.2',
+                    'start': '2017-01-01T12:00:00',
+                    'event_type': 'access_combined'})
+        e2 = Event({'ip': '10.0.0.2',
+                    'netid': 'abc12345',
+                    'start': '2017-01-01T11:59:50',
+                    'event_type': 'cas:prod'})
+        inserts, updates = correlate([e1, e2], [self.session])
+
+        self.assertEqual(updates, {})
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(inserts[0].get('netid'), 'abc12345')
+        self.assertEqual(inserts[0].get('start'),
+                         datetime.datetime(2017, 1, 1, 11, 59, 50))
+
+    def test_checkpoint_with_batch(self):
+        """ The checkpoint is written in the same call as the batch """
+
+        writes = []
+
+        class FakeDatabase:
+            def select_many(self, events):
+                return []
+
+            def write_many(self, inserts, updates, checkpoint=None):
+                writes.append((len(inserts), checkpoint))
+
+            def transaction(self):
+                return self
+
+            def __enter__(self):
+                pass
+
+            def __exit__(self, *args):
+                return False
+
+        batch = Batch(FakeDatabase(), size=2, search='cas')
+        batch.advance('2017-01-01T12:00:00')
+        self.assertFalse(batch.add(Event({'ip': '10.0.0.3',
+                                          'start': '2017-01-01T12:00:00'})))
+        batch.advance('2017-01-01T12:01:00')
+        self.assertTrue(batch.add(Event({'ip': '10.0.0.4',
+                                         'start': '2017-01-01T12:01:00'})))
+        # Nothing new has been read, so there is nothing to write
+        self.assertFalse(batch.flush())
+        batch.advance('2017-01-01T12:02:00')
+        self.assertTrue(batch.flush())
+
+        self.assertEqual(writes, [(2, ('cas', '2017-01-01T12:01:00')),
+                                  (0, ('cas', '2017-01-01T12:02:00'))])
+
+
+if __name__ == '__main__':
+    unittest.main()
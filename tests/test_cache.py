@@ -0,0 +1,93 @@
+import unittest
+import datetime
+
+# Our class imports
+from geode.cache import SessionCache
+from geode.event import Event
+
+
+class SessionCacheTestCase(unittest.TestCase):
+    """Test class for the in memory cache of sediment sessions"""
+
+    def setUp(self):
+        """Create a cache holding one session"""
+
+        self.cache = SessionCache(max_sessions=2, max_age=3600)
+        self.cache.put(Event(
+                       {
+                         'ip': '10.0.0.1',
+                         'mac': 'aa:bb:cc:dd:ee:ff',
+                         'start': datetime.datetime(2017, 1, 1, 12, 0, 0),
+                         'stop': datetime.datetime(2017, 1, 1, 12, 20, 0),
+                         'event_type': [1]
+                       }), 1)
+
+    def test_hit_and_miss(self):
+        """ Overlapping matching events hit, everything else misses """
+
+        hit = self.cache.select(Event({'mac': 'aa:bb:cc:dd:ee:ff',
+                                       'start': '2017-01-01T12:05:00'}))
+        self.assertEqual(hit.get('id'), 1)
+
+        # Outside of the session
+        self.assertEqual(self.cache.select(
+            Event({'ip': '10.0.0.1', 'start': '2017-01-01T13:00:00'})), None)
+        # Unknown IP
+        self.assertEqual(self.cache.select(
+            Event({'ip': '10.0.0.2', 'start': '2017-01-01T12:05:00'})), None)
+
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_oldest_first(self):
+        """ Of two overlapping sessions, the one with the lowest id is used,
+        as it is by select """
+
+        self.cache.put(Event({'mac': 'aa:bb:cc:dd:ee:ff', 'ip': '10.0.0.2',
+                              'start': datetime.datetime(2017, 1, 1, 12, 10),
+                              'stop': datetime.datetime(2017, 1, 1, 12, 30),
+                              'event_type': [1]}), 2)
+        hit = self.cache.select(Event({'mac': 'aa:bb:cc:dd:ee:ff',
+                                       'start': '2017-01-01T12:15:00'}))
+        self.assertEqual(hit.get('id'), 1)
+
+        # The oldest is the only one checked, like in select
+        self.assertEqual(self.cache.select(
+            Event({'mac': 'aa:bb:cc:dd:ee:ff', 'ip': '10.0.0.2',
+                   'start': '2017-01-01T12:15:00'})), None)
+
+    def test_put_replaces(self):
+        """ Updating a session moves it in the MAC and IP indexes """
+
+        session = self.cache.select(Event({'ip': '10.0.0.1',
+                                           'start': '2017-01-01T12:05:00'}))
+        session['ip'] = '10.0.0.9'
+        # Changing the copy we got back does not change the cache
+        self.assertEqual(self.cache.sessions[1].get('ip'), '10.0.0.1')
+
+        self.cache.put(session)
+        self.assertEqual(self.cache.select(
+            Event({'ip': '10.0.0.1', 'start': '2017-01-01T12:05:00'})), None)
+        self.assertEqual(self.cache.select(
+            Event({'ip': '10.0.0.9',
+                   'start': '2017-01-01T12:05:00'})).get('id'), 1)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_eviction(self):
+        """ The cache stays within its size and age limits """
+
+        for i in range(2, 4):
+            self.cache.put(Event({'ip': '10.0.1.%d' % i,
+                                  'start': '2017-01-01T12:30:00'}), i)
+        self.assertEqual(len(self.cache), 2)
+        self.assertTrue(1 not in self.cache.sessions)
+
+        self.cache.put(Event({'ip': '10.0.1.4',
+                              'start': '2017-01-01T18:00:00'}), 4)
+        self.assertEqual(list(self.cache.sessions.keys()), [4])
+        self.assertEqual(self.cache.evictions, 3)
+        self.assertEqual(self.cache.ips.keys(), ['10.0.1.4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+# Our class imports
+from geode.config import Config
+
+
+class ConfigTestCase(unittest.TestCase):
+    """Test class for the cached configuration file"""
+
+    def setUp(self):
+        """Write out a small settings file"""
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'settings.conf')
+        self._write('2017-01-01T00:00:00', 100)
+        self.config = Config(self.path, check_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, time, mtime):
+        """Writes the file with the given modification time"""
+
+        with open(self.path, 'w') as c:
+            c.write("[Time]\nearliest_dhcp_time = %s\n" % time)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_reads_from_memory(self):
+        """ The file is only parsed again once it changes """
+
+        self.assertEqual(self.config.get('Time', 'earliest_dhcp_time'),
+                         '2017-01-01T00:00:00')
+        parser = self.config.parser
+
+        self.config.get('Time', 'earliest_dhcp_time')
+        self.assertTrue(self.config.parser is parser)
+
+        self._write('2017-01-02T00:00:00', 200)
+        self.assertEqual(self.config.get('Time', 'earliest_dhcp_time'),
+                         '2017-01-02T00:00:00')
+        self.assertFalse(self.config.parser is parser)
+
+    def test_set(self):
+        """ Values that are set are written out and stay in memory """
+
+        self.config.set('Time', 'earliest_dhcp_time', '2017-01-03T00:00:00')
+        parser = self.config.parser
+        self.assertEqual(self.config.get('Time', 'earliest_dhcp_time'),
+                         '2017-01-03T00:00:00')
+        self.assertTrue(self.config.parser is parser)
+        self.assertTrue(self.config.has('Time', 'earliest_dhcp_time'))
+        self.assertFalse(self.config.has('Splunk', 'prefetch'))
+
+        with open(self.path) as c:
+            self.assertTrue('2017-01-03T00:00:00' in c.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,323 @@
+import unittest
+import datetime
+import os
+import threading
+import time
+from distutils.spawn import find_executable
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+# Our class imports
+if psycopg2 is not None:
+    from geode.database import Database
+    from geode.event import Event
+    from geode.main import Geode
+    from tests.fixtures import Postgres, generate
+
+
+class CorrelateTestCase(unittest.TestCase):
+    """Test class comparing geode_correlate in Postgres with correlation in
+    Python, against a throwaway local Postgres (see tests/fixtures.py)"""
+
+    @classmethod
+    def setUpClass(cls):
+        if psycopg2 is None or find_executable("initdb") is None:
+            raise unittest.SkipTest("Needs psycopg2 and a local Postgres")
+        cls.postgres = Postgres()
+        cls.postgres.start()
+        cls.log_file = os.path.join(cls.postgres.directory, "geode.log")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.postgres.stop()
+
+    def _run(self, searches, correlate, batch_size, shards=0, cache_size=0,
+             schema="plain"):
+        """Runs the (search, results) pairs through process_results into an
+        empty sediment table, and returns what ends up in it"""
+
+        self.postgres.reset(schema)
+        config_file = self.postgres.write_config(cache_size, correlate,
+                                                 schema)
+
+        geode = Geode(log_file=self.log_file)
+        geode.database = Database(config_file=config_file,
+                                  log_file=self.log_file)
+        geode.dhcp_search = 'dhcp'
+        geode.batch_size = batch_size
+        geode.flush_interval = 3600
+        geode.shards = shards
+        try:
+            for s, results in searches:
+                geode.process_results([dict(r) for r in results], s)
+        finally:
+            geode._close_shards()
+
+        cursor = geode.database.cursor
+        cursor.execute("""SELECT id, mac::text AS mac, abbrev(ip) AS ip,
+                                 netid, hostname, start, stop, useragent, os,
+                                 event_type
+                          FROM sediment ORDER BY id;""")
+        rows = cursor.fetchall()
+        geode.database.database.close()
+        return rows
+
+    def _compare(self, searches):
+        """Checks that the server ends up with the same sessions as process
+        results does one event at a time"""
+
+        expected = self._run(searches, "python", 0)
+        for batch_size in (2, 50):
+            self.assertEqual(self._run(searches, "server", batch_size),
+                             expected)
+        return expected
+
+    def test_synthetic(self):
+        """ A stream with DHCP churn and identity events for the same
+        devices """
+
+        results = generate(3000, 150, 100, 0.3, seed=1)
+        names = ['dhcp', 'wireless', 'cas', 'access']
+        rows = self._compare([(s, results[s]) for s in names])
+        self.assertTrue(0 < len(rows) < 3000)
+
+    def test_range_schema(self):
+        """ The server finds the same sessions through the range schema's
+        indexes """
+
+        results = generate(3000, 150, 100, 0.3, seed=3)
+        searches = [(s, results[s])
+                    for s in ['dhcp', 'wireless', 'cas', 'access']]
+        expected = self._run(searches, "python", 0)
+        self.assertEqual(self._run(searches, "server", 50, schema="range"),
+                         expected)
+
+    def test_range_backwards(self):
+        """ Events that stop before they start are looked up through the
+        range schema like through the plain one """
+
+        dhcp = [{'start': '2017-01-01T10:00:00',
+                 'stop': '2017-01-01T10:20:00',
+                 'mac': 'aa:bb:cc:dd:ee:ff', 'ip': '10.0.0.1',
+                 'event_type': 'DHCPACK'}]
+        identity = [{'start': '2017-01-01T10:10:00',
+                     'stop': '2017-01-01T10:05:00',
+                     'ip': '10.0.0.1', 'netid': 'abc12345',
+                     'event_type': 'cas:prod'}]
+        searches = [('dhcp', dhcp), ('cas', identity)]
+
+        expected = self._run(searches, "python", 0)
+        for correlate, batch_size in (("python", 0), ("python", 50),
+                                      ("server", 50)):
+            self.assertEqual(self._run(searches, correlate, batch_size,
+                                       schema="range"), expected)
+
+    def test_sharded(self):
+        """ Sharding gives the same sessions, though the shards insert them
+        in a different order """
+
+        results = generate(3000, 150, 100, 0.3, seed=2)
+        searches = [(s, results[s])
+                    for s in ['dhcp', 'wireless', 'cas', 'access']]
+
+        def sessions(rows):
+            return sorted(tuple(sorted((k, v) for k, v in r.items()
+                                       if k != 'id'))
+                          for r in rows)
+
+        expected = sessions(self._run(searches, "python", 0))
+        for batch_size in (0, 50):
+            self.assertEqual(sessions(self._run(searches, "python",
+                                                batch_size, shards=3)),
+                             expected)
+
+    def test_sharded_mixed(self):
+        """ A search with both MAC and IP-only results, which the shards
+        split up by different keys, merges them all into the same sessions
+        as it does unsharded """
+
+        dhcp = []
+        mixed = []
+        for i in range(20):
+            mac = 'aa:bb:cc:dd:ee:%02x' % i
+            ip = '10.0.0.%d' % (i + 1)
+            dhcp.append({'start': '2017-01-01T10:00:00',
+                         'stop': '2017-01-01T10:20:00',
+                         'mac': mac, 'ip': ip, 'event_type': 'DHCPACK'})
+            for j in range(10):
+                start = '2017-01-01T10:%02d:%02d' % (j + 1, i)
+                if j % 2:
+                    mixed.append({'start': start, 'ip': ip,
+                                  'useragent': 'curl %d' % i,
+                                  'event_type': 'access_combined'})
+                else:
+                    mixed.append({'start': start, 'mac': mac,
+                                  'netid': 'user%05d' % i,
+                                  'event_type': 'wireless_authentication'})
+        mixed.sort(key=lambda r: r['start'])
+        searches = [('dhcp', dhcp), ('mixed', mixed)]
+
+        def sessions(rows):
+            return sorted(tuple(sorted((k, v) for k, v in r.items()
+                                       if k != 'id'))
+                          for r in rows)
+
+        expected = self._run(searches, "python", 0)
+        self.assertEqual(len(expected), 20)
+        self.assertTrue(all(r['netid'] and r['useragent'] for r in expected))
+        for batch_size in (0, 50):
+            self.assertEqual(sessions(self._run(searches, "python",
+                                                batch_size, shards=3)),
+                             sessions(expected))
+
+    def test_cached(self):
+        """ The cache picks the same session as Postgres when two sessions
+        overlap the event """
+
+        dhcp = [{'start': '2017-01-01T10:00:00',
+                 'stop': '2017-01-01T10:20:00',
+                 'mac': 'aa:bb:cc:dd:ee:ff', 'ip': '10.0.0.1',
+                 'event_type': 'DHCPACK'},
+                # Terminates the first session at 10:10 and starts another
+                {'start': '2017-01-01T10:10:00',
+                 'stop': '2017-01-01T10:30:00',
+                 'mac': 'aa:bb:cc:dd:ee:ff', 'ip': '10.0.0.2',
+                 'event_type': 'DHCPACK'}]
+        # Close enough to 10:10 to overlap both
+        identity = [{'start': '2017-01-01T10:10:10',
+                     'mac': 'aa:bb:cc:dd:ee:ff', 'netid': 'abc12345',
+                     'event_type': 'wireless_authentication'}]
+        searches = [('dhcp', dhcp), ('wireless', identity)]
+
+        expected = self._run(searches, "python", 0)
+        for batch_size in (0, 50):
+            self.assertEqual(self._run(searches, "python", batch_size,
+                                       cache_size=1000), expected)
+        self.assertEqual(expected[0]['netid'], 'abc12345')
+
+    def test_interleaved_writers(self):
+        """ Two writers merging into the same session in turn, with the
+        cache configured, don't undo each other's merges """
+
+        self.postgres.reset()
+        config_file = self.postgres.write_config(1000, shards=2)
+        writers = []
+        for i in range(2):
+            geode = Geode(log_file=self.log_file)
+            geode.database = Database(config_file=config_file,
+                                      log_file=self.log_file)
+            self.assertEqual(geode.database.cache, None)
+            geode.batch_size = 0
+            geode.shards = 0
+            writers.append(geode)
+        dhcp, identity = writers
+
+        dhcp.process_results([{'start': '2017-01-01T10:00:00',
+                               'stop': '2017-01-01T10:20:00',
+                               'mac': 'aa:bb:cc:dd:ee:ff',
+                               'ip': '10.0.0.1',
+                               'event_type': 'DHCPACK'}], 'dhcp')
+        identity.process_results([{'start': '2017-01-01T10:05:00',
+                                   'ip': '10.0.0.1', 'netid': 'abc12345',
+                                   'event_type': 'cas:prod'}], 'cas')
+        dhcp.process_results([{'start': '2017-01-01T10:10:00',
+                               'mac': 'aa:bb:cc:dd:ee:ff',
+                               'hostname': 'laptop',
+                               'event_type': 'DHCPACK'}], 'dhcp')
+
+        cursor = dhcp.database.cursor
+        cursor.execute("SELECT netid, hostname FROM sediment;")
+        self.assertEqual([dict(r) for r in cursor.fetchall()],
+                         [{'netid': 'abc12345', 'hostname': 'laptop'}])
+        for geode in writers:
+            geode.database.database.close()
+
+    def test_concurrent_writers(self):
+        """ A writer that merges into a session while another has it looked
+        up waits for that writer's merge, rather than having it undone """
+
+        self.postgres.reset()
+        config_file = self.postgres.write_config(0, shards=2)
+        writers = []
+        for i in range(2):
+            geode = Geode(log_file=self.log_file)
+            geode.database = Database(config_file=config_file,
+                                      log_file=self.log_file)
+            self.assertTrue(geode.database.shared)
+            geode.batch_size = 0
+            geode.shards = 0
+            writers.append(geode)
+        dhcp, identity = writers
+
+        dhcp.process_results([{'start': '2017-01-01T10:00:00',
+                               'stop': '2017-01-01T10:20:00',
+                               'mac': 'aa:bb:cc:dd:ee:ff',
+                               'ip': '10.0.0.1',
+                               'event_type': 'DHCPACK'}], 'dhcp')
+
+        # The DHCP writer looks the session up, and the identity writer
+        # tries to merge into it before the DHCP writer has written it back
+        renewal = Event({'start': '2017-01-01T10:10:00',
+                         'mac': 'aa:bb:cc:dd:ee:ff', 'hostname': 'laptop',
+                         'event_type': 'DHCPACK'})
+        merging = threading.Thread(
+            target=identity.process_results,
+            args=([{'start': '2017-01-01T10:05:00', 'ip': '10.0.0.1',
+                    'netid': 'abc12345', 'event_type': 'cas:prod'}], 'cas'))
+        with dhcp.database.transaction():
+            lookup = dhcp.database.select(renewal, lock=True)
+            merging.start()
+            time.sleep(0.5)
+            self.assertTrue(merging.is_alive())
+            dhcp.database.update(lookup.merge(renewal), lookup.get('id'))
+        merging.join()
+
+        cursor = dhcp.database.cursor
+        cursor.execute("SELECT netid, hostname FROM sediment;")
+        self.assertEqual([dict(r) for r in cursor.fetchall()],
+                         [{'netid': 'abc12345', 'hostname': 'laptop'}])
+        for geode in writers:
+            geode.database.database.close()
+
+    def test_quirks(self):
+        """ MACs in other formats, conflicts, and sessions that only overlap
+        one way """
+
+        dhcp = [{'start': '2017-01-01T10:00:00',
+                 'stop': '2017-01-01T10:20:00',
+                 'mac': 'aa:bb:cc:dd:ee:ff', 'ip': '10.0.0.1',
+                 'hostname': 'laptop', 'event_type': 'DHCPACK'},
+                {'start': '2017-01-01T10:10:00',
+                 'stop': '2017-01-01T10:30:00',
+                 'mac': '11:22:33:44:55:66', 'ip': '10.0.0.2',
+                 'event_type': 'DHCPACK'}]
+        identity = [
+            # Ends just before the first session, which only overlaps it one
+            # way, so the session is terminated
+            {'start': '2017-01-01T09:59:00', 'stop': '2017-01-01T09:59:30',
+             'mac': 'aa:bb:cc:dd:ee:ff', 'netid': 'abc12345',
+             'event_type': 'wireless_authentication'},
+            # The same MAC written differently doesn't match
+            {'start': '2017-01-01T10:11:00', 'mac': '11-22-33-44-55-66',
+             'netid': 'xyz98765', 'event_type': 'wireless_authentication'},
+            # Merges into the second session
+            {'start': '2017-01-01T10:12:00', 'ip': '10.0.0.2',
+             'netid': 'xyz98765', 'useragent': 'curl',
+             'event_type': 'access_combined'},
+            # Conflicts with the netid that was just merged in, so it gets a
+            # session of its own
+            {'start': '2017-01-01T10:13:00', 'ip': '10.0.0.2',
+             'netid': 'def67890', 'event_type': 'cas:prod'}]
+
+        rows = self._compare([('dhcp', dhcp), ('wireless', identity)])
+        self.assertEqual(rows[0]['stop'],
+                         datetime.datetime(2017, 1, 1, 9, 59))
+        self.assertEqual(rows[1]['netid'], 'xyz98765')
+        self.assertEqual(rows[1]['event_type'], [1, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import datetime
+
+# Our class imports
+from geode.dedup import DedupFilter
+
+
+class DedupFilterTestCase(unittest.TestCase):
+    """Test class for the filter that drops repeated events"""
+
+    def _result(self, start, **fields):
+        r = {'start': start, 'mac': 'aa:bb:cc:dd:ee:ff',
+             'event_type': ['DHCPACK', 'DHCPEXPIRE']}
+        r.update(fields)
+        return r
+
+    def test_repeats(self):
+        """ Only exact repeats are dropped """
+
+        dedup = DedupFilter(window=60)
+        self.assertTrue(dedup.check(self._result('2018-01-16T13:36:16')))
+        self.assertFalse(dedup.check(self._result('2018-01-16T13:36:16')))
+        self.assertTrue(dedup.check(self._result('2018-01-16T13:36:16',
+                                                 ip='10.0.0.1')))
+        self.assertTrue(dedup.check(self._result('2018-01-16T13:36:17')))
+        self.assertTrue(dedup.check({'mac': 'aa:bb:cc:dd:ee:ff'}))
+        self.assertEqual(dedup.stats(), {'passed': 4, 'suppressed': 1,
+                                         'expired': 0, 'events': 3})
+
+    def test_splunk_fields(self):
+        """ Fields that Splunk adds for each job don't make a repeat new """
+
+        dedup = DedupFilter(window=60)
+        self.assertTrue(dedup.check(self._result(
+            '2018-01-16T13:36:16', _serial='0', _cd='12:345',
+            _indextime='1516109776')))
+        self.assertFalse(dedup.check(self._result(
+            '2018-01-16T13:36:16', _serial='7', _cd='14:2',
+            _indextime='1516109790')))
+
+    def test_rollback(self):
+        """ Events that were never committed aren't repeats when they are
+        fetched again """
+
+        dedup = DedupFilter(window=60)
+        for i in range(3):
+            self.assertTrue(dedup.check(self._result(
+                '2018-01-16T13:36:1%d' % i)))
+        dedup.commit(datetime.datetime(2018, 1, 16, 13, 36, 11))
+        dedup.rollback()
+
+        self.assertFalse(dedup.check(self._result('2018-01-16T13:36:10')))
+        self.assertTrue(dedup.check(self._result('2018-01-16T13:36:11')))
+        self.assertTrue(dedup.check(self._result('2018-01-16T13:36:12')))
+        self.assertEqual(len(dedup), 3)
+
+    def test_expiry(self):
+        """ Events are forgotten once the search is past the window, or
+        once there are too many """
+
+        dedup = DedupFilter(window=60, max_events=3)
+        dedup.check(self._result('2018-01-16T13:36:16'))
+        dedup.check(self._result('2018-01-16T13:37:17'))
+        self.assertEqual(len(dedup), 1)
+        self.assertTrue(dedup.check(self._result('2018-01-16T13:36:16')))
+
+        for i in range(3):
+            dedup.check(self._result('2018-01-16T13:37:17', ip=str(i)))
+        self.assertEqual(len(dedup), 3)
+        self.assertEqual(dedup.stats()['expired'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -107,6 +107,50 @@ class EventTestCase(unittest.TestCase):
                    )
         self.assertEquals(tmp, e1.merge(e2))
 
+    def test_inputs_unmodified(self):
+        """ Creating and merging events leaves their inputs alone """
+
+        d = {
+             'mac': 'ff:ff:ff:ff:ff:ff',
+             'start': datetime.datetime(2016, 11, 22, 11, 11, 22),
+             'event_type': 'DHCPACK',
+             'extra': {'vlan': 10}
+            }
+        before = dict(d, extra={'vlan': 10})
+        e = Event(d)
+        self.assertEquals(d, before)
+
+        # Changing the event doesn't change the dict, or the other way around
+        e['mac'] = 'aa:aa:aa:aa:aa:aa'
+        e.get('extra')['vlan'] = 20
+        self.assertEquals(d, before)
+        d['extra']['vlan'] = 30
+        self.assertEquals(e.get('extra'), {'vlan': 20})
+
+        # A merge doesn't change either event, even when e has no stop time
+        e1 = self.event1
+        e1['tags'] = ['wired']
+        e1_before = e1.items()
+        e2 = {'ip': '127.0.0.1',
+              'start': datetime.datetime(2016, 11, 22, 11, 20),
+              'notes': ['first']}
+        e2_before = {'ip': '127.0.0.1',
+                     'start': datetime.datetime(2016, 11, 22, 11, 20),
+                     'notes': ['first']}
+        m = e1.merge(e2)
+        self.assertEquals(e1.items(), e1_before)
+        self.assertEquals(e2, e2_before)
+
+        # And changing the merged event doesn't reach back into them either
+        m['netid'] = 'xyz98765'
+        m.get('notes').append('second')
+        m.get('tags').append('wireless')
+        self.assertEquals(e1.items(), e1_before)
+        self.assertEquals(e1.get('tags'), ['wired'])
+        self.assertEquals(e2, e2_before)
+        self.assertEquals(m.get('stop'),
+                          datetime.datetime(2016, 11, 22, 11, 41, 22))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,142 @@
+import unittest
+import gzip
+import io
+import threading
+import BaseHTTPServer
+import SocketServer
+
+try:
+    import splunklib.binding
+except ImportError:
+    splunklib = None
+
+# Our class imports
+if splunklib is not None:
+    from geode.handler import KeepAliveHandler
+
+# A page of results, big enough to be streamed rather than read at once
+RESULTS = b"<results>" + b"<result></result>" * 10000 + b"</results>"
+
+
+class StubSplunk(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the calls that a window makes, counting the connections that
+    they come in on"""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        if self.path.endswith("/results"):
+            body = RESULTS
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                compressed = io.BytesIO()
+                f = gzip.GzipFile(fileobj=compressed, mode="wb")
+                f.write(body)
+                f.close()
+                self._respond(compressed.getvalue(), gzip=True)
+                return
+            self._respond(body)
+        else:
+            self._respond(b"<entry><content>isDone 1</content></entry>")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._respond(b"<response><sid>1</sid></response>")
+
+    def _respond(self, body, gzip=False):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        if gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubSplunk)
+        self.lock = threading.Lock()
+        self.connections = 0
+
+
+class HandlerTestCase(unittest.TestCase):
+    """Test class for KeepAliveHandler, against a stub Splunk"""
+
+    def setUp(self):
+        if splunklib is None:
+            raise unittest.SkipTest("Needs splunklib")
+        self.server = StubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/services/search/jobs" % (
+            self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _window(self, handler, read_results=True):
+        """Makes the calls of one window: creating a job, checking on it,
+        reading its results and cancelling it. Like splunklib, the body of
+        the cancel is never read"""
+
+        body = handler(self.url, {"method": "POST", "headers": [],
+                                  "body": "search=x"})["body"]
+        body.read()
+        handler(self.url + "/1", {"method": "GET",
+                                  "headers": []})["body"].read()
+        results = handler(self.url + "/1/results", {"method": "GET",
+                                                    "headers": []})["body"]
+        if read_results:
+            data = results.read()
+        else:
+            data = results.read(100)
+            results.close()
+        handler(self.url + "/1/control", {"method": "POST", "headers": [],
+                                          "body": "action=cancel"})
+        return data
+
+    def test_reuse(self):
+        """ Every window uses the same connection """
+
+        handler = KeepAliveHandler()
+        for i in range(5):
+            self.assertEqual(self._window(handler), RESULTS)
+        handler.close()
+        self.assertEqual(handler.opened, 1)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_gzip(self):
+        """ Gzipped results come out the same """
+
+        handler = KeepAliveHandler(gzip=True)
+        for i in range(3):
+            self.assertEqual(self._window(handler), RESULTS)
+        handler.close()
+        self.assertEqual(self.server.connections, 1)
+
+    def test_abandoned(self):
+        """ Results that are closed part way through take their connection
+        with them """
+
+        handler = KeepAliveHandler()
+        for i in range(3):
+            self._window(handler, read_results=False)
+        handler.close()
+        # One for each abandoned page of results, and one more for the last
+        # cancel
+        self.assertEqual(self.server.connections, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+# Our class imports
+from geode.jobs import JobManager
+
+
+class FakeJob:
+    """Stands in for a splunklib Job, recording whether it was cancelled.
+    Cancelling fails while its connection is down"""
+
+    def __init__(self, sid, connection):
+        self.sid = sid
+        self.connection = connection
+        self.cancelled = False
+
+    def cancel(self):
+        if self.connection.down:
+            raise IOError("Connection refused")
+        self.cancelled = True
+
+
+class FakeJobs:
+    """Stands in for a splunklib Jobs collection"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = 0
+
+    def create(self, search_string, **kwargs):
+        self.created += 1
+        return FakeJob("sid%d" % self.created, self.connection)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.jobs = FakeJobs(self)
+        self.down = False
+
+
+class FakeManager(JobManager):
+    """A JobManager that cancels jobs by sid without asking Splunk"""
+
+    def __init__(self, *args):
+        JobManager.__init__(self, *args)
+        self.reaped = []
+
+    def _job(self, connection, sid):
+        job = FakeJob(sid, connection)
+        self.reaped.append(job)
+        return job
+
+
+class JobManagerTestCase(unittest.TestCase):
+    """Test class for JobManager"""
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.job_dir)
+
+    def _registry(self, manager):
+        with open(manager.registry.name) as f:
+            return f.read()
+
+    def test_limit(self):
+        """ No more than max_jobs are open, and the registry empties once
+        they are cancelled """
+
+        connection = FakeConnection()
+        manager = JobManager(2, self.job_dir)
+        first = manager.create(connection, "search x")
+        second = manager.create(connection, "search x")
+        self.assertEqual(manager.create(connection, "search x", block=False),
+                         None)
+        self.assertEqual(self._registry(manager), "+sid1\n+sid2\n")
+
+        manager.cancel(first)
+        self.assertTrue(first.cancelled)
+        self.assertEqual(self._registry(manager), "+sid1\n+sid2\n-sid1\n")
+        third = manager.create(connection, "search x", block=False)
+        self.assertEqual(third.sid, "sid3")
+
+        manager.cancel(second)
+        manager.cancel(third)
+        self.assertEqual(manager.open, set())
+        self.assertEqual(self._registry(manager), "")
+
+    def test_orphans(self):
+        """ A job that couldn't be cancelled keeps its slot until it is,
+        even from a new connection """
+
+        connection = FakeConnection()
+        manager = FakeManager(1, self.job_dir)
+        job = manager.create(connection, "search x")
+
+        connection.down = True
+        manager.cancel(job)
+        self.assertFalse(job.cancelled)
+        self.assertEqual(manager.orphans, set(["sid1"]))
+        self.assertEqual(manager.create(connection, "search x", block=False),
+                         None)
+
+        reconnected = FakeConnection()
+        job = manager.create(reconnected, "search x", block=False)
+        self.assertEqual([j.sid for j in manager.reaped if j.cancelled],
+                         ["sid1"])
+        self.assertEqual(manager.orphans, set())
+        self.assertEqual(job.sid, "sid1")
+        manager.cancel(job)
+        self.assertEqual(self._registry(manager), "")
+
+    def test_replace(self):
+        """ A window searched again takes over its job's slot, even when
+        there is no other room """
+
+        connection = FakeConnection()
+        manager = JobManager(1, self.job_dir)
+        job = manager.create(connection, "search x")
+        again = manager.replace(connection, job, "search x")
+        self.assertTrue(job.cancelled)
+        self.assertEqual(again.sid, "sid2")
+        self.assertEqual(manager.open, set(["sid2"]))
+        self.assertEqual(manager.create(connection, "search x", block=False),
+                         None)
+
+        manager.cancel(again)
+        self.assertEqual(self._registry(manager), "")
+
+    def test_reap(self):
+        """ Jobs left by a process that is gone are cancelled at startup,
+        and those of running processes are left alone """
+
+        # Nothing runs as a pid this big
+        with open(os.path.join(self.job_dir, "4194305"), "w") as f:
+            f.write("+a\n+b\n-a\n+c\n")
+        with open(os.path.join(self.job_dir, str(os.getppid())), "w") as f:
+            f.write("+d\n")
+        # Left by an earlier process that had our pid
+        with open(os.path.join(self.job_dir, str(os.getpid())), "w") as f:
+            f.write("+e\n")
+
+        manager = FakeManager(2, self.job_dir)
+        self.assertEqual(manager.reap(FakeConnection()), 3)
+        self.assertEqual(sorted(j.sid for j in manager.reaped),
+                         ["b", "c", "e"])
+        self.assertEqual(sorted(os.listdir(self.job_dir)),
+                         sorted([str(os.getpid()), str(os.getppid())]))
+
+    def test_reap_race(self):
+        """ A registry that another process reaps first is skipped """
+
+        path = os.path.join(self.job_dir, "4194305")
+        with open(path, "w") as f:
+            f.write("+a\n")
+
+        manager = FakeManager(2, self.job_dir)
+        listdir = os.listdir
+
+        def reaped_first(directory):
+            names = listdir(directory)
+            os.remove(path)
+            return names
+
+        os.listdir = reaped_first
+        try:
+            self.assertEqual(manager.reap(FakeConnection()), 0)
+        finally:
+            os.listdir = listdir
+        self.assertEqual(manager.reaped, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+# Our class imports
+import geode.metrics as metrics
+import geode.utils as utils
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Test class for the ingest instrumentation"""
+
+    def setUp(self):
+        """Turn metrics on, writing to a temporary file"""
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'geode.prom')
+        metrics._metrics = metrics.Metrics(self.path, interval=3600)
+
+    def tearDown(self):
+        metrics._metrics = None
+        shutil.rmtree(self.directory)
+
+    def test_exclusive_timing(self):
+        """ Time in a nested stage only counts towards the inner stage """
+
+        with metrics.timer("outer"):
+            time.sleep(0.05)
+            with metrics.timer("inner"):
+                time.sleep(0.1)
+
+        stages = metrics._metrics.stages
+        self.assertEqual(stages["outer"][0], 1)
+        self.assertEqual(stages["inner"][0], 1)
+        self.assertTrue(0.04 < stages["outer"][1] < 0.09)
+        self.assertTrue(stages["inner"][1] >= 0.09)
+
+    def test_timed(self):
+        """ Iterating is timed, but not what the consumer does in between """
+
+        def slow():
+            for i in range(3):
+                time.sleep(0.02)
+                yield i
+
+        for i in metrics.timed(slow(), "parse"):
+            time.sleep(0.05)
+
+        calls, seconds = metrics._metrics.stages["parse"]
+        self.assertEqual(calls, 4)
+        self.assertTrue(0.05 < seconds < 0.12)
+
+    def test_export(self):
+        """ Everything is written out in the Prometheus text format """
+
+        with metrics.timer("select"):
+            pass
+        metrics.count("rows_fetched", 5)
+        metrics.checkpoint("dhcp", utils.time_diff(utils.now(), -120))
+
+        # Not due yet
+        metrics.export()
+        self.assertFalse(os.path.exists(self.path))
+
+        metrics.export(force=True)
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue('geode_stage_calls_total{stage="select"} 1' in lines)
+        self.assertTrue('geode_rows_fetched_total 5' in lines)
+        lag = [l for l in lines if l.startswith('geode_lag_seconds{')]
+        self.assertEqual(len(lag), 1)
+        self.assertTrue(119 <= int(lag[0].split()[1]) <= 125)
+
+    def test_disabled(self):
+        """ With metrics off, nothing is recorded and iterables pass through
+        untouched """
+
+        metrics._metrics = None
+        values = [1, 2, 3]
+        self.assertTrue(metrics.timed(values, "parse") is values)
+        with metrics.timer("select"):
+            metrics.count("rows_fetched")
+            metrics.checkpoint("dhcp", datetime.datetime(2017, 1, 1))
+        metrics.export(force=True)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
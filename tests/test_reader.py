@@ -0,0 +1,82 @@
+import unittest
+import io
+import json
+
+# Our class imports
+from geode import reader
+from geode.reader import JSONReader, CSVReader
+
+
+class ReaderTestCase(unittest.TestCase):
+    """Test class for the JSON and CSV result readers"""
+
+    rows = [{'start': '2018-01-16T13:36:%02d' % i, 'mac': 'aa:bb:cc:dd:ee:ff',
+             'event_type': ['DHCPACK', 'DHCPEXPIRE'] if i % 2 else 'DHCPACK'}
+            for i in range(40)]
+
+    def setUp(self):
+        # Small reads, so that values are split across them
+        self.read_size = reader.READ_SIZE
+        reader.READ_SIZE = 7
+
+    def tearDown(self):
+        reader.READ_SIZE = self.read_size
+
+    def test_json_results(self):
+        """ The results endpoint's response, with brackets in the keys and
+        values around the results """
+
+        data = json.dumps({'preview': False, 'init_offset': 0,
+                           'messages': [{'type': 'INFO', 'text': ']}"'}],
+                           'fields': [{'name': 'start'}],
+                           'results': self.rows,
+                           'highlighted': {'a': [1, {'b': ']'}]}})
+        parsed = list(JSONReader(io.BytesIO(data)))
+        self.assertEqual(parsed, self.rows)
+        self.assertEqual(type(parsed[0]['start']), str)
+
+    def test_json_keys(self):
+        """ Only a top level results key starts the results, whatever the
+        strings before it say """
+
+        data = ('{"preview":true,"messages":[{"type":"WARN",'
+                '"text":"\\"results\\": [1] \\"result\\""}],'
+                '"fields":[{"name":"results"}],"results":' +
+                json.dumps(self.rows) + '}\n' +
+                json.dumps({'result': {'mac': '"results":[{"a":1}]'}}))
+        evts = JSONReader(io.BytesIO(data))
+        parsed = []
+        for r in evts:
+            parsed.append((evts.is_preview, r))
+        self.assertEqual(parsed,
+                         [(True, r) for r in self.rows] +
+                         [(False, {'mac': '"results":[{"a":1}]'})])
+
+    def test_json_export(self):
+        """ A row at a time from export, previews first """
+
+        data = "\n".join(json.dumps({'preview': i < 2, 'offset': i,
+                                     'result': r})
+                         for i, r in enumerate(self.rows[:5]))
+        evts = JSONReader(io.BytesIO(data))
+        self.assertEqual([(evts.is_preview, r) for r in evts],
+                         [(i < 2, r) for i, r in enumerate(self.rows[:5])])
+
+    def test_csv(self):
+        """ Multivalue fields are split and empty ones left out """
+
+        data = ('start,mac,event_type,__mv_event_type\n'
+                '2018-01-16T13:36:16,aa:bb:cc:dd:ee:ff,'
+                '"DHCPACK\nDHCPEXPIRE",$DHCPACK$;$DHCPEXPIRE$\n'
+                'start,mac,event_type,__mv_event_type\n'
+                '2018-01-16T13:36:17,,DHCPACK,\n')
+        self.assertEqual(list(CSVReader(io.BufferedReader(io.BytesIO(data)))),
+                         [{'start': '2018-01-16T13:36:16',
+                           'mac': 'aa:bb:cc:dd:ee:ff',
+                           'event_type': ['DHCPACK', 'DHCPEXPIRE']},
+                          {'start': '2018-01-16T13:36:17',
+                           'event_type': 'DHCPACK'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
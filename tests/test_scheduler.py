@@ -0,0 +1,74 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+
+# Our class imports
+from geode.scheduler import Watermark, job_limit
+
+
+class WatermarkTestCase(unittest.TestCase):
+    """Test class for holding identity searches back behind DHCP"""
+
+    def setUp(self):
+        self.watermark = Watermark(datetime.datetime(2017, 1, 1, 12, 0, 0))
+        self.results = [{'start': '2017-01-01T11:59:00'},
+                        {'start': '2017-01-01T12:01:00'}]
+
+    def test_gate_waits_for_dhcp(self):
+        """ Events past the watermark wait until DHCP catches up """
+
+        seen = []
+        gate = self.watermark.gate(iter(self.results))
+        seen.append(next(gate))
+
+        t = threading.Thread(target=lambda: seen.append(next(gate)))
+        t.start()
+        t.join(0.1)
+        self.assertEqual(len(seen), 1)
+
+        self.watermark.advance(datetime.datetime(2017, 1, 1, 12, 1, 0))
+        t.join(5)
+        self.assertEqual(seen, self.results)
+
+    def test_gate_fails_with_dhcp(self):
+        """ Events past the watermark are not processed if DHCP fails """
+
+        self.watermark.fail()
+        gate = self.watermark.gate(iter(self.results))
+        self.assertEqual(next(gate), self.results[0])
+        self.assertRaises(Exception, next, gate)
+
+
+class JobLimitTestCase(unittest.TestCase):
+    """Test class for the number of jobs a search may have open"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'settings.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, text):
+        with open(self.path, 'w') as c:
+            c.write(text)
+
+    def test_prefetch(self):
+        """ Each search has room for its prefetched windows by default """
+
+        self._write("[Splunk]\nprefetch = 2\n[Concurrency]\nvpn = 1\n")
+        self.assertEqual(job_limit('dhcp', path=self.path), 3)
+        self.assertEqual(job_limit('vpn', path=self.path), 1)
+
+    def test_no_prefetch(self):
+        """ Without prefetching a search needs one job """
+
+        self._write("[Splunk]\nhost = localhost\n")
+        self.assertEqual(job_limit('dhcp', path=self.path), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
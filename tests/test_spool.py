@@ -0,0 +1,349 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import psycopg2
+    import splunklib.results
+except ImportError:
+    psycopg2 = splunklib = None
+
+# Our class imports
+import geode.spool
+from geode.spool import Spool
+if psycopg2 is not None and splunklib is not None:
+    import geode.main
+    from geode.main import Geode
+    from geode.splunk import Checkpoint
+
+
+class SpoolTestCase(unittest.TestCase):
+    """Test class for the on-disk spool"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _result(self, i):
+        return {'start': '2018-01-16T13:36:%02d' % (i % 60),
+                'mac': 'aa:bb:cc:dd:ee:ff',
+                'event_type': ['DHCPACK', 'DHCPEXPIRE']}
+
+    def test_groups(self):
+        """ Results come out grouped by search up to each checkpoint, and
+        only until they've been drained """
+
+        spool = Spool(self.directory)
+        checkpoint = datetime.datetime(2018, 1, 16, 13, 37)
+        for i in range(3):
+            spool.append('dhcp', self._result(i))
+        spool.checkpoint('dhcp', checkpoint)
+        spool.append('cas', self._result(3))
+        spool.checkpoint('cas', checkpoint)
+        # Not drained until it has a checkpoint
+        spool.append('cas', self._result(4))
+
+        groups = list(spool.groups())
+        self.assertEqual([(s, r, t) for s, r, t, p in groups],
+                         [('dhcp', [self._result(i) for i in range(3)],
+                           checkpoint),
+                          ('cas', [self._result(3)], checkpoint)])
+        self.assertEqual(type(groups[0][1][0]['mac']), str)
+
+        spool.commit(groups[0][3])
+        self.assertEqual([s for s, r, t, p in spool.groups()], ['cas'])
+        spool.commit(groups[1][3])
+        self.assertEqual(list(spool.groups()), [])
+        spool.close()
+
+    def test_segments(self):
+        """ Full segments are rolled over, and deleted once drained """
+
+        spool = Spool(self.directory, segment_size=500)
+        for i in range(20):
+            spool.append('dhcp', self._result(i))
+            spool.checkpoint('dhcp', datetime.datetime(2018, 1, 16, 0, i))
+        self.assertTrue(len(spool.segments()) > 2)
+
+        groups = list(spool.groups())
+        self.assertEqual([r for s, r, t, p in groups],
+                         [[self._result(i)] for i in range(20)])
+        spool.commit(groups[-1][3])
+        self.assertEqual(len(spool.segments()), 1)
+        spool.close()
+
+    def test_group_size(self):
+        """ Big windows are drained a piece at a time """
+
+        size = geode.spool.GROUP_SIZE
+        geode.spool.GROUP_SIZE = 2
+        try:
+            spool = Spool(self.directory)
+            for i in range(5):
+                spool.append('dhcp', self._result(i))
+            spool.checkpoint('dhcp', datetime.datetime(2018, 1, 16))
+            self.assertEqual([(len(r), t) for s, r, t, p in spool.groups()],
+                             [(2, None), (2, None),
+                              (1, datetime.datetime(2018, 1, 16))])
+            spool.close()
+        finally:
+            geode.spool.GROUP_SIZE = size
+
+    def test_max_size(self):
+        """ Once the spool is full, fetching waits at the next checkpoint
+        until it has been drained """
+
+        spool = Spool(self.directory, max_size=200)
+        spool.append('dhcp', self._result(0))
+        spool.checkpoint('dhcp', datetime.datetime(2018, 1, 16, 0, 0))
+        self.assertTrue(spool.pending < 200)
+
+        def fetch():
+            for i in range(1, 4):
+                spool.append('dhcp', self._result(i))
+            spool.checkpoint('dhcp', datetime.datetime(2018, 1, 16, 0, 1))
+
+        t = threading.Thread(target=fetch)
+        t.daemon = True
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+
+        for s, r, time, position in spool.groups():
+            spool.commit(position)
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(spool.pending, 0)
+        spool.close()
+
+        # What is waiting is worked out again when the spool is reopened
+        spool = Spool(self.directory, max_size=200)
+        self.assertEqual(spool.pending, 0)
+        spool.append('dhcp', self._result(4))
+        pending = spool.pending
+        spool.close()
+        spool = Spool(self.directory)
+        self.assertEqual(spool.pending, pending)
+        spool.close()
+
+    def test_reopen(self):
+        """ After a crash, a half written record is dropped and the rest is
+        still there, along with how far each search was fetched """
+
+        spool = Spool(self.directory)
+        spool.append('dhcp', self._result(0))
+        spool.checkpoint('dhcp', datetime.datetime(2018, 1, 16))
+        spool.close()
+        with open(os.path.join(self.directory,
+                               geode.spool.SEGMENT_FORMAT.format(0)),
+                  "ab") as f:
+            f.write('{"s":"dhcp","r":{"sta')
+
+        spool = Spool(self.directory)
+        self.assertEqual(spool.fetched('dhcp'), datetime.datetime(2018, 1, 16))
+        self.assertEqual(spool.fetched('cas'), None)
+        spool.append('dhcp', self._result(1))
+        spool.checkpoint('dhcp', datetime.datetime(2018, 1, 17))
+        self.assertEqual([r for s, r, t, p in spool.groups()],
+                         [[self._result(0)], [self._result(1)]])
+        spool.close()
+
+
+class FakeDatabase:
+    """Stands in for Database, keeping what is written in memory. Inserts
+    fail once there have been fail_at of them"""
+
+    def __init__(self, checkpoints=None, fail_at=None):
+        self.inserted = []
+        self.checkpoints = dict(checkpoints or {})
+        self.fail_at = fail_at
+        self.cache = None
+        self.shared = False
+
+    def select(self, event, lock=False):
+        return None
+
+    def insert(self, event):
+        if self.fail_at is not None and len(self.inserted) >= self.fail_at:
+            raise Exception("The database is down")
+        self.inserted.append(event)
+
+    def get_checkpoint(self, search):
+        return self.checkpoints.get(search)
+
+    def set_checkpoint(self, search, time):
+        self.checkpoints[search] = time
+        return True
+
+
+class FakeSplunk:
+    """Stands in for Splunk, giving every search the same results"""
+
+    def __init__(self, results, time):
+        self.results = results
+        self.time = time
+        self.searched = []
+
+    def search(self, s, latest_time, earliest_time, job_slots=None):
+        self.searched.append((s, earliest_time))
+        for r in self.results:
+            yield r
+        yield Checkpoint(self.time)
+
+
+class DrainTestCase(unittest.TestCase):
+    """Test class for fetching into the spool and draining it into the
+    database"""
+
+    def setUp(self):
+        if psycopg2 is None or splunklib is None:
+            raise unittest.SkipTest("Needs psycopg2 and splunklib")
+        self.directory = tempfile.mkdtemp()
+        self.time = datetime.datetime(2018, 1, 16, 13, 37)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _result(self, i):
+        return {'start': '2018-01-16T13:36:%02d' % i,
+                'mac': 'aa:bb:cc:dd:ee:%02d' % i,
+                'event_type': ['DHCPACK']}
+
+    def _geode(self, database=None, spool=None):
+        """Returns a Geode as _connect would leave it, but with database
+        in place of Postgres"""
+
+        g = Geode(log_file=os.devnull)
+        g.database = database
+        g.spool = spool
+        g.dhcp_search = 'dhcp'
+        g.batch_size = 0
+        g.shards = 0
+        g.dedup_window = 0
+        return g
+
+    def _fill(self, spool):
+        for i in range(3):
+            spool.append('dhcp', self._result(i))
+        spool.checkpoint('dhcp', self.time)
+        for i in range(3, 5):
+            spool.append('cas', self._result(i))
+        spool.checkpoint('cas', self.time)
+
+    def test_failure(self):
+        """ A group that fails to drain is left in the spool and drained
+        again, with the groups before it drained once """
+
+        spool = Spool(self.directory)
+        self._fill(spool)
+
+        database = FakeDatabase(fail_at=4)
+        g = self._geode(database)
+        self.assertRaises(Exception, g.drain_once, spool)
+        self.assertEqual(database.checkpoints, {'dhcp': self.time})
+        self.assertEqual([s for s, r, t, p in spool.groups()], ['cas'])
+
+        database.fail_at = None
+        g.drain_once(spool)
+        self.assertEqual([e.get('mac') for e in database.inserted],
+                         ['aa:bb:cc:dd:ee:%02d' % i
+                          for i in (0, 1, 2, 3, 3, 4)])
+        self.assertEqual(database.checkpoints, {'dhcp': self.time,
+                                                'cas': self.time})
+        self.assertEqual(list(spool.groups()), [])
+        spool.close()
+
+    def test_dedup_failure(self):
+        """ With dedup on, what failed to drain is still written when it is
+        drained again """
+
+        spool = Spool(self.directory)
+        self._fill(spool)
+
+        database = FakeDatabase(fail_at=4)
+        g = self._geode(database)
+        g.dedup_window = 60
+        g.dedup_size = 1000
+        self.assertRaises(Exception, g.drain_once, spool)
+        database.fail_at = None
+        g.drain_once(spool)
+        self.assertEqual([e.get('mac') for e in database.inserted],
+                         ['aa:bb:cc:dd:ee:%02d' % i
+                          for i in (0, 1, 2, 3, 3, 4)])
+        self.assertEqual(g.dedup_filters['cas'].stats()['suppressed'], 0)
+        spool.close()
+
+    def test_dedup_refetch(self):
+        """ Without a spool, a search that fails is fetched again from its
+        checkpoint, and whatever wasn't written gets through dedup """
+
+        database = FakeDatabase(fail_at=2)
+        g = self._geode(database)
+        g.dedup_window = 60
+        g.dedup_size = 1000
+        g.splunk = FakeSplunk([self._result(i) for i in range(4)], self.time)
+        self.assertRaises(Exception, g.run_search, 'dhcp', self.time)
+
+        database.fail_at = None
+        g.run_search('dhcp', self.time)
+        self.assertEqual(sorted(set(e.get('mac') for e in database.inserted)),
+                         ['aa:bb:cc:dd:ee:%02d' % i for i in range(4)])
+        self.assertEqual(database.checkpoints, {'dhcp': self.time})
+
+    def test_restart(self):
+        """ What wasn't drained before a restart is drained after it """
+
+        spool = Spool(self.directory)
+        self._fill(spool)
+        spool.close()
+
+        spool = Spool(self.directory)
+        database = FakeDatabase()
+        self._geode(database).drain_once(spool)
+        self.assertEqual(len(database.inserted), 5)
+        self.assertEqual(spool.fetched('dhcp'), self.time)
+        spool.close()
+
+    def test_run_search(self):
+        """ The first fetch of a search starts from the database's
+        checkpoint, and later ones from the spool without the database """
+
+        started = datetime.datetime(2018, 1, 16, 13, 30)
+        databases = []
+
+        def connect():
+            databases.append(FakeDatabase({'dhcp': started}))
+            return databases[-1]
+
+        database = geode.main.Database
+        geode.main.Database = connect
+        try:
+            spool = Spool(self.directory)
+            splunk = FakeSplunk([self._result(i) for i in range(3)],
+                                self.time)
+            g = self._geode(spool=spool)
+            g.splunk = splunk
+            g.run_search('dhcp', self.time)
+            self.assertEqual(len(databases), 1)
+            self.assertEqual(spool.fetched('dhcp'), self.time)
+
+            g = self._geode(spool=spool)
+            g.splunk = splunk
+            g.run_search('dhcp', self.time)
+            self.assertEqual(len(databases), 1)
+            self.assertEqual(splunk.searched, [('dhcp', started),
+                                               ('dhcp', self.time)])
+            self.assertEqual([len(r) for s, r, t, p in spool.groups()],
+                             [3, 3])
+            spool.close()
+        finally:
+            geode.main.Database = database
+
+
+if __name__ == '__main__':
+    unittest.main()
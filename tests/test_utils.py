@@ -0,0 +1,45 @@
+import unittest
+import datetime
+
+# Our class imports
+import geode.utils as utils
+
+
+class UtilsTestCase(unittest.TestCase):
+    """Test class for the time helpers in utils"""
+
+    def test_string_to_dto(self):
+        """ Times parse the same way strptime parses them """
+
+        for s in ['2016-11-22T11:11:22', '2000-02-29T00:00:00',
+                  '1999-12-31T23:59:59']:
+            self.assertEqual(utils.string_to_dto(s),
+                             datetime.datetime.strptime(s, utils.TIME_FORMAT))
+            # And again, from the memo
+            self.assertEqual(utils.string_to_dto(s),
+                             datetime.datetime.strptime(s, utils.TIME_FORMAT))
+
+        for s in ['2016-11-22 11:11:22', '2017-02-29T00:00:00', '2016-11-22',
+                  '2016-13-22T11:11:22', 'not a time at all']:
+            self.assertRaises(ValueError, utils.string_to_dto, s)
+
+    def test_dto_to_string(self):
+        """ Times format the same way strftime formats them """
+
+        for d in [datetime.datetime(2016, 11, 22, 11, 11, 22),
+                  datetime.datetime(2016, 1, 2, 3, 4, 5, 678)]:
+            self.assertEqual(utils.dto_to_string(d),
+                             d.strftime(utils.TIME_FORMAT))
+
+    def test_differences(self):
+        """ The string helpers agree with datetime arithmetic """
+
+        self.assertEqual(utils.time_diff_string('2016-12-31T23:59:30', 60),
+                         '2017-01-01T00:00:30')
+        self.assertEqual(utils.return_difference('2016-12-31T23:59:30',
+                                                 '2017-01-02T00:00:30'),
+                         24 * 60 * 60 + 60)
+
+
+if __name__ == '__main__':
+    unittest.main()